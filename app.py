@@ -1,31 +1,197 @@
 from __future__ import annotations
+import asyncio
 import json
-from typing import Any, Dict, List, Optional, Generator
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, Dict, List, Optional, Union
 
+import httpx
 from fastapi import FastAPI, Request, Response, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel, Field
 
-from openai import OpenAI
-from rag_query import answer as rag_answer
+from backend_pool import AsyncPoolClient, Backend, BackendPool, NoBackendAvailable, embedding_pool, generation_pool
+from rag_query import (
+    EMBED_MODEL, GEN_MODEL as RAG_MODEL, answer as rag_answer, pack_hits, prompt_messages,
+    embed_batcher, retrieval_cache, retrieve, retrieve_many, warmup_index,
+)
+from completion_cache import CompletionCache, completion_key
+from embed_cache import default_cache as embed_cache
+from readiness import Readiness
+from metrics import (
+    INFLIGHT_STREAMS, STREAMS_CANCELLED, STREAMS_TOTAL, GenerationMeter, ServerTimingMiddleware, Timings,
+    current_timings, render_metrics, span,
+)
+from scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, QueueFull, Scheduler, Ticket
+from sessions import Session, SessionStore
+from sse import FlushPolicy, SSEEvent, SSEWriter
+from tool_calls import ToolCallAssembler
+from tool_engine import ToolEngine
 
 # ====== 設定 ======
-OLLAMA_BASE_URL = "http://localhost:11434/v1"  # OllamaのOpenAI互換API
+# 生成・埋め込みを送る Ollama（複数可）は backend_pool.py の GENERATION_BACKENDS / EMBEDDING_BACKENDS
 OLLAMA_API_KEY = "ollama"                      # 任意文字列でOK
 MODEL_NAME = "gpt-oss:20b"                     # 例：gpt-oss:20b
 
-client = OpenAI(base_url=OLLAMA_BASE_URL, api_key=OLLAMA_API_KEY)
+# ====== 受付制御（Ollamaへ同時に投げる生成の数と待ち行列） ======
+SCHED_MAX_INFLIGHT = 4     # 同時に走らせる生成の数（Ollama の OLLAMA_NUM_PARALLEL の、生成バックエンド全体での合計に合わせる）
+SCHED_MAX_QUEUE = 64       # これ以上待たせる場合は 429 + Retry-After で即座に断る
+
+scheduler = Scheduler(max_inflight=SCHED_MAX_INFLIGHT, max_queue=SCHED_MAX_QUEUE)
+
+# /rag/batch（評価ジョブ向け）
+RAG_BATCH_MAX_QUERIES = 1000   # 1リクエストあたりの質問数の上限
+RAG_BATCH_CONCURRENCY = 4      # 同時に走らせる生成の数（リクエストの concurrency で上書き可）
+
+# サーバ側の会話履歴（session_id / X-Session-Id を指定したときだけ使う）
+SESSION_MAX = 10000            # 保持するセッション数の上限（超えたら最も古く使われたものから捨てる）
+SESSION_TTL = 3600.0           # 最後のターンからこの秒数で捨てる
+SESSION_MAX_TOKENS = 6000      # 履歴がこれを超えたら古いターンから落とす
+SESSION_TRIM_TO_TOKENS = 4000  # 落とすときはここまで一気に減らす（毎ターン先頭がずれないように）
+
+sessions = SessionStore(
+    max_sessions=SESSION_MAX, ttl=SESSION_TTL,
+    max_tokens=SESSION_MAX_TOKENS, trim_to_tokens=SESSION_TRIM_TO_TOKENS,
+)
+
+# SSEのまとめ送り（リクエストの flush_ms / flush_bytes で上書き可）
+SSE_FLUSH_MS = 40.0        # 最初の未送信デルタからこの時間で flush
+SSE_FLUSH_BYTES = 1024     # バッファがこのバイト数に達したら flush
+SSE_HEARTBEAT_SEC = 15.0   # 送るものが無い間（プリフィル・ツール実行中など）この間隔で ": ping" を送り、切断を確かめる
+
+# ====== HTTP接続プール（全リクエストで共有） ======
+# 同時SSE数の上限はスレッド数ではなく、ここの max_connections とバックエンド側で決まる
+HTTP_MAX_CONNECTIONS = 100          # 同時接続の上限（= 同時に生成できるストリーム数の上限）
+HTTP_MAX_KEEPALIVE = 20             # アイドル時に保持しておく keep-alive 接続数
+HTTP_KEEPALIVE_EXPIRY = 30.0        # keep-alive 接続を捨てるまでの秒数
+HTTP_CONNECT_TIMEOUT = 5.0          # 接続確立のタイムアウト（秒）
+HTTP_READ_TIMEOUT = 300.0           # トークン間の最大待ち時間（生成が遅いモデル向けに長め）
+HTTP_WRITE_TIMEOUT = 30.0
+HTTP_POOL_TIMEOUT = 10.0            # プールが満杯のとき空きを待つ最大秒数
+
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    ),
+    timeout=httpx.Timeout(
+        connect=HTTP_CONNECT_TIMEOUT,
+        read=HTTP_READ_TIMEOUT,
+        write=HTTP_WRITE_TIMEOUT,
+        pool=HTTP_POOL_TIMEOUT,
+    ),
+)
+
+# OpenAI クライアントと同じ呼び方で、呼び出しごとに同時実行数の少ないバックエンドへ送る。
+# 接続できない・5xx なら（ストリーミングは最初のチャンクより前なら）別のバックエンドで試し直す
+client = AsyncPoolClient(generation_pool, embedding_pool, api_key=OLLAMA_API_KEY, http_client=http_client)
+
+# ====== 起動時ウォームアップ（/ready） ======
+# 最初のリクエストで Ollama のモデル読み込みや Chroma のオープンを待たないよう、起動直後に裏で済ませておく。
+# keep_alive はこの読み込みに対する保持時間。以降の通常リクエストでも保持したい場合は Ollama 側の OLLAMA_KEEP_ALIVE も設定する。
+WARMUP_ENABLED = True
+WARMUP_KEEP_ALIVE = "30m"
+WARMUP_RETRIES = 5            # Ollama が後から起動する場合に備えてやり直す回数
+WARMUP_RETRY_DELAY = 2.0      # 最初のやり直しまでの秒数（以降は倍々）
+# /ready が 200 を返す条件。RAG も必須なら "embedding_model" と "index" を加える
+READY_REQUIRES = ("generation_model",)
+
+readiness = Readiness(["generation_model", "embedding_model", "index"], READY_REQUIRES)
+
+def ollama_root(base_url) -> str:
+    """OpenAI互換APIのURL（…/v1）から Ollama ネイティブAPIのURLを作る"""
+    url = str(base_url).rstrip("/")
+    return url[:-3] if url.endswith("/v1") else url
+
+async def warm_backends(pool: BackendPool, model: str, warm_one) -> Dict[str, Any]:
+    """model を受ける全バックエンドで warm_one を実行する。1台でも温まれば成功、全滅なら最後の例外を投げる"""
+    backends = pool.candidates(model)
+    if not backends:
+        raise NoBackendAvailable(f"no backends configured in pool '{pool.name}' for model '{model}'")
+    results = await asyncio.gather(*[warm_one(b) for b in backends], return_exceptions=True)
+    detail = {
+        b.url: f"error: {type(r).__name__}: {r}" if isinstance(r, Exception) else r
+        for b, r in zip(backends, results)
+    }
+    errors = [r for r in results if isinstance(r, Exception)]
+    if len(errors) == len(results):
+        raise errors[-1]
+    return {"model": model, "backends": detail}
+
+async def warm_generation_model() -> Dict[str, Any]:
+    async def one(b: Backend) -> str:
+        # prompt なしの /api/generate はモデルを読み込むだけで生成しない
+        res = await http_client.post(f"{ollama_root(b.url)}/api/generate",
+                                     json={"model": MODEL_NAME, "keep_alive": WARMUP_KEEP_ALIVE})
+        if res.status_code == 404:
+            # Ollama 以外の OpenAI互換サーバ：1トークンだけ生成させる
+            await client.client_for(b).chat.completions.create(
+                model=MODEL_NAME, messages=[{"role": "user", "content": "ping"}], max_tokens=1,
+            )
+            return "chat.completions"
+        res.raise_for_status()
+        return "api/generate"
+
+    return await warm_backends(generation_pool, MODEL_NAME, one)
+
+async def warm_embedding_model() -> Dict[str, Any]:
+    async def one(b: Backend) -> str:
+        res = await http_client.post(f"{ollama_root(b.url)}/api/embed",
+                                     json={"model": EMBED_MODEL, "input": "warmup", "keep_alive": WARMUP_KEEP_ALIVE})
+        if res.status_code == 404:
+            await client.client_for(b).embeddings.create(model=EMBED_MODEL, input=["warmup"])
+            return "embeddings"
+        res.raise_for_status()
+        return "api/embed"
+
+    return await warm_backends(embedding_pool, EMBED_MODEL, one)
+
+async def warm_index() -> Dict[str, Any]:
+    return await run_in_threadpool(warmup_index)
+
+async def warmup() -> None:
+    await asyncio.gather(
+        readiness.warm("generation_model", warm_generation_model, WARMUP_RETRIES, WARMUP_RETRY_DELAY),
+        readiness.warm("embedding_model", warm_embedding_model, WARMUP_RETRIES, WARMUP_RETRY_DELAY),
+        # インデックスが無いのは ingest 待ちなので、やり直さずに /ready で知らせるだけ
+        readiness.warm("index", warm_index),
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 受け付けは止めずに裏でウォームアップする（進み具合は /ready）
+    warmup_task = None
+    if WARMUP_ENABLED:
+        warmup_task = asyncio.create_task(warmup())
+    else:
+        for name in ("generation_model", "embedding_model", "index"):
+            readiness.skip(name)
+    # バックエンドの死活監視（落ちたものは切り離し、復帰したら戻す）
+    health_tasks = [asyncio.create_task(pool.run_health_checks(http_client))
+                    for pool in (generation_pool, embedding_pool)]
+    yield
+    for task in [warmup_task, *health_tasks]:
+        if task is not None:
+            task.cancel()
+    await asyncio.gather(*[t for t in [warmup_task, *health_tasks] if t is not None], return_exceptions=True)
+    # 終了時に keep-alive 接続とツール用スレッドを閉じる
+    await client.close()
+    tool_engine.shutdown()
 
 # ====== FastAPI ======
-app = FastAPI(title="gpt-oss SSE demo", version="1.0.0")
+app = FastAPI(title="gpt-oss SSE demo", version="1.0.0", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # 必要に応じて制限
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Session-Id", "X-Cache"],
 )
+app.add_middleware(ServerTimingMiddleware)
 
 # ====== Tools 定義（必要に応じて追加/削除OK） ======
 TOOLS = [
@@ -77,13 +243,21 @@ def get_current_weather(location: str, unit: str = "metric") -> Dict[str, Any]:
 def add_numbers(a: float, b: float) -> Dict[str, Any]:
     return {"a": a, "b": b, "sum": a + b}
 
-def dispatch_tool(name: str, args_json: str) -> Dict[str, Any]:
-    args = json.loads(args_json or "{}")
-    if name == "get_current_weather":
-        return get_current_weather(**args)
-    if name == "add_numbers":
-        return add_numbers(**args)
-    raise ValueError(f"Unknown tool: {name}")
+# ====== ツール実行エンジン ======
+# 並行実行の上限・ツールごとの締め切り・結果キャッシュの秒数はここで調整する
+TOOL_MAX_WORKERS = 8
+TOOL_CACHE_SIZE = 1024
+
+tool_engine = ToolEngine(max_workers=TOOL_MAX_WORKERS, cache_size=TOOL_CACHE_SIZE)
+tool_engine.register("get_current_weather", get_current_weather, timeout=5.0, cache_ttl=30.0)
+tool_engine.register("add_numbers", add_numbers, timeout=1.0, cache_ttl=300.0)
+
+# ====== 応答キャッシュ（/chat） ======
+# 決定的なリクエスト（temperature=0）か、"cache": true を付けたリクエストだけが対象。
+# 同じ messages / tools / tool_choice / モデル / temperature なら、2回の生成とツール実行を飛ばして保存済みの回答を流す。
+COMPLETION_CACHE_ENABLED = True
+
+completion_cache = CompletionCache()
 
 # ====== 入出力スキーマ ======
 class ChatMessage(BaseModel):
@@ -91,119 +265,495 @@ class ChatMessage(BaseModel):
     content: Optional[str] = None
     name: Optional[str] = None
 
-class ChatRequest(BaseModel):
+class SSEOptions(BaseModel):
+    # SSEのまとめ送り設定（未指定ならサーバ既定値）。低遅延UIは小さく、一括取得は大きく
+    flush_ms: Optional[float] = Field(default=None, ge=0, description="この時間(ms)ごとにflush。0でデルタごと")
+    flush_bytes: Optional[int] = Field(default=None, ge=0, description="このバイト数でflush。0でデルタごと")
+    sse_ids: bool = Field(default=False, description="dataフレームに連番 id: を付ける")
+    debug: bool = Field(default=False, description="[DONE] の直前に event: debug で区間ごとの所要時間を送る")
+
+    def flush_policy(self) -> FlushPolicy:
+        return FlushPolicy(
+            max_bytes=SSE_FLUSH_BYTES if self.flush_bytes is None else self.flush_bytes,
+            max_delay_ms=SSE_FLUSH_MS if self.flush_ms is None else self.flush_ms,
+            emit_ids=self.sse_ids,
+        )
+
+    def sse_writer(self, request: Request) -> SSEWriter:
+        return SSEWriter(self.flush_policy(), heartbeat_sec=SSE_HEARTBEAT_SEC,
+                         is_disconnected=request.is_disconnected)
+
+class ChatRequest(SSEOptions):
     messages: List[ChatMessage]
+    session_id: Optional[str] = Field(
+        default=None, max_length=128,
+        description="指定すると履歴をサーバ側に持つ（messages は今回の分だけ送る）。\"new\" なら新規発行",
+    )
     temperature: float = 0.2
     tool_choice: str = Field(default="auto", description="auto|required|none")
+    stream_first: bool = Field(default=True, description="1回目(ツール判定)からストリーミングするか")
+    cache: Optional[bool] = Field(
+        default=None, description="true で応答キャッシュを使う / false で使わない。未指定なら temperature=0 のときだけ",
+    )
 
-# ====== SSEユーティリティ ======
-def sse_data(data: str, event: Optional[str] = None) -> bytes:
-    """
-    SSEフレームを生成する。例:
-      data: こんにちは
-      \n
-    """
-    if event:
-        payload = f"event: {event}\ndata: {data}\n\n"
-    else:
-        payload = f"data: {data}\n\n"
-    return payload.encode("utf-8")
+    def cacheable(self) -> bool:
+        if not COMPLETION_CACHE_ENABLED:
+            return False
+        return self.cache if self.cache is not None else self.temperature == 0
+
+class RagRequest(SSEOptions):
+    query: str
+    top_k: int = Field(default=4, ge=1, le=50)
+    temperature: float = 0.2
+    mode: Optional[str] = Field(default=None, description="vector|lexical|hybrid（未指定ならサーバ既定値）")
+
+class RagBatchRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=RAG_BATCH_MAX_QUERIES)
+    top_k: int = Field(default=4, ge=1, le=50)
+    temperature: float = 0.2
+    mode: Optional[str] = Field(default=None, description="vector|lexical|hybrid（未指定ならサーバ既定値）")
+    concurrency: Optional[int] = Field(default=None, ge=1, le=64, description="同時に走らせる生成の数")
 
 # ====== コア処理：ツール解決 → 本回答をSSEで流す ======
-def stream_final_answer(messages: List[Dict[str, Any]], temperature: float, tool_choice: str) -> Generator[bytes, None, None]:
+async def stream_final_answer(
+    messages: List[Dict[str, Any]],
+    temperature: float,
+    tool_choice: str,
+    stream_first: bool = True,
+    timings: Optional[Timings] = None,
+) -> AsyncGenerator[Union[str, SSEEvent], None]:
     """
-    2段階構成：
-      (1) 1回目: ツール呼び出しが必要かを判定（この段は外へは流さない）
-      (2) ツールを全部実行してrole=toolで渡したあと、
+    テキスト差分（str）と制御フレーム（SSEEvent）を順に返す。SSEへの符号化とまとめ送りは SSEWriter が行う。
+    2段階構成（AsyncOpenAI上の非同期ジェネレータ。スレッドプールを占有しない）：
+      (1) 1回目: ツール呼び出しが必要かを判定
+          - stream_first=True : 1回目から stream=True。テキストは即クライアントへ流し、
+                                tool_calls の断片は index ごとに組み立てる
+          - stream_first=False: 1回目は non-stream（この段は外へは流さない）
+      (2) ツールが要求されたときだけ、全部実行して role=tool で渡したあと、
           2回目を stream=True でSSEとしてクライアントへ逐次送信
+    messages には、送った assistant / tool メッセージと最終回答を追記していく（セッションの履歴になる）。
+    timings には first_round / tools / second_round と ttft（最初のトークンまで）を記録する。
     """
+    meter = GenerationMeter("chat", timings)
     # -------- 1回目（tool判定） --------
-    # stream=Trueでもいいが、外に流さないためnon-streamで十分。
-    first = client.chat.completions.create(
+    first_kwargs = dict(
         model=MODEL_NAME,
         messages=messages,
         tools=None if tool_choice == "none" else TOOLS,
         tool_choice=None if tool_choice == "auto" else tool_choice,  # "required"を渡す場合あり
         temperature=temperature,
-        stream=False,
     )
 
-    choice = first.choices[0]
-    tool_calls = getattr(choice.message, "tool_calls", None)
+    if stream_first:
+        # ツール不要ならこの1ラウンドで回答が完結する（TTFT = 1回目の最初のトークン）
+        assembler = ToolCallAssembler()
+        content_parts: List[str] = []
+        with span("first_round", timings=timings):
+            stream = await client.chat.completions.create(
+                **first_kwargs, stream=True, stream_options={"include_usage": True},
+            )
+            async with stream:
+                async for ev in stream:
+                    meter.usage(ev.usage)
+                    if not ev.choices:
+                        continue
+                    delta = ev.choices[0].delta
+                    if not delta:
+                        continue
+                    if chunk := (delta.content or ""):
+                        meter.token()
+                        content_parts.append(chunk)
+                        yield chunk
+                    if delta.tool_calls:
+                        assembler.add(delta.tool_calls)
+
+        if not len(assembler):
+            meter.finish()
+            messages.append({"role": "assistant", "content": "".join(content_parts)})
+            yield SSEEvent("[DONE]")
+            return
+        assistant_content = "".join(content_parts) or None
+        tool_calls = assembler.calls()
+    else:
+        with span("first_round", timings=timings):
+            first = await client.chat.completions.create(**first_kwargs, stream=False)
+        choice = first.choices[0]
+        if not choice.message.tool_calls:
+            # ツール不要なら、firstのテキストをそのまま流す
+            # （改行を含んでいても SSEWriter が data: 行に分割する）
+            if text := (choice.message.content or ""):
+                meter.token()
+                yield text
+            messages.append({"role": "assistant", "content": choice.message.content or ""})
+            yield SSEEvent("[DONE]")
+            return
+        assistant_content = choice.message.content
+        tool_calls = [tc.model_dump() for tc in choice.message.tool_calls]
+
+    # -------- ツール実行 --------
+    # assistant側（ツール指示を含む）を会話にも残す
+    messages.append({
+        "role": "assistant",
+        "content": assistant_content,
+        "tool_calls": tool_calls,
+    })
 
-    # ツールが必要なら、全部実行して tool メッセージを積む
-    if tool_calls:
-        # assistant側（ツール指示を含む）を会話にも残す
+    # それぞれのツールを並行に実行して、元の順で role=tool として返す
+    with span("tools", timings=timings):
+        results = await tool_engine.run_all(tool_calls)
+    for idx, (tc, result) in enumerate(zip(tool_calls, results)):
         messages.append({
-            "role": "assistant",
-            "content": choice.message.content,
-            "tool_calls": [tc.model_dump() for tc in tool_calls],
+            "role": "tool",
+            "tool_call_id": tc["id"] or f"tool-call-{idx+1}",
+            "name": tc["function"]["name"],
+            "content": json.dumps(result, ensure_ascii=False),
         })
 
-        # それぞれのツールを実行して、role=toolで返す
-        for idx, tc in enumerate(tool_calls):
-            name = tc.function.name
-            args_json = tc.function.arguments or "{}"
-            try:
-                result = dispatch_tool(name, args_json)
-            except Exception as e:
-                result = {"error": str(e)}
-
-            messages.append({
-                "role": "tool",
-                "tool_call_id": tc.id or f"tool-call-{idx+1}",
-                "name": name,
-                "content": json.dumps(result, ensure_ascii=False),
-            })
-    else:
-        # ツール不要なら、firstのテキストをそのまま流す
-        text = choice.message.content or ""
-        if text:
-            # 逐次化のために適当に分割送信（実運用ではモデルのstream推奨）
-            for ch in text:
-                yield sse_data(ch)
-        yield sse_data("[DONE]")
-        return
-
     # -------- 2回目（本回答をSSEで流す） --------
-    with client.chat.completions.create(
-        model=MODEL_NAME,
-        messages=messages,
-        temperature=temperature,
-        stream=True,
-    ) as stream:
-        for ev in stream:
-            delta = ev.choices[0].delta
-            # 逐次テキストをSSEで送信
-            if delta and (chunk := (delta.content or "")):
-                yield sse_data(chunk)
+    answer_parts: List[str] = []
+    with span("second_round", timings=timings):
+        stream = await client.chat.completions.create(
+            model=MODEL_NAME,
+            messages=messages,
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async with stream:
+            async for ev in stream:
+                meter.usage(ev.usage)
+                if not ev.choices:
+                    continue
+                delta = ev.choices[0].delta
+                # 逐次テキストをSSEで送信
+                if delta and (chunk := (delta.content or "")):
+                    meter.token()
+                    answer_parts.append(chunk)
+                    yield chunk
+    meter.finish()
+    messages.append({"role": "assistant", "content": "".join(answer_parts)})
 
     # 最後に完了シグナル
-    yield sse_data("[DONE]")
+    yield SSEEvent("[DONE]")
+
+# ====== RAG：検索結果 → 回答トークン → 計測値 をSSEで流す ======
+async def stream_rag_answer(query: str, top_k: int, temperature: float, mode: Optional[str] = None,
+                            timings: Optional[Timings] = None) -> AsyncGenerator[Union[str, SSEEvent], None]:
+    """
+    イベント順：
+      event: sources  … 検索が終わった時点で出典一覧（id, source, chunk, score）
+      data: ...       … 回答トークン
+      event: done     … 所要時間（ms）・usage・コンテキスト詰め込みの結果（削減トークン数など）
+      data: [DONE]
+    """
+    t0 = time.perf_counter()
+    meter = GenerationMeter("rag_stream", timings)
+    # 検索（埋め込み＋Chroma）は同期APIなのでスレッドプールで実行
+    with span("retrieve", timings=timings):
+        hits = await run_in_threadpool(retrieve, query, top_k, None, mode)
+    t_retrieved = time.perf_counter()
+    sources = [
+        {
+            "id": h["id"],
+            "source": h["meta"].get("source"),
+            "chunk": h["meta"].get("chunk"),
+            "score": h["score"],
+        }
+        for h in hits
+    ]
+    yield SSEEvent(json.dumps({"sources": sources}, ensure_ascii=False), event="sources")
+
+    with span("pack_context", timings=timings):
+        packed = pack_hits(hits)
+    usage = None
+    t_first = None
+    with span("generate", timings=timings):
+        stream = await client.chat.completions.create(
+            model=RAG_MODEL,
+            messages=prompt_messages(query, packed.text),
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async with stream:
+            async for ev in stream:
+                meter.usage(ev.usage)
+                if ev.usage:
+                    usage = ev.usage.model_dump()
+                if not ev.choices:
+                    continue
+                delta = ev.choices[0].delta
+                if delta and (chunk := (delta.content or "")):
+                    meter.token()
+                    if t_first is None:
+                        t_first = time.perf_counter()
+                    yield chunk
+    meter.finish()
+    t_end = time.perf_counter()
+
+    timing = {
+        "retrieve_ms": round((t_retrieved - t0) * 1000, 1),
+        "ttft_ms": round(((t_first or t_end) - t0) * 1000, 1),
+        "generate_ms": round((t_end - t_retrieved) * 1000, 1),
+        "total_ms": round((t_end - t0) * 1000, 1),
+    }
+    yield SSEEvent(
+        json.dumps({"timing": timing, "usage": usage, "context": packed.stats}, ensure_ascii=False), event="done"
+    )
+    yield SSEEvent("[DONE]")
+
+# ====== 応答キャッシュ：保存と再生 ======
+def tool_failed(messages: List[Dict[str, Any]]) -> bool:
+    """ツール結果に {"error": ...} が含まれるか（失敗を含む回答はキャッシュしない）"""
+    for m in messages:
+        if m.get("role") == "tool":
+            try:
+                result = json.loads(m.get("content") or "{}")
+            except json.JSONDecodeError:
+                return True
+            if isinstance(result, dict) and "error" in result:
+                return True
+    return False
+
+def completion_ttl(messages: List[Dict[str, Any]]) -> Optional[float]:
+    """
+    回答をキャッシュしておける秒数。ツール結果を含む回答は、使ったツールの cache_ttl のうち最短まで縮める。
+    キャッシュしないツール（cache_ttl なし）を使った回答は 0（キャッシュしない）。
+    """
+    ttls = [tool_engine.cache_ttl(m.get("name") or "") for m in messages if m.get("role") == "tool"]
+    if not ttls:
+        return completion_cache.ttl
+    if any(ttl is None for ttl in ttls):
+        return 0.0
+    shortest = min(ttls)
+    return min(shortest, completion_cache.ttl) if completion_cache.ttl else shortest
+
+async def cached_completion(key: str, messages: List[Dict[str, Any]],
+                            source: AsyncGenerator[Union[str, SSEEvent], None]) -> AsyncGenerator[Union[str, SSEEvent], None]:
+    """
+    source をそのまま流しつつ、流したテキストと追記された assistant / tool メッセージを集め、
+    最後まで流れたら（[DONE] の直前に）キャッシュへ入れる。途中で切断・失敗したものは入れない。
+    寿命は completion_ttl（ツールの結果より長く使い回さない）。
+    """
+    n_before = len(messages)
+    parts: List[str] = []
+    async for item in source:
+        if isinstance(item, str):
+            parts.append(item)
+        elif item.data == "[DONE]":
+            added = messages[n_before:]
+            ttl = completion_ttl(added)
+            if not tool_failed(added) and ttl != 0:
+                entry = {"model": MODEL_NAME, "text": "".join(parts), "messages": added, "created": time.time()}
+                await run_in_threadpool(completion_cache.put, key, entry, ttl)
+        yield item
+
+async def replay_completion(entry: Dict[str, Any],
+                            timings: Optional[Timings] = None) -> AsyncGenerator[Union[str, SSEEvent], None]:
+    """キャッシュした回答を待ち時間なしで流す（フレーム分割と id: は SSEWriter がふだんどおり行う）"""
+    if timings is not None:
+        timings.mark("ttft")
+    if text := entry.get("text"):
+        yield text
+    yield SSEEvent("[DONE]")
+
+# ====== 受付制御のヘルパー ======
+def client_key(request: Request) -> str:
+    """公平性の単位。X-Client-Id ヘッダがあればそれ、なければ接続元IPアドレス"""
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "unknown")
+
+def too_many_requests(e: QueueFull) -> JSONResponse:
+    return JSONResponse(
+        {"detail": "server busy, retry later"},
+        status_code=429,
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+async def session_turn(session: Session, new_messages: List[Dict[str, Any]], temperature: float,
+                       tool_choice: str, stream_first: bool,
+                       timings: Optional[Timings] = None) -> AsyncGenerator[Union[str, SSEEvent], None]:
+    """
+    セッションの履歴＋今回のメッセージで stream_final_answer を回し、最後まで終わったら履歴を更新する。
+    途中で切断・失敗したターンは履歴に残さない（次のターンは前回の完了時点から続く）。
+    """
+    async with session.lock:
+        messages = session.prompt(new_messages)
+        async for item in stream_final_answer(messages, temperature, tool_choice, stream_first, timings):
+            if isinstance(item, SSEEvent) and item.data == "[DONE]":
+                sessions.commit(session, messages)
+            yield item
+
+async def scheduled(ticket: Ticket, source: AsyncGenerator[Union[str, SSEEvent], None],
+                    timings: Optional[Timings] = None) -> AsyncGenerator[Union[str, SSEEvent], None]:
+    """
+    順番待ちの間は event: queue で位置（前に何件いるか）を送り、順番が来たら source を流す。
+    終わったら（切断されても）必ず枠を返す。
+    """
+    try:
+        with span("queue", timings=timings):
+            async for position in ticket.wait():
+                yield SSEEvent(json.dumps({"position": position}), event="queue")
+        async for item in source:
+            yield item
+    finally:
+        ticket.release()
+
+class ScheduledResponse(StreamingResponse):
+    """
+    整理券つきの StreamingResponse。本文の送信が終わったら（例外でも）整理券を返す。
+    本文を1度も読み出す前にクライアントが切断すると scheduled() の finally は走らないので、
+    エンドポイントで enqueue したぶんはここで必ず返す（release は2回呼んでも1回ぶん）。
+    """
+
+    def __init__(self, ticket: Ticket, content: Any, **kwargs: Any) -> None:
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.ticket.release()
+
+def cancel_stage(timings: Optional[Timings]) -> str:
+    """切断されたときに実行中だった区間（queue / first_round / tools / second_round / retrieve / generate など）"""
+    if timings is None:
+        return "unknown"
+    return timings.interrupted or "between_phases"
+
+async def instrumented(endpoint: str, source: AsyncGenerator[Union[str, SSEEvent], None],
+                       timings: Optional[Timings], debug: bool = False) -> AsyncGenerator[Union[str, SSEEvent], None]:
+    """
+    同時ストリーム数を数え、debug=True なら [DONE] の直前に区間ごとの所要時間を event: debug で送る。
+    クライアントが途中で居なくなったら（SSEWriter 経由でキャンセル/クローズされる）段階ごとに数える。
+    このとき上流の生成ストリームは async with で閉じられ、未実行のツールも走らない。
+    """
+    STREAMS_TOTAL.inc(endpoint=endpoint)
+    with INFLIGHT_STREAMS.track(endpoint=endpoint):
+        try:
+            async for item in source:
+                if debug and timings is not None and isinstance(item, SSEEvent) and item.data == "[DONE]":
+                    yield SSEEvent(json.dumps({"timings_ms": timings.as_dict()}), event="debug")
+                yield item
+        except (asyncio.CancelledError, GeneratorExit):
+            STREAMS_CANCELLED.inc(endpoint=endpoint, stage=cancel_stage(timings))
+            raise
 
 # ====== エンドポイント ======
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+@app.get("/ready")
+def ready():
+    """
+    起動時ウォームアップの状態（モデル読み込み・インデックス）。
+    READY_REQUIRES が揃うまでは 503 を返すので、ロードバランサの readiness probe に使える。
+    /health はプロセスが生きているかだけを見る。
+    """
+    snapshot = readiness.snapshot()
+    return JSONResponse(snapshot, status_code=200 if snapshot["ready"] else 503)
+
+@app.get("/tools/stats")
+def tools_stats():
+    """ツール実行のキャッシュヒット/ミスと、ツールごとの呼び出し回数・レイテンシ"""
+    return tool_engine.stats()
+
 @app.post("/chat")
-async def chat(req: ChatRequest):
+async def chat(req: ChatRequest, request: Request):
     """
     入力:
       {
         "messages": [{"role":"user", "content":"Matsuyamaの天気を華氏で"}],
         "tool_choice": "auto" | "required" | "none",
-        "temperature": 0.2
+        "temperature": 0.2,
+        "stream_first": true,
+        "session_id": "new" | "<前回の X-Session-Id>",            # 省略可（ヘッダ X-Session-Id でも可）
+        "cache": true | false,                                  # 省略可（未指定なら temperature=0 のときだけ応答キャッシュ）
+        "flush_ms": 40, "flush_bytes": 1024, "sse_ids": false,  # 省略可
+        "debug": false                                          # true で最後に event: debug（区間ごとの ms）
       }
     出力:
-      text/event-stream (SSE)
+      text/event-stream (SSE)。混雑時は先に event: queue {"position": n} が届く
+      待ち行列が満杯なら 429 + Retry-After
+      セッション使用時はレスポンスヘッダ X-Session-Id。次のターンは新しいメッセージだけ送ればよい
+      知らない・期限切れの session_id は 404（新しく始めるときは "new"）
+      応答キャッシュの対象ならレスポンスヘッダ X-Cache: HIT | MISS（HIT のときは生成せず保存済みの回答を流す）
     """
-    # Pydantic -> dict 変換（OpenAI SDKに渡す形式へ）
-    messages = [m.model_dump() for m in req.messages]
+    timings = current_timings()
+    session_id = req.session_id or request.headers.get("x-session-id")
+    session = None
+    if session_id == "new":
+        session = sessions.create()
+    elif session_id:
+        # ID はサーバが発行したものだけ受け付ける（知らない ID で新しいセッションを作らない）
+        session = sessions.resume(session_id)
+        if session is None:
+            return JSONResponse({"error": "session not found"}, status_code=404)
+
+    # 応答キャッシュ（セッションは履歴がターンごとに変わり当たらないので対象外）
+    cache_key = None
+    if session is None and req.cacheable():
+        messages = [m.model_dump() for m in req.messages]
+        tools = None if req.tool_choice == "none" else TOOLS
+        cache_key = completion_key(MODEL_NAME, messages, tools, req.tool_choice, req.temperature)
+        with span("cache_lookup", timings=timings):
+            entry = await run_in_threadpool(completion_cache.get, cache_key)
+        if entry is not None:
+            # 当たれば生成しないので順番待ちもしない
+            generator = instrumented("chat", replay_completion(entry, timings), timings, req.debug)
+            return StreamingResponse(req.sse_writer(request).stream(generator), media_type="text/event-stream",
+                                     headers={"X-Cache": "HIT"})
+
+    try:
+        ticket = scheduler.enqueue(client_key(request), PRIORITY_INTERACTIVE)
+    except QueueFull as e:
+        return too_many_requests(e)
+
+    if session is None:
+        # Pydantic -> dict 変換（OpenAI SDKに渡す形式へ）
+        messages = [m.model_dump() for m in req.messages]
+        source = stream_final_answer(messages, req.temperature, req.tool_choice, req.stream_first, timings)
+        headers = None
+        if cache_key is not None:
+            source = cached_completion(cache_key, messages, source)
+            headers = {"X-Cache": "MISS"}
+    else:
+        # 履歴の先頭を毎回同じ形にするため、None のフィールドは持たない
+        messages = [m.model_dump(exclude_none=True) for m in req.messages]
+        source = session_turn(session, messages, req.temperature, req.tool_choice, req.stream_first, timings)
+        headers = {"X-Session-Id": session.id}
 
     # SSEのストリーミングレスポンス
-    generator = stream_final_answer(messages, req.temperature, req.tool_choice)
-    return StreamingResponse(generator, media_type="text/event-stream")
+    generator = instrumented("chat", scheduled(ticket, source, timings), timings, req.debug)
+    return ScheduledResponse(ticket, req.sse_writer(request).stream(generator), media_type="text/event-stream",
+                             headers=headers)
+
+@app.get("/chat/cache/stats")
+def chat_cache_stats():
+    """/chat の応答キャッシュのヒット/ミスと使用バイト数"""
+    return completion_cache.stats()
+
+@app.delete("/chat/cache")
+def clear_chat_cache():
+    completion_cache.clear()
+    return {"cleared": True}
+
+@app.get("/sessions/stats")
+def sessions_stats():
+    """保持しているセッション数など"""
+    return sessions.stats()
+
+@app.get("/sessions/{session_id}")
+def session_info(session_id: str):
+    session = sessions.get(session_id)
+    if session is None:
+        return JSONResponse({"error": "session not found"}, status_code=404)
+    return session.info()
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    return {"deleted": sessions.delete(session_id)}
 
 # ---- 便利: ルート ----
 @app.get("/")
@@ -211,11 +761,111 @@ def root():
     return JSONResponse({"message": "POST /chat (SSE). curl例はREADME参照。"})
 
 @app.post("/rag")
-def rag(query: str = Body(..., embed=True)):
+async def rag(request: Request, query: str = Body(..., embed=True)):
     """
     入力: { "query": "..." }
     出力: { "answer": "..." }
     """
-    out = rag_answer(query)
+    try:
+        ticket = scheduler.enqueue(client_key(request), PRIORITY_BULK)
+    except QueueFull as e:
+        return too_many_requests(e)
+    try:
+        with span("queue"):
+            await ticket.wait_granted()
+        out = await run_in_threadpool(rag_answer, query)
+    finally:
+        ticket.release()
     return {"answer": out}
 
+@app.post("/rag/stream")
+async def rag_stream(req: RagRequest, request: Request):
+    """
+    入力: { "query": "...", "top_k": 4, "temperature": 0.2, "mode": "vector" | "lexical" | "hybrid" }
+    出力: text/event-stream (SSE)。sources → 回答トークン → done の順
+    （一括で受け取りたいバッチ用途は従来どおり POST /rag）
+    画面で待つ用途なので /chat と同じ優先度で扱う。
+    """
+    try:
+        ticket = scheduler.enqueue(client_key(request), PRIORITY_INTERACTIVE)
+    except QueueFull as e:
+        return too_many_requests(e)
+    timings = current_timings()
+    source = stream_rag_answer(req.query, req.top_k, req.temperature, req.mode, timings)
+    generator = instrumented("rag_stream", scheduled(ticket, source, timings), timings, req.debug)
+    return ScheduledResponse(ticket, req.sse_writer(request).stream(generator), media_type="text/event-stream")
+
+@app.post("/rag/batch")
+async def rag_batch(req: RagBatchRequest, request: Request):
+    """
+    入力: { "queries": ["...", "..."], "top_k": 4, "concurrency": 4 }
+    出力: { "results": [ {"query", "answer", "sources", "context"} | {"query", "error"}, ... ] }（入力順）
+    検索は全質問まとめて（埋め込み1回・ベクトル検索1回）、生成は concurrency 本ずつ並行に行う。
+    検索も生成と同じく低優先度の整理券を取ってから行う（まとめた埋め込み・検索が対話的な要求を押しのけない）。
+    """
+    cid = client_key(request)
+    try:
+        ticket = scheduler.enqueue(cid, PRIORITY_BULK)
+    except QueueFull as e:
+        return too_many_requests(e)
+    try:
+        with span("queue"):
+            await ticket.wait_granted()
+        all_hits = await run_in_threadpool(retrieve_many, req.queries, req.top_k, None, req.mode, PRIORITY_BULK)
+    except Exception as e:
+        return {"results": [{"query": q, "error": f"retrieve failed: {e}"} for q in req.queries]}
+    finally:
+        ticket.release()
+
+    sem = asyncio.Semaphore(req.concurrency or RAG_BATCH_CONCURRENCY)
+
+    async def generate(query: str, hits: List[Dict[str, Any]]) -> Dict[str, Any]:
+        sources = [{"id": h["id"], "score": h["score"]} for h in hits]
+        packed = pack_hits(hits)
+        try:
+            async with sem:
+                # 1件ずつ低優先度で並ぶ（対話的な /chat を追い越さない）
+                ticket = scheduler.enqueue(cid, PRIORITY_BULK)
+                try:
+                    await ticket.wait_granted()
+                    res = await client.chat.completions.create(
+                        model=RAG_MODEL,
+                        messages=prompt_messages(query, packed.text),
+                        temperature=req.temperature,
+                    )
+                finally:
+                    ticket.release()
+            return {"query": query, "answer": res.choices[0].message.content, "sources": sources,
+                    "context": packed.stats}
+        except QueueFull as e:
+            return {"query": query, "error": f"queue full, retry after {e.retry_after}s", "sources": sources}
+        except Exception as e:
+            return {"query": query, "error": str(e), "sources": sources}
+
+    results = await asyncio.gather(*[generate(q, hits) for q, hits in zip(req.queries, all_hits)])
+    return {"results": results}
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus 形式の計測値（TTFT・tokens/sec・ツール/埋め込み/検索のレイテンシ・同時ストリーム数）"""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/backends/stats")
+def backends_stats():
+    """バックエンドごとの同時実行数・リクエスト数・失敗数・切り離し状態・レイテンシ（EWMA）"""
+    return {"generation": generation_pool.stats(), "embedding": embedding_pool.stats()}
+
+@app.get("/scheduler/stats")
+def scheduler_stats():
+    """同時実行数・待ち行列の長さ・429で断った件数"""
+    return scheduler.stats()
+
+@app.get("/rag/stats")
+def rag_stats():
+    """検索結果キャッシュと埋め込みキャッシュのヒット/ミス、埋め込みマイクロバッチの効き具合"""
+    return {
+        "retrieval_cache": retrieval_cache.stats(),
+        "embed_cache": embed_cache().stats(),
+        "embed_batcher": embed_batcher.stats(),
+    }
+
@@ -0,0 +1,402 @@
+# backend_pool.py
+from __future__ import annotations
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import httpx
+import openai
+from openai import AsyncOpenAI, OpenAI
+
+from metrics import BACKEND_FAILURES, BACKEND_INFLIGHT, BACKEND_SECONDS
+
+# ---- バックエンド（Ollama の OpenAI互換API）----
+# 生成と埋め込みで別のプールにできる。
+#   url    : OpenAI互換APIのベースURL（…/v1）
+#   weight : 重み。同時実行数を weight で割った値が小さいものへ送る（GPU が倍なら 2.0 など）
+#   models : このバックエンドに送ってよいモデル名。省略時はどのモデルも受ける
+GENERATION_BACKENDS: List[Dict[str, Any]] = [
+    {"url": "http://localhost:11434/v1", "weight": 1.0},
+    # {"url": "http://gpu2:11434/v1", "weight": 2.0, "models": ["gpt-oss:20b"]},
+]
+EMBEDDING_BACKENDS: List[Dict[str, Any]] = [
+    {"url": "http://localhost:11434/v1", "weight": 1.0},
+    # {"url": "http://cpu1:11434/v1", "weight": 1.0, "models": ["nomic-embed-text"]},
+]
+BACKEND_API_KEY = "ollama"            # 任意文字列でOK
+
+# ---- ヘルスチェックと切り離し ----
+HEALTH_CHECK_INTERVAL = 10.0          # 秒ごとに GET {url}/models
+HEALTH_CHECK_TIMEOUT = 2.0
+EJECT_AFTER_FAILURES = 3              # 連続でこの回数失敗したら切り離す（ヘルスチェックと本番の失敗の合計）
+EJECT_SECONDS = 30.0                  # 切り離している時間。過ぎたら候補に戻し、また失敗すればすぐ切り離す
+EXTRA_ATTEMPTS = 1                    # 候補を一巡したあとに追加で試す回数（1台構成での再試行）
+LATENCY_EWMA_ALPHA = 0.2
+
+# 別のバックエンドで試し直す失敗（接続できない・5xx・混雑・そのモデルが無い）
+RETRYABLE_ERRORS: Tuple[type, ...] = (
+    openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError, openai.NotFoundError,
+    httpx.TransportError,
+)
+# このうちバックエンドの不調とみなして連続失敗に数えるもの
+UNHEALTHY_ERRORS: Tuple[type, ...] = (openai.APIConnectionError, openai.InternalServerError, httpx.TransportError)
+
+
+class NoBackendAvailable(RuntimeError):
+    pass
+
+
+@dataclass(eq=False)
+class Backend:
+    url: str
+    weight: float = 1.0
+    models: Optional[Tuple[str, ...]] = None
+    inflight: int = 0
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    ejected_until: float = 0.0
+    ejections: int = 0
+    latency_ms: Optional[float] = None     # 1リクエストの所要時間（EWMA）
+    ttft_ms: Optional[float] = None        # ストリーミングで最初のチャンクまで（EWMA）
+    last_error: Optional[str] = None
+
+    def supports(self, model: Optional[str]) -> bool:
+        return model is None or self.models is None or model in self.models
+
+    def ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    def load(self) -> float:
+        return (self.inflight + 1) / max(self.weight, 1e-6)
+
+    def info(self, now: float) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "models": list(self.models) if self.models is not None else None,
+            "healthy": not self.ejected(now),
+            "inflight": self.inflight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+            "ejected_for_sec": round(max(0.0, self.ejected_until - now), 1),
+            "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+            "ttft_ms": round(self.ttft_ms, 1) if self.ttft_ms is not None else None,
+            "last_error": self.last_error,
+        }
+
+
+def _ewma(old: Optional[float], value: float) -> float:
+    return value if old is None else old + LATENCY_EWMA_ALPHA * (value - old)
+
+
+class Lease:
+    """選んだバックエンドへの1リクエスト。finish() で同時実行数を戻し、所要時間と成否を記録する"""
+
+    def __init__(self, pool: "BackendPool", backend: Backend) -> None:
+        self.pool = pool
+        self.backend = backend
+        self.t0 = time.perf_counter()
+        self._done = False
+
+    def first_token(self) -> None:
+        with self.pool._lock:
+            self.backend.ttft_ms = _ewma(self.backend.ttft_ms, (time.perf_counter() - self.t0) * 1000)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        if self._done:
+            return
+        self._done = True
+        elapsed = time.perf_counter() - self.t0
+        b = self.backend
+        with self.pool._lock:
+            b.inflight -= 1
+            if error is None:
+                b.latency_ms = _ewma(b.latency_ms, elapsed * 1000)
+                b.consecutive_failures = 0
+        BACKEND_INFLIGHT.dec(pool=self.pool.name, backend=b.url)
+        if error is None:
+            BACKEND_SECONDS.observe(elapsed, pool=self.pool.name, backend=b.url)
+        elif isinstance(error, UNHEALTHY_ERRORS):
+            self.pool.record_failure(b, error)
+
+
+class BackendPool:
+    """
+    複数の Ollama に生成・埋め込みを振り分ける。
+      - そのモデルを受けるバックエンドのうち、同時実行数 / weight が最小のものを選ぶ（同点はランダム）
+      - 連続失敗が EJECT_AFTER_FAILURES に達したら EJECT_SECONDS だけ候補から外す。
+        全部外れているときは、どれも使わないよりはましなので外れているものからも選ぶ
+      - run_health_checks() で定期的に GET /models を叩き、復帰したものは戻す
+    スレッドからも使う（rag_query の検索はスレッドプールで動く）のでロックで守る。
+    """
+
+    def __init__(self, name: str, backends: Sequence[Dict[str, Any]],
+                 eject_after: int = EJECT_AFTER_FAILURES, eject_seconds: float = EJECT_SECONDS) -> None:
+        self.name = name
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self.backends: List[Backend] = []
+        self.configure(backends)
+
+    def configure(self, backends: Sequence[Dict[str, Any]]) -> None:
+        """バックエンドの一覧を入れ替える（起動時の設定やベンチマーク用）"""
+        parsed = [
+            Backend(url=b["url"].rstrip("/"), weight=float(b.get("weight", 1.0)),
+                    models=tuple(b["models"]) if b.get("models") else None)
+            for b in backends
+        ]
+        if not parsed:
+            raise ValueError(f"backend pool '{self.name}' needs at least one backend")
+        with self._lock:
+            self.backends = parsed
+
+    def candidates(self, model: Optional[str]) -> List[Backend]:
+        return [b for b in self.backends if b.supports(model)]
+
+    def acquire(self, model: Optional[str], exclude: Sequence[Backend] = ()) -> Lease:
+        """model を受けるバックエンドを1つ選び、同時実行数に数えて返す。exclude はなるべく避ける"""
+        now = time.time()
+        with self._lock:
+            cands = self.candidates(model)
+            if not cands:
+                raise NoBackendAvailable(f"no backend in pool '{self.name}' serves model '{model}'")
+            healthy = [b for b in cands if not b.ejected(now)] or cands
+            fresh = [b for b in healthy if b not in exclude] or healthy
+            best = min(b.load() for b in fresh)
+            backend = random.choice([b for b in fresh if b.load() == best])
+            backend.inflight += 1
+            backend.requests += 1
+        BACKEND_INFLIGHT.inc(pool=self.name, backend=backend.url)
+        return Lease(self, backend)
+
+    def attempts(self, model: Optional[str]) -> int:
+        return len(self.candidates(model)) + EXTRA_ATTEMPTS
+
+    def record_failure(self, backend: Backend, error: BaseException) -> None:
+        BACKEND_FAILURES.inc(pool=self.name, backend=backend.url)
+        with self._lock:
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            backend.last_error = f"{type(error).__name__}: {error}"
+            if backend.consecutive_failures >= self.eject_after:
+                if not backend.ejected(time.time()):
+                    backend.ejections += 1
+                backend.ejected_until = time.time() + self.eject_seconds
+
+    def record_healthy(self, backend: Backend) -> None:
+        with self._lock:
+            backend.consecutive_failures = 0
+            backend.ejected_until = 0.0
+
+    # ---- 能動的なヘルスチェック ----
+    async def check(self, http_client: httpx.AsyncClient, timeout: float = HEALTH_CHECK_TIMEOUT) -> None:
+        async def one(b: Backend) -> None:
+            try:
+                res = await http_client.get(f"{b.url}/models", timeout=timeout)
+                res.raise_for_status()
+            except Exception as e:
+                # 接続エラー以外（壊れた URL・想定外の応答など）も落ちているものとして扱う
+                if not isinstance(e, httpx.HTTPError):
+                    print(f"[WARN] ヘルスチェック失敗 {self.name} {b.url}: {type(e).__name__}: {e}")
+                self.record_failure(b, e)
+            else:
+                self.record_healthy(b)
+
+        await asyncio.gather(*[one(b) for b in list(self.backends)])
+
+    async def run_health_checks(self, http_client: httpx.AsyncClient,
+                                interval: float = HEALTH_CHECK_INTERVAL) -> None:
+        while True:
+            try:
+                await self.check(http_client)
+            except Exception as e:
+                # 1回の失敗でチェックのループ自体を止めない
+                print(f"[WARN] ヘルスチェックを実行できません {self.name}: {type(e).__name__}: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            backends = [b.info(now) for b in self.backends]
+        return {"pool": self.name, "backends": backends}
+
+
+generation_pool = BackendPool("generation", GENERATION_BACKENDS)
+embedding_pool = BackendPool("embedding", EMBEDDING_BACKENDS)
+
+
+# ---- OpenAI クライアントと同じ形で呼べるラッパ ----
+class PooledStream:
+    """
+    フェイルオーバーのために先読みした最初のチャンクを先頭に戻したストリーム。
+    async for / async with は AsyncStream と同じ。閉じたときにバックエンドの同時実行数を戻す。
+    """
+
+    def __init__(self, stream, first: Any, lease: Lease) -> None:
+        self._stream = stream
+        self._first = first
+        self._lease = lease
+
+    def __aiter__(self) -> "PooledStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        if self._first is not None:
+            first, self._first = self._first, None
+            return first
+        try:
+            return await self._stream.__anext__()
+        except StopAsyncIteration:
+            self._lease.finish()
+            raise
+        except BaseException as e:
+            self._lease.finish(e)
+            raise
+
+    async def close(self, error: Optional[BaseException] = None) -> None:
+        try:
+            await self._stream.close()
+        finally:
+            self._lease.finish(error)
+
+    async def __aenter__(self) -> "PooledStream":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close(exc)
+
+
+class _PoolClientBase:
+    def __init__(self, generation: Optional[BackendPool] = None, embedding: Optional[BackendPool] = None,
+                 api_key: str = BACKEND_API_KEY) -> None:
+        self.generation = generation or generation_pool
+        self.embedding = embedding or embedding_pool
+        self.api_key = api_key
+        self._clients: Dict[str, Any] = {}
+        self._clients_lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat_create))
+        self.embeddings = SimpleNamespace(create=self._embeddings_create)
+
+    def _new_client(self, url: str):
+        raise NotImplementedError
+
+    def client_for(self, backend: Backend):
+        """バックエンドごとの OpenAI クライアント（再試行はプール側で別のバックエンドに対して行う）"""
+        client = self._clients.get(backend.url)
+        if client is None:
+            with self._clients_lock:
+                client = self._clients.get(backend.url)
+                if client is None:
+                    client = self._clients[backend.url] = self._new_client(backend.url)
+        return client
+
+    def stats(self) -> Dict[str, Any]:
+        return {"generation": self.generation.stats(), "embedding": self.embedding.stats()}
+
+    def _chat_create(self, **kwargs):
+        raise NotImplementedError
+
+    def _embeddings_create(self, **kwargs):
+        raise NotImplementedError
+
+
+class PoolClient(_PoolClientBase):
+    """
+    同期版。client.chat.completions.create / client.embeddings.create を、呼び出しごとにプールから選んだ
+    バックエンドへ送り、接続できない・5xx などなら別のバックエンドで試し直す（rag_query / rag_ingest 用）。
+    stream=True はストリームを返した時点までしか同時実行数に数えない。
+    """
+
+    def _new_client(self, url: str) -> OpenAI:
+        return OpenAI(base_url=url, api_key=self.api_key, max_retries=0)
+
+    def _call(self, pool: BackendPool, model: Optional[str], fn: Callable[[OpenAI], Any]) -> Any:
+        tried: List[Backend] = []
+        attempts = pool.attempts(model)
+        for attempt in range(attempts):
+            lease = pool.acquire(model, exclude=tried)
+            try:
+                result = fn(self.client_for(lease.backend))
+            except RETRYABLE_ERRORS as e:
+                lease.finish(e)
+                tried.append(lease.backend)
+                if attempt + 1 >= attempts:
+                    raise
+                continue
+            except BaseException as e:
+                lease.finish(e)
+                raise
+            lease.finish()
+            return result
+
+    def _chat_create(self, **kwargs):
+        return self._call(self.generation, kwargs.get("model"), lambda c: c.chat.completions.create(**kwargs))
+
+    def _embeddings_create(self, **kwargs):
+        return self._call(self.embedding, kwargs.get("model"), lambda c: c.embeddings.create(**kwargs))
+
+
+class AsyncPoolClient(_PoolClientBase):
+    """
+    非同期版（app.py 用）。stream=True のときは最初のチャンクが届くまでを試し、
+    そこまでに失敗したら別のバックエンドへ切り替える（クライアントにはまだ何も送っていないので安全）。
+    最初のチャンク以降の失敗はそのまま呼び出し側へ投げる。
+    """
+
+    def __init__(self, generation: Optional[BackendPool] = None, embedding: Optional[BackendPool] = None,
+                 api_key: str = BACKEND_API_KEY, http_client: Optional[httpx.AsyncClient] = None) -> None:
+        super().__init__(generation, embedding, api_key)
+        self.http_client = http_client
+
+    def _new_client(self, url: str) -> AsyncOpenAI:
+        return AsyncOpenAI(base_url=url, api_key=self.api_key, http_client=self.http_client, max_retries=0)
+
+    async def _call(self, pool: BackendPool, model: Optional[str], fn, stream: bool = False) -> Any:
+        tried: List[Backend] = []
+        attempts = pool.attempts(model)
+        for attempt in range(attempts):
+            lease = pool.acquire(model, exclude=tried)
+            try:
+                result = await fn(self.client_for(lease.backend))
+                if stream:
+                    try:
+                        first = await result.__anext__()
+                    except StopAsyncIteration:
+                        first = None
+                    except BaseException:
+                        await result.close()
+                        raise
+                    lease.first_token()
+                    return PooledStream(result, first, lease)
+            except RETRYABLE_ERRORS as e:
+                lease.finish(e)
+                tried.append(lease.backend)
+                if attempt + 1 >= attempts:
+                    raise
+                continue
+            except BaseException as e:
+                lease.finish(e)
+                raise
+            lease.finish()
+            return result
+
+    async def _chat_create(self, **kwargs):
+        return await self._call(self.generation, kwargs.get("model"),
+                                lambda c: c.chat.completions.create(**kwargs), stream=bool(kwargs.get("stream")))
+
+    async def _embeddings_create(self, **kwargs):
+        return await self._call(self.embedding, kwargs.get("model"), lambda c: c.embeddings.create(**kwargs))
+
+    async def close(self) -> None:
+        if self.http_client is not None:
+            await self.http_client.aclose()
+        for client in list(self._clients.values()):
+            await client.close()
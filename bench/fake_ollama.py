@@ -0,0 +1,206 @@
+# bench/fake_ollama.py
+"""
+GPU なしでベンチマークを回すための、Ollama（OpenAI互換API）の代役サーバ。
+  - POST /v1/chat/completions … stream / non-stream、tools 指定時は tool_calls も返す
+  - POST /v1/embeddings       … テキストのハッシュから作る決定的な単位ベクトル
+  - GET  /v1/models           … ヘルスチェック用
+遅延（最初のトークンまで・トークン間・埋め込み）は起動オプションで指定する。
+
+    python bench/fake_ollama.py --port 11435 --ttft-ms 300 --token-ms 20 --tokens 200
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeConfig:
+    ttft_ms: float = 200.0           # リクエスト受信から最初のトークンまで（プリフィル相当）
+    token_ms: float = 20.0           # トークン間の間隔
+    tokens: int = 100                # 1回答あたりのトークン数
+    embed_ms: float = 20.0           # 埋め込み1リクエストの固定遅延
+    embed_per_text_ms: float = 0.5   # 埋め込み1テキストあたりの追加遅延
+    dim: int = 768                   # 埋め込みの次元
+    tool_pattern: str = r"天気|weather"   # 最後の user 発話がこれに一致したら tool_calls を返す
+
+
+TOKEN_TEXT = ["これは", "ベンチ", "マーク", "用の", "ダミー", "回答", "です。", "\n"]
+
+
+def _chunk(cid: str, model: str, delta: Dict[str, Any], finish: Optional[str] = None) -> str:
+    body = {
+        "id": cid, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+    }
+    return f"data: {json.dumps(body, ensure_ascii=False)}\n\n"
+
+
+def _wants_tool(body: Dict[str, Any], config: FakeConfig) -> bool:
+    if not body.get("tools") or body.get("tool_choice") == "none":
+        return False
+    messages = body.get("messages") or []
+    if messages and messages[-1].get("role") == "tool":
+        return False   # ツール結果を受け取った2回目は本回答を返す
+    if body.get("tool_choice") == "required":
+        return True
+    last_user = next((m for m in reversed(messages) if m.get("role") == "user"), {})
+    return bool(re.search(config.tool_pattern, last_user.get("content") or ""))
+
+
+def _tool_calls(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """tools の先頭2つを呼ぶ（並列ツール呼び出しの再現）。引数は required を埋めたもの"""
+    calls = []
+    for i, tool in enumerate((body.get("tools") or [])[:2]):
+        fn = tool["function"]
+        props = fn.get("parameters", {}).get("properties", {})
+        args = {}
+        for name in fn.get("parameters", {}).get("required", []):
+            args[name] = 1 if props.get(name, {}).get("type") == "number" else "Tokyo"
+        calls.append({
+            "id": f"call_{i}", "type": "function",
+            "function": {"name": fn["name"], "arguments": json.dumps(args, ensure_ascii=False)},
+        })
+    return calls
+
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+def create_app(config: Optional[FakeConfig] = None) -> FastAPI:
+    config = config or FakeConfig()
+    app = FastAPI(title="fake ollama")
+    app.state.config = config
+    app.state.stats = {"chat": 0, "embeddings": 0, "embedded_texts": 0, "inflight": 0}
+
+    @app.get("/v1/models")
+    def models():
+        return {"object": "list", "data": [{"id": "gpt-oss:20b", "object": "model"}]}
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        app.state.stats["embeddings"] += 1
+        app.state.stats["embedded_texts"] += len(texts)
+        await asyncio.sleep((config.embed_ms + config.embed_per_text_ms * len(texts)) / 1000)
+        return {
+            "object": "list", "model": body.get("model"),
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(t, config.dim)}
+                     for i, t in enumerate(texts)],
+            "usage": {"prompt_tokens": sum(len(t) for t in texts), "total_tokens": sum(len(t) for t in texts)},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        model = body.get("model", "gpt-oss:20b")
+        cid = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        tool = _wants_tool(body, config)
+        prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages") or []) // 2
+        app.state.stats["chat"] += 1
+
+        if not body.get("stream"):
+            app.state.stats["inflight"] += 1
+            try:
+                await asyncio.sleep((config.ttft_ms + config.token_ms * (0 if tool else config.tokens)) / 1000)
+            finally:
+                app.state.stats["inflight"] -= 1
+            message: Dict[str, Any] = {"role": "assistant", "content": None if tool else
+                                       "".join(TOKEN_TEXT[i % len(TOKEN_TEXT)] for i in range(config.tokens))}
+            if tool:
+                message["tool_calls"] = _tool_calls(body)
+            return JSONResponse({
+                "id": cid, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool else "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": config.tokens,
+                          "total_tokens": prompt_tokens + config.tokens},
+            })
+
+        async def stream() -> AsyncIterator[str]:
+            app.state.stats["inflight"] += 1
+            try:
+                await asyncio.sleep(config.ttft_ms / 1000)
+                yield _chunk(cid, model, {"role": "assistant", "content": ""})
+                if tool:
+                    # 引数は数文字ずつに分けて送る（組み立て側の動作確認も兼ねる）
+                    for i, tc in enumerate(_tool_calls(body)):
+                        args = tc["function"]["arguments"]
+                        yield _chunk(cid, model, {"tool_calls": [{
+                            "index": i, "id": tc["id"], "type": "function",
+                            "function": {"name": tc["function"]["name"], "arguments": ""},
+                        }]})
+                        for j in range(0, len(args), 8):
+                            await asyncio.sleep(config.token_ms / 1000)
+                            yield _chunk(cid, model, {"tool_calls": [{
+                                "index": i, "function": {"arguments": args[j:j + 8]},
+                            }]})
+                    n_tokens = 0
+                    yield _chunk(cid, model, {}, "tool_calls")
+                else:
+                    for i in range(config.tokens):
+                        if i:
+                            await asyncio.sleep(config.token_ms / 1000)
+                        yield _chunk(cid, model, {"content": TOKEN_TEXT[i % len(TOKEN_TEXT)]})
+                    n_tokens = config.tokens
+                    yield _chunk(cid, model, {}, "stop")
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": n_tokens,
+                             "total_tokens": prompt_tokens + n_tokens}
+                    yield "data: " + json.dumps({
+                        "id": cid, "object": "chat.completion.chunk", "created": int(time.time()),
+                        "model": model, "choices": [], "usage": usage,
+                    }) + "\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                app.state.stats["inflight"] -= 1
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    def stats():
+        return app.state.stats
+
+    return app
+
+
+def add_config_args(parser: argparse.ArgumentParser) -> None:
+    d = FakeConfig()
+    parser.add_argument("--ttft-ms", type=float, default=d.ttft_ms, help="最初のトークンまでの遅延(ms)")
+    parser.add_argument("--token-ms", type=float, default=d.token_ms, help="トークン間の遅延(ms)")
+    parser.add_argument("--tokens", type=int, default=d.tokens, help="1回答のトークン数")
+    parser.add_argument("--embed-ms", type=float, default=d.embed_ms, help="埋め込み1リクエストの遅延(ms)")
+    parser.add_argument("--embed-per-text-ms", type=float, default=d.embed_per_text_ms,
+                        help="埋め込み1テキストあたりの追加遅延(ms)")
+    parser.add_argument("--dim", type=int, default=d.dim, help="埋め込みの次元")
+
+
+def config_from_args(args: argparse.Namespace) -> FakeConfig:
+    return FakeConfig(
+        ttft_ms=args.ttft_ms, token_ms=args.token_ms, tokens=args.tokens,
+        embed_ms=args.embed_ms, embed_per_text_ms=args.embed_per_text_ms, dim=args.dim,
+    )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Ollama（OpenAI互換API）の代役サーバ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    add_config_args(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
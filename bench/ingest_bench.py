@@ -0,0 +1,126 @@
+# bench/ingest_bench.py
+"""
+合成コーパスで rag_ingest を回し、全件作成・差分なし再実行・一部変更後の再実行の所要時間を測る。
+埋め込みは fake_ollama（プロセス内で起動）に向けるので GPU は不要。作業は一時ディレクトリで行う。
+
+    python bench/ingest_bench.py --docs 500 --paragraphs 20 --embed-ms 30
+"""
+from __future__ import annotations
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from common import rss_mb, serve_in_thread
+from fake_ollama import add_config_args, config_from_args, create_app
+
+WORDS = ["検索", "埋め込み", "モデル", "文書", "チャンク", "応答", "遅延", "キャッシュ", "サーバ", "設定",
+         "ストリーミング", "トークン", "インデックス", "評価", "ツール", "会議", "手順", "結果"]
+
+
+def synthetic_doc(rng: random.Random, n_paragraphs: int) -> str:
+    """見出し・段落・箇条書きを含む日本語っぽい Markdown"""
+    lines = [f"# 文書 {rng.randrange(10**6)}", ""]
+    for p in range(n_paragraphs):
+        if p % 5 == 0:
+            lines += [f"## 節 {p // 5 + 1}", ""]
+        if p % 7 == 3:
+            lines += [f"- {rng.choice(WORDS)}の{rng.choice(WORDS)}を確認する" for _ in range(rng.randint(2, 5))]
+        else:
+            sentences = [
+                "".join(rng.choice(WORDS) + rng.choice(["の", "を", "と", "で"]) for _ in range(rng.randint(3, 8)))
+                + rng.choice(["確認した。", "改善する。", "測定した。", "記録する。"])
+                for _ in range(rng.randint(2, 8))
+            ]
+            lines.append("".join(sentences))
+        lines.append("")
+    return "\n".join(lines)
+
+
+def write_corpus(docs_dir: Path, n_docs: int, n_paragraphs: int, seed: int) -> List[Path]:
+    rng = random.Random(seed)
+    docs_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(n_docs):
+        p = docs_dir / f"doc{i:05d}.md"
+        p.write_text(synthetic_doc(rng, n_paragraphs), encoding="utf-8")
+        paths.append(p)
+    return paths
+
+
+def timed(label: str, fn, fake_stats: Dict[str, int]) -> Dict[str, float]:
+    before = dict(fake_stats)
+    t0 = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - t0
+    texts = fake_stats["embedded_texts"] - before["embedded_texts"]
+    result = {
+        "run": label,
+        "seconds": round(elapsed, 3),
+        "embedded_texts": texts,
+        "embed_requests": fake_stats["embeddings"] - before["embeddings"],
+        "texts_per_sec": round(texts / elapsed, 1) if elapsed else 0.0,
+        "rss_mb": round(rss_mb() or 0.0, 1),
+    }
+    print(f"[BENCH] {label:<10} {result['seconds']:>8.2f}s  embedded={texts:<6} "
+          f"requests={result['embed_requests']:<4} {result['texts_per_sec']:>8.1f} texts/s  rss={result['rss_mb']}MB")
+    return result
+
+
+def main(args: argparse.Namespace) -> None:
+    work = Path(tempfile.mkdtemp(prefix="ingest-bench-"))
+    fake = create_app(config_from_args(args))
+    fake_url, _ = serve_in_thread(fake)
+    try:
+        os.chdir(work)   # rag_ingest は data/ 以下を相対パスで使う
+        paths = write_corpus(work / "data" / "docs", args.docs, args.paragraphs, args.seed)
+        os.makedirs("data/chroma", exist_ok=True)
+        size_mb = sum(p.stat().st_size for p in paths) / 2**20
+        print(f"[INFO] 合成コーパス: {len(paths)}件 {size_mb:.1f}MB → {work}")
+
+        from backend_pool import embedding_pool
+        import rag_ingest
+        embedding_pool.configure([{"url": fake_url + "/v1"}])
+        stats = fake.state.stats
+
+        results = [timed("full", lambda: rag_ingest.main(full=True), stats)]
+        results.append(timed("no-change", lambda: rag_ingest.main(), stats))
+        rng = random.Random(args.seed + 1)
+        for p in rng.sample(paths, max(1, len(paths) * args.modify_pct // 100)):
+            with p.open("a", encoding="utf-8") as f:
+                f.write("\n追記された段落です。差分インデックスの確認用。\n")
+        results.append(timed(f"modify{args.modify_pct}%", lambda: rag_ingest.main(), stats))
+        if args.exports:
+            results.append(timed("exports", lambda: rag_ingest.main(numpy_index=True, lexical_index=True), stats))
+
+        index_mb = sum(f.stat().st_size for f in (work / "data").rglob("*") if f.is_file()
+                       and "docs" not in f.parts) / 2**20
+        print(f"[INFO] インデックス等のサイズ: {index_mb:.1f}MB")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"docs": args.docs, "paragraphs": args.paragraphs, "corpus_mb": round(size_mb, 2),
+                           "index_mb": round(index_mb, 2), "results": results}, f, indent=2)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="rag_ingest のベンチマーク（合成コーパス）")
+    parser.add_argument("--docs", type=int, default=200, help="文書数")
+    parser.add_argument("--paragraphs", type=int, default=20, help="1文書あたりの段落数")
+    parser.add_argument("--modify-pct", type=int, default=10, help="2回目の差分実行で書き換える文書の割合(%)")
+    parser.add_argument("--exports", action="store_true", help="NumPy/文字n-gramインデックスの書き出しも測る")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="作業ディレクトリを消さずに残す")
+    parser.add_argument("--json", help="結果を書き出すファイル")
+    add_config_args(parser)
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    main(args)
@@ -0,0 +1,190 @@
+# bench/load.py
+"""
+app.app に同時実行数を変えながら負荷をかけ、TTFT・全体レイテンシ（p50/p95/p99）・RPS・メモリを測る。
+
+既定では、このプロセスの中で fake_ollama と app.app を uvicorn で起動して測る（GPU 不要）:
+    python bench/load.py --endpoint chat --concurrency 1 4 16 --requests 200
+起動済みのサーバを測る場合（メモリはクライアント側の値になる）:
+    python bench/load.py --url http://127.0.0.1:8000 --endpoint rag_stream
+結果を JSON で保存して前回と比べる:
+    python bench/load.py --json bench_result.json
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from common import percentile, rss_mb, serve_in_thread
+from fake_ollama import add_config_args, config_from_args, create_app
+
+CHAT_PROMPTS = ["自己紹介して", "SSE とは何？", "RAG の構成を説明して", "要約して"]
+TOOL_PROMPT = "東京の天気を教えて"
+RAG_QUERIES = ["RAGの全体構成", "埋め込みモデルは？", "チャンク分割の方法", "SSEの仕組み"]
+
+
+@dataclass
+class Sample:
+    ok: bool
+    ttft: float
+    total: float
+    status: int
+
+
+@dataclass
+class LevelResult:
+    concurrency: int
+    requests: int
+    errors: int
+    rps: float
+    ttft_p50_ms: float
+    ttft_p95_ms: float
+    ttft_p99_ms: float
+    total_p50_ms: float
+    total_p95_ms: float
+    total_p99_ms: float
+    rss_mb: Optional[float]
+
+
+def payload(endpoint: str, i: int, tool_every: int, unique: bool) -> Dict[str, Any]:
+    if endpoint == "chat":
+        text = TOOL_PROMPT if tool_every and i % tool_every == 0 else CHAT_PROMPTS[i % len(CHAT_PROMPTS)]
+        return {"messages": [{"role": "user", "content": f"{text} #{i}" if unique else text}]}
+    query = RAG_QUERIES[i % len(RAG_QUERIES)]
+    return {"query": f"{query} #{i}" if unique else query, "top_k": 4}
+
+
+async def one_request(client: httpx.AsyncClient, path: str, body: Dict[str, Any]) -> Sample:
+    t0 = time.perf_counter()
+    ttft = None
+    try:
+        async with client.stream("POST", path, json=body) as res:
+            if res.status_code != 200:
+                await res.aread()
+                return Sample(False, 0.0, time.perf_counter() - t0, res.status_code)
+            event = None
+            async for line in res.aiter_lines():
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif not line:
+                    event = None
+                elif line.startswith("data:") and event is None and ttft is None and line[5:].strip() != "[DONE]":
+                    ttft = time.perf_counter() - t0   # 制御イベント（queue / sources など）は除いた最初のトークン
+        total = time.perf_counter() - t0
+        return Sample(True, ttft if ttft is not None else total, total, 200)
+    except httpx.HTTPError:
+        return Sample(False, 0.0, time.perf_counter() - t0, 0)
+
+
+async def run_level(base_url: str, endpoint: str, concurrency: int, n_requests: int,
+                    tool_every: int, unique: bool) -> LevelResult:
+    path = {"chat": "/chat", "rag_stream": "/rag/stream"}[endpoint]
+    counter = iter(range(n_requests))
+    samples: List[Sample] = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=httpx.Timeout(300.0)) as client:
+        async def worker() -> None:
+            for i in counter:
+                samples.append(await one_request(client, path, payload(endpoint, i, tool_every, unique)))
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        wall = time.perf_counter() - t0
+
+    ok = [s for s in samples if s.ok]
+    ttft = sorted(s.ttft * 1000 for s in ok)
+    total = sorted(s.total * 1000 for s in ok)
+    mem = rss_mb()
+    return LevelResult(
+        concurrency=concurrency,
+        requests=len(samples),
+        errors=len(samples) - len(ok),
+        rps=round(len(ok) / wall, 2) if wall else 0.0,
+        ttft_p50_ms=round(percentile(ttft, 50), 1),
+        ttft_p95_ms=round(percentile(ttft, 95), 1),
+        ttft_p99_ms=round(percentile(ttft, 99), 1),
+        total_p50_ms=round(percentile(total, 50), 1),
+        total_p95_ms=round(percentile(total, 95), 1),
+        total_p99_ms=round(percentile(total, 99), 1),
+        rss_mb=round(mem, 1) if mem is not None else None,
+    )
+
+
+def start_in_process(args: argparse.Namespace) -> str:
+    """fake_ollama（--fake-backends 台）と app.app をこのプロセス内で起動し、app のURLを返す"""
+    from backend_pool import embedding_pool, generation_pool
+
+    if args.backend:
+        backends = [{"url": url} for url in args.backend]
+    else:
+        backends = [{"url": serve_in_thread(create_app(config_from_args(args)))[0] + "/v1"}
+                    for _ in range(args.fake_backends)]
+    # 生成・埋め込みの向き先を代役サーバへ差し替える（app と rag_query は同じプールを使う）
+    generation_pool.configure(backends)
+    embedding_pool.configure(backends)
+
+    import app as app_module
+    url, _ = serve_in_thread(app_module.app)
+    return url
+
+
+def print_backends(base_url: str) -> None:
+    try:
+        stats = httpx.get(f"{base_url}/backends/stats", timeout=10).json()
+    except (httpx.HTTPError, ValueError):
+        return
+    for pool in ("generation", "embedding"):
+        for b in stats.get(pool, {}).get("backends", []):
+            print(f"[{pool}] {b['url']}: requests={b['requests']} failures={b['failures']} "
+                  f"latency_ms={b['latency_ms']} ttft_ms={b['ttft_ms']}")
+
+
+def print_table(endpoint: str, results: List[LevelResult]) -> None:
+    print(f"\n[{endpoint}]")
+    print(f"{'conc':>5} {'reqs':>5} {'err':>4} {'rps':>8} "
+          f"{'ttft p50':>9} {'p95':>8} {'p99':>8} {'total p50':>10} {'p95':>8} {'p99':>8} {'rss MB':>8}")
+    for r in results:
+        print(f"{r.concurrency:>5} {r.requests:>5} {r.errors:>4} {r.rps:>8.2f} "
+              f"{r.ttft_p50_ms:>9.1f} {r.ttft_p95_ms:>8.1f} {r.ttft_p99_ms:>8.1f} "
+              f"{r.total_p50_ms:>10.1f} {r.total_p95_ms:>8.1f} {r.total_p99_ms:>8.1f} "
+              f"{r.rss_mb if r.rss_mb is not None else '-':>8}")
+
+
+async def main(args: argparse.Namespace) -> None:
+    url = args.url or start_in_process(args)
+    results = []
+    # 1回目は接続やキャッシュの立ち上がりを含むので捨てる
+    await run_level(url, args.endpoint, 1, args.warmup, args.tool_every, args.unique)
+    for c in args.concurrency:
+        results.append(await run_level(url, args.endpoint, c, args.requests, args.tool_every, args.unique))
+    print_table(args.endpoint, results)
+    print_backends(url)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"endpoint": args.endpoint, "url": args.url, "results": [asdict(r) for r in results]}, f,
+                      indent=2)
+        print(f"\n[INFO] 結果を書き出しました: {args.json}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="/chat・/rag/stream の負荷試験")
+    parser.add_argument("--endpoint", choices=["chat", "rag_stream"], default="chat")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=100, help="同時実行数ごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--tool-every", type=int, default=4, help="chat で N 件に1件ツール呼び出しを含める（0 で無し）")
+    parser.add_argument("--unique", action="store_true", help="毎回違う質問にする（キャッシュを効かせない）")
+    parser.add_argument("--url", help="起動済みの app のURL（省略時はこのプロセス内で起動）")
+    parser.add_argument("--backend", nargs="+", help="生成/埋め込みの向き先（複数可。省略時は fake_ollama を内部で起動）")
+    parser.add_argument("--fake-backends", type=int, default=1, help="内部で起動する fake_ollama の台数")
+    parser.add_argument("--workdir", default=".", help="app を起動するディレクトリ（data/ の場所）")
+    parser.add_argument("--json", help="結果を書き出すファイル")
+    add_config_args(parser)
+    args = parser.parse_args()
+    os.chdir(args.workdir)
+    asyncio.run(main(args))
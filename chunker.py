@@ -0,0 +1,141 @@
+# chunker.py
+from __future__ import annotations
+import re
+from dataclasses import dataclass
+from typing import Iterator, List, Tuple
+
+CHUNK_TARGET_CHARS = 800   # これを超えない範囲で段落・文をまとめる
+CHUNK_MIN_CHARS = 200      # これより短いチャンクは見出しをまたいでも次とまとめる
+
+_HEADING = re.compile(r"^(#{1,6})[ \t]+(.+?)[ \t#]*$")
+_LIST_ITEM = re.compile(r"^[ \t]*(?:[-*+]|\d+[.)])[ \t]+")
+_FENCE = re.compile(r"^[ \t]*(```|~~~)")
+# 「。」「！」「？」（閉じ括弧が続けばそこまで）、英文の . ! ? は後ろに空白があるときだけ文末とみなす
+_SENTENCE_END = re.compile(r"[。！？]+[」』）】]*|[.!?]+(?=\s)")
+
+
+@dataclass(frozen=True)
+class Chunk:
+    """元テキスト上の範囲 [start, end) と、そのチャンクが属する見出しの階層"""
+    start: int
+    end: int
+    heading: str = ""
+
+    def text(self, source: str) -> str:
+        return source[self.start:self.end]
+
+
+def _trim(text: str, start: int, end: int) -> Tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _blocks(text: str) -> Iterator[Tuple[int, int, int, str]]:
+    """
+    行を走査して (start, end, 見出しレベル, 見出し文字列) を返す。
+    見出し行はレベル 1〜6、段落・リスト項目・コードブロックはレベル 0。
+    """
+    pos = 0
+    para_start = None
+    para_end = 0
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        start, end = pos, pos + len(line)
+        pos = end
+        body = line.rstrip("\r\n")
+        if _FENCE.match(body):
+            # コードブロックは途中で切らない（中の # も見出しとみなさない）
+            if not in_fence and para_start is not None:
+                yield para_start, para_end, 0, ""
+                para_start = None
+            if para_start is None:
+                para_start = start
+            para_end = end
+            in_fence = not in_fence
+            if not in_fence:
+                yield para_start, para_end, 0, ""
+                para_start = None
+            continue
+        if in_fence:
+            para_end = end
+            continue
+        m = _HEADING.match(body)
+        if m or not body.strip() or _LIST_ITEM.match(body):
+            if para_start is not None:
+                yield para_start, para_end, 0, ""
+                para_start = None
+        if m:
+            yield start, end, len(m.group(1)), m.group(2).strip()
+            continue
+        if not body.strip():
+            continue
+        if para_start is None:
+            para_start = start
+        para_end = end
+    if para_start is not None:
+        yield para_start, para_end, 0, ""
+
+
+def _split_long(text: str, start: int, end: int, max_chars: int) -> Iterator[Tuple[int, int]]:
+    """max_chars を超える段落を文単位に、それでも長い文は max_chars ごとに切る"""
+    if end - start <= max_chars:
+        yield start, end
+        return
+    cut = start
+    for m in _SENTENCE_END.finditer(text, start, end):
+        s, e = _trim(text, cut, m.end())
+        cut = m.end()
+        if s < e:
+            yield from _split_long(text, s, e, max_chars) if e - s > max_chars else [(s, e)]
+    s, e = _trim(text, cut, end)
+    while e - s > max_chars:
+        yield s, s + max_chars
+        s = s + max_chars
+    if s < e:
+        yield s, e
+
+
+def split_chunks(text: str, target_chars: int = CHUNK_TARGET_CHARS,
+                 min_chars: int = CHUNK_MIN_CHARS) -> List[Chunk]:
+    """
+    見出し・段落・文の境目で区切り、target_chars 以内になるようにまとめる。
+      - Markdown の見出しでは（直前のチャンクが min_chars 未満でなければ）必ず新しいチャンクを始める
+      - 段落が長すぎるときだけ文（。や . の後）で切る。文も長すぎれば文字数で切る
+      - テキストはコピーせず、元テキスト上の (start, end) と見出しの階層だけを返す
+    """
+    chunks: List[Chunk] = []
+    path: List[Tuple[int, str]] = []       # [(レベル, 見出し), ...]
+    cur_start = cur_end = -1
+    cur_heading = ""
+
+    def flush() -> None:
+        nonlocal cur_start, cur_end
+        if cur_start >= 0:
+            chunks.append(Chunk(cur_start, cur_end, cur_heading))
+        cur_start = cur_end = -1
+
+    for b_start, b_end, level, title in _blocks(text):
+        b_start, b_end = _trim(text, b_start, b_end)
+        if b_start >= b_end:
+            continue
+        if level:
+            if cur_start >= 0 and cur_end - cur_start >= min_chars:
+                flush()
+            while path and path[-1][0] >= level:
+                path.pop()
+            path.append((level, title))
+            pieces = [(b_start, b_end)]
+        else:
+            pieces = list(_split_long(text, b_start, b_end, target_chars))
+        for s, e in pieces:
+            if cur_start >= 0 and e - cur_start > target_chars:
+                flush()
+            if cur_start < 0:
+                cur_start = s
+                cur_heading = " > ".join(t for _, t in path)
+            cur_end = e
+    flush()
+    return chunks
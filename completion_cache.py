@@ -0,0 +1,157 @@
+# completion_cache.py
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+COMPLETION_CACHE_MAX_BYTES = 64 * 2**20        # メモリに置く応答の合計（JSONのバイト数）
+COMPLETION_CACHE_TTL = 3600.0                  # 秒（ツールを使った回答は、そのツールの cache_ttl のうち最短に縮める）
+COMPLETION_CACHE_DISK_PATH: Optional[str] = None   # 例: "data/completion_cache.sqlite3"（None ならメモリだけ）
+COMPLETION_CACHE_DISK_MAX_ENTRIES = 100_000
+
+
+def completion_key(model: str, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]],
+                   tool_choice: Optional[str], temperature: float) -> str:
+    """
+    リクエストの正規形の sha256。
+    値が None のフィールドは落とし、キー順・空白の違いは json.dumps(sort_keys) で吸収する。
+    """
+    canonical = {
+        "model": model,
+        "messages": [{k: v for k, v in m.items() if v is not None} for m in messages],
+        "tools": tools or None,
+        "tool_choice": tool_choice,
+        "temperature": float(temperature),
+    }
+    blob = json.dumps(canonical, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    /chat の応答（流したテキストと、途中の assistant / tool メッセージ）を覚えておくキャッシュ。
+      - メモリ層は合計バイト数で上限を決める LRU（スレッドセーフ）
+      - disk_path を指定すると SQLite の2層目を持つ。メモリで外れたらディスクを引き、当たればメモリへ戻す
+      - ttl 秒（put で個別に指定したらその秒数）を過ぎたエントリは読み出し時に捨てる
+    値は JSON 文字列で持つので、get のたびに新しい dict が返る（呼び出し側で書き換えてよい）。
+    """
+
+    def __init__(self, max_bytes: int = COMPLETION_CACHE_MAX_BYTES, ttl: Optional[float] = COMPLETION_CACHE_TTL,
+                 disk_path: Optional[str] = COMPLETION_CACHE_DISK_PATH,
+                 disk_max_entries: int = COMPLETION_CACHE_DISK_MAX_ENTRIES) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_max_entries = disk_max_entries
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._data: "OrderedDict[str, Tuple[str, int, Optional[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_count = 0
+        if disk_path:
+            if os.path.dirname(disk_path):
+                os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL, last_used REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS completions_last_used ON completions(last_used)")
+            self._disk_count = self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    # ---- メモリ層 ----
+    def _remember(self, key: str, blob: str, expires: Optional[float]) -> None:
+        size = len(blob.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._data[key] = (blob, size, expires)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, dropped, _) = self._data.popitem(last=False)
+            self._bytes -= dropped
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                blob, _, expires = item
+                if expires is None or expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return json.loads(blob)
+                self._bytes -= self._data.pop(key)[1]
+            if self._db is not None:
+                row = self._db.execute("SELECT value, expires FROM completions WHERE key=?", (key,)).fetchone()
+                if row is not None and (row[1] is None or row[1] > now):
+                    self._db.execute("UPDATE completions SET last_used=? WHERE key=?", (now, key))
+                    self._remember(key, row[0], row[1])
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+            self.misses += 1
+            return None
+
+    def put(self, key: str, entry: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        """ttl を渡すとこのエントリだけ寿命を変える（None なら self.ttl）"""
+        blob = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        now = time.time()
+        ttl = self.ttl if ttl is None else ttl
+        expires = now + ttl if ttl else None
+        with self._lock:
+            self._remember(key, blob, expires)
+            if self._db is not None:
+                exists = self._db.execute("SELECT 1 FROM completions WHERE key=?", (key,)).fetchone()
+                self._db.execute(
+                    "INSERT OR REPLACE INTO completions(key, value, expires, last_used) VALUES (?, ?, ?, ?)",
+                    (key, blob, expires, now),
+                )
+                self._disk_count += 0 if exists else 1
+                if self._disk_count > self.disk_max_entries:
+                    self._evict_disk(now)
+
+    def _evict_disk(self, now: float) -> None:
+        # 期限切れを消し、それでも多ければ上限の9割まで last_used の古いものから捨てる
+        self._db.execute("DELETE FROM completions WHERE expires IS NOT NULL AND expires <= ?", (now,))
+        count = self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+        target = int(self.disk_max_entries * 0.9)
+        if count > target:
+            self._db.execute(
+                "DELETE FROM completions WHERE key IN (SELECT key FROM completions ORDER BY last_used LIMIT ?)",
+                (count - target,),
+            )
+        self._disk_count = self._db.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM completions")
+                self._disk_count = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "disk_entries": self._disk_count if self._db is not None else None,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,172 @@
+# context_packer.py
+from __future__ import annotations
+import re
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+BLOCK_SEP = "\n\n---\n\n"
+
+# CJK（かな・漢字・全角記号）はおおむね1文字1トークン、それ以外は4文字1トークン程度として見積もる
+_CJK = re.compile(r"[　-ヿ㐀-䶿一-鿿豈-﫿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """トークナイザを使わない概算のトークン数"""
+    n_cjk = len(_CJK.findall(text))
+    return n_cjk + (len(text) - n_cjk + 3) // 4
+
+
+@dataclass
+class PackedContext:
+    text: str
+    stats: Dict[str, int] = field(default_factory=dict)
+
+
+def _merge_text(a: str, b: str, max_overlap: int) -> str:
+    """a の末尾と b の先頭が重なっていれば、重なりを1回だけにしてつなぐ"""
+    for k in range(min(max_overlap, len(a), len(b)), 0, -1):
+        if a.endswith(b[:k]):
+            return a + b[k:]
+    return a + " " + b
+
+
+def _join(a: Dict[str, Any], b: Dict[str, Any], max_overlap: int) -> Dict[str, Any]:
+    """
+    同じファイルの前後のブロック a, b をつなぐ。
+    メタデータに元テキスト上の位置（start, end）があれば、それで重なりを正確に取り除く。
+    """
+    if a["end"] is not None and b["start"] is not None:
+        if b["start"] < a["end"]:
+            text = a["text"] + b["text"][a["end"] - b["start"]:]
+        else:
+            text = a["text"] + "\n\n" + b["text"]
+        end = max(a["end"], b["end"])
+    else:
+        text, end = _merge_text(a["text"], b["text"], max_overlap), None
+    return {"text": text, "start": a["start"], "end": end}
+
+
+def mmr_select(embeddings: np.ndarray, relevance: np.ndarray, lam: float = 0.7,
+               dup_threshold: float = 0.95) -> List[int]:
+    """
+    MMR（Maximal Marginal Relevance）で並べ替えつつ、ほぼ同じ内容のものを落とす。
+    embeddings は (n, dim)。類似度行列は1回の行列積でまとめて計算する。
+    返り値は採用した行番号（採用順）。
+    """
+    n = len(embeddings)
+    if n == 0:
+        return []
+    e = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    sim = e @ e.T
+    selected: List[int] = []
+    candidates = np.ones(n, dtype=bool)
+    max_sim = np.full(n, -np.inf, dtype=np.float32)
+    while candidates.any():
+        redundancy = np.where(np.isfinite(max_sim), max_sim, 0.0)
+        mmr = lam * relevance - (1.0 - lam) * redundancy
+        mmr[~candidates] = -np.inf
+        i = int(np.argmax(mmr))
+        selected.append(i)
+        candidates[i] = False
+        max_sim = np.maximum(max_sim, sim[i])
+        # 既に採用したものとほぼ同じなら候補から外す
+        candidates &= max_sim < dup_threshold
+    return selected
+
+
+def pack_context(
+    hits: Sequence[Dict[str, Any]],
+    token_budget: int = 3000,
+    max_overlap: int = 200,
+    mmr_lambda: float = 0.7,
+    dup_threshold: float = 0.95,
+) -> PackedContext:
+    """
+    検索結果をプロンプト用のコンテキストに詰める。
+      1) 同じファイルの隣接チャンク（chunk 番号が連続）をつなぎ、重なり部分を1回にする
+         （メタデータに start/end があれば位置で、なければ文字列の一致で重なりを探す）
+      2) 埋め込みがあれば MMR で並べ替え、ほぼ重複のブロックを落とす
+      3) 関連度の高い順に token_budget まで詰める（溢れたブロックは途中で切る）
+    stats には、素朴に全部つないだ場合と比べて何トークン減ったかを入れる。
+    """
+    hits = list(hits)
+    raw_tokens = estimate_tokens(BLOCK_SEP.join(
+        f"[source={(h['meta'] or {}).get('source')} chunk={(h['meta'] or {}).get('chunk')}]\n{h['doc'] or ''}"
+        for h in hits
+    ))
+
+    # 1) 同じファイルの連続チャンクをまとめる（検索順で最初に出てきた位置を代表にする）
+    spans: List[Dict[str, Any]] = []
+    by_source: Dict[Any, List[Dict[str, Any]]] = {}
+    for h in hits:
+        meta = h["meta"] or {}
+        src = meta.get("source")
+        ch = meta.get("chunk")
+        piece = {"text": h["doc"] or "", "start": meta.get("start"), "end": meta.get("end")}
+        target = None
+        if isinstance(ch, int):
+            for span in by_source.get(src, []):
+                if span["first"] - 1 <= ch <= span["last"] + 1:
+                    target = span
+                    break
+        if target is None:
+            span = {"source": src, "first": ch, "last": ch, "heading": meta.get("heading"),
+                    "embs": [h.get("embedding")], **piece}
+            spans.append(span)
+            by_source.setdefault(src, []).append(span)
+            continue
+        if ch == target["last"] + 1:
+            target.update(_join(target, piece, max_overlap))
+            target["last"] = ch
+        elif ch == target["first"] - 1:
+            target.update(_join(piece, target, max_overlap))
+            target["first"] = ch
+            target["heading"] = meta.get("heading")
+        target["embs"].append(h.get("embedding"))
+    n_merged = len(hits) - len(spans)
+
+    # 2) MMR＋重複除去（埋め込みが揃っているときだけ。ブロックの埋め込みは構成チャンクの平均）
+    n_spans = len(spans)
+    if spans and all(e is not None for span in spans for e in span["embs"]):
+        emb = np.stack([np.mean(np.asarray(span["embs"], dtype=np.float32), axis=0) for span in spans])
+        relevance = 1.0 - np.arange(n_spans, dtype=np.float32) / n_spans   # 検索順位を関連度とみなす
+        spans = [spans[i] for i in mmr_select(emb, relevance, mmr_lambda, dup_threshold)]
+    dropped = n_spans - len(spans)
+
+    # 3) トークン予算まで詰める
+    blocks: List[str] = []
+    used = 0
+    truncated = 0
+    sep_tokens = estimate_tokens(BLOCK_SEP)
+    for span in spans:
+        label = span["first"] if span["first"] == span["last"] else f"{span['first']}-{span['last']}"
+        section = f" section={span['heading']}" if span.get("heading") else ""
+        block = f"[source={span['source']} chunk={label}{section}]\n{span['text']}"
+        cost = estimate_tokens(block) + (sep_tokens if blocks else 0)
+        if used + cost > token_budget:
+            remaining = token_budget - used - (sep_tokens if blocks else 0)
+            if remaining >= 64:
+                # 予算に収まるところまで文字数を削る（CJKなら1文字≒1トークン）
+                while block and estimate_tokens(block) > remaining:
+                    block = block[: max(1, int(len(block) * remaining / estimate_tokens(block)) - 1)]
+                blocks.append(block)
+                used += estimate_tokens(block) + (sep_tokens if len(blocks) > 1 else 0)
+            truncated += 1
+            break
+        blocks.append(block)
+        used += cost
+    text = BLOCK_SEP.join(blocks)
+    packed_tokens = estimate_tokens(text)
+    return PackedContext(text=text, stats={
+        "hits": len(hits),
+        "blocks": len(blocks),
+        "dropped_duplicates": dropped,
+        "merged_chunks": n_merged,
+        "truncated": truncated,
+        "tokens_raw": raw_tokens,
+        "tokens_packed": packed_tokens,
+        "tokens_saved": max(0, raw_tokens - packed_tokens),
+        "token_budget": token_budget,
+    })
@@ -0,0 +1,184 @@
+# doc_loader.py
+from __future__ import annotations
+import multiprocessing
+import os
+import signal
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+DOC_SUFFIXES = (".txt", ".md", ".pdf")
+TEXT_SUFFIXES = (".txt", ".md")
+
+PDF_WORKERS = os.cpu_count() or 1   # PDF抽出に使うプロセス数
+PDF_TIMEOUT = 120.0                 # 1ファイルあたりの抽出の締め切り（秒）
+
+
+def iter_doc_paths(doc_dir: str) -> Iterator[Path]:
+    """対象拡張子のファイルを（順序を固定して）1つずつ返す"""
+    for p in sorted(Path(doc_dir).rglob("*")):
+        if p.is_file() and p.suffix.lower() in DOC_SUFFIXES:
+            yield p
+
+
+def read_text_file(p: Path) -> str:
+    return p.read_text(encoding="utf-8", errors="ignore")
+
+
+def extract_pdf_text(path: str) -> str:
+    """PDFからテキストを抜き出す（ワーカープロセス側で動く）"""
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def _report_pid(pids) -> None:
+    """ワーカーの initializer。親が固まったワーカーを止められるよう、自分の PID を知らせる"""
+    pids.put(os.getpid())
+
+
+class PdfExtractor:
+    """
+    PDF抽出を ProcessPoolExecutor で並列に行う（CPUバウンドなので全コアを使う）。
+      - 同時に投げるのはワーカー数まで（メモリを一定に保つ）
+      - 締め切りを過ぎたファイルは諦めて None を返す。固まったワーカーは
+        プールごと止めて作り直し、巻き添えになった他のファイルは投げ直す
+      - ワーカーが落ちた（pypdf の segfault や OOM で BrokenProcessPool）ときもプールを作り直す。
+        どのファイルが原因かは分からないので、そのとき実行中だったものを1つずつ単独で投げ直し、
+        単独でも落ちたファイルだけを None にする
+    """
+
+    def __init__(self, workers: int = PDF_WORKERS, timeout: float = PDF_TIMEOUT) -> None:
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pids = None    # ワーカーが起動時に PID を入れるキュー（プールごとに作り直す）
+        self._workers: Set[int] = set()
+        self._futs: Dict[Future, Tuple[Path, float, bool]] = {}   # future -> (path, 締め切り, 単独実行か)
+        self._suspects: Deque[Path] = deque()   # ワーカーが落ちたときに実行中だった（単独で投げ直す）ファイル
+        self._ready: Deque[Tuple[Path, Optional[str]]] = deque()
+
+    @property
+    def full(self) -> bool:
+        # 切り分け中（単独実行・その待ち）は新しいファイルを投げない
+        solo = any(s for _, _, s in self._futs.values())
+        return len(self._futs) >= self.workers or solo or bool(self._suspects)
+
+    def __len__(self) -> int:
+        return len(self._futs) + len(self._ready) + len(self._suspects)
+
+    def submit(self, p: Path, solo: bool = False) -> None:
+        if self._pool is None:
+            ctx = multiprocessing.get_context()
+            self._pids = ctx.SimpleQueue()
+            self._workers = set()
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                             initializer=_report_pid, initargs=(self._pids,))
+        try:
+            fut = self._pool.submit(extract_pdf_text, str(p))
+        except BrokenProcessPool:
+            # 前のファイルでワーカーが落ちていた。作り直してから投げる
+            self._recover([])
+            return self.submit(p, solo)
+        self._futs[fut] = (p, time.monotonic() + self.timeout, solo)
+
+    def _recover(self, broken: List[Tuple[Path, bool]]) -> None:
+        """プールが壊れた。実行中だったファイルは切り分けのため単独で投げ直し、単独でも落ちたものは諦める"""
+        affected = broken + [(p, solo) for p, _, solo in self._futs.values()]
+        self._futs.clear()
+        self._restart()
+        for p, solo in affected:
+            if solo:
+                print(f"[WARN] PDF抽出中にワーカーが異常終了 {p}")
+                self._ready.append((p, None))
+            else:
+                self._suspects.append(p)
+
+    def _restart(self) -> None:
+        # ProcessPoolExecutor には個別ワーカーを止める手段がないので、プールを閉じてワーカーを全部落とす。
+        # ワーカーは initializer で PID を知らせてくるので、内部属性（_processes）には触らない
+        pool, self._pool = self._pool, None
+        if pool is None:
+            return
+        pool.shutdown(wait=False, cancel_futures=True)
+        while not self._pids.empty():
+            self._workers.add(self._pids.get())
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)   # Windows では TerminateProcess になる
+            except OSError:
+                pass   # すでに終わっている
+        self._pids.close()
+        self._pids, self._workers = None, set()
+
+    def next_done(self) -> Tuple[Path, Optional[str]]:
+        """次に終わった（または締め切りを過ぎた）ファイルの (path, text|None) を返す"""
+        while not self._ready:
+            if not self._futs:
+                self.submit(self._suspects.popleft(), solo=True)
+            earliest = min(deadline for _, deadline, _ in self._futs.values())
+            done, _ = wait(self._futs, timeout=max(0.0, earliest - time.monotonic()),
+                           return_when=FIRST_COMPLETED)
+            broken: List[Tuple[Path, bool]] = []
+            for fut in done:
+                p, _, solo = self._futs.pop(fut)
+                try:
+                    self._ready.append((p, fut.result()))
+                except BrokenProcessPool:
+                    broken.append((p, solo))
+                except Exception as e:
+                    print(f"[WARN] PDF読取失敗 {p}: {e}")
+                    self._ready.append((p, None))
+            if broken:
+                self._recover(broken)
+            if done:
+                continue
+
+            now = time.monotonic()
+            expired = [p for p, deadline, _ in self._futs.values() if deadline <= now]
+            survivors = [(p, solo) for p, deadline, solo in self._futs.values() if deadline > now]
+            self._futs.clear()
+            self._restart()
+            for p in expired:
+                print(f"[WARN] PDF読取タイムアウト（{self.timeout}s）{p}")
+                self._ready.append((p, None))
+            # 巻き添えで止めたファイルは捨てずに投げ直す（締め切りも新しくする）
+            for p, solo in survivors:
+                self.submit(p, solo)
+        return self._ready.popleft()
+
+    def close(self) -> None:
+        if self._futs:
+            self._restart()
+        elif self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            self._pids.close()
+            self._pids = None
+        self._futs.clear()
+        self._suspects.clear()
+
+
+def iter_documents(paths: Iterable[Path], pdf_workers: int = PDF_WORKERS,
+                   pdf_timeout: float = PDF_TIMEOUT) -> Iterator[Tuple[Path, Optional[str]]]:
+    """
+    (path, text) を遅延で返すジェネレータ。読めなかったファイルは text=None。
+    テキストファイルはその場で読み、PDFはプロセスプールに回して終わった順に返す。
+    一度にメモリに載るのは、読み終えた1ファイルと抽出中のPDF（ワーカー数ぶん）だけ。
+    """
+    extractor = PdfExtractor(pdf_workers, pdf_timeout)
+    try:
+        for p in paths:
+            if p.suffix.lower() in TEXT_SUFFIXES:
+                yield p, read_text_file(p)
+            elif p.suffix.lower() == ".pdf":
+                while extractor.full:
+                    yield extractor.next_done()
+                extractor.submit(p)
+        while len(extractor):
+            yield extractor.next_done()
+    finally:
+        extractor.close()
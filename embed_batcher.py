@@ -0,0 +1,188 @@
+# embed_batcher.py
+from __future__ import annotations
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeout
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+
+_Item = Tuple[int, int, List[str], Future, float]
+
+
+def _settle(fut: Future, result: Optional[List[List[float]]] = None,
+            exc: Optional[BaseException] = None) -> None:
+    """結果を渡す。待ちきれずに諦めた（cancel 済みの）呼び出し元の Future は飛ばす"""
+    try:
+        if exc is not None:
+            fut.set_exception(exc)
+        else:
+            fut.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class EmbedMicroBatcher:
+    """
+    同時に来た埋め込みリクエストを1回の embeddings.create にまとめる。
+      - 最初の1件が来てから window_ms だけ待ち、その間に来たものを1バッチにする
+      - テキスト数が max_batch に達したら待たずに送る（1回の送信は max_batch 件まで。多い依頼は分けて並べる）
+      - priority の小さいものから送る。/rag/batch のような大口の依頼があっても、対話の埋め込みは先に出る
+    呼び出し側は embed() を呼ぶだけで、自分のぶんのベクトルだけが返ってくる。
+    送信は専用のバックグラウンドスレッド1本で行う。
+    呼び出し側は timeout 秒までしか待たない。スレッドが落ちていたら待っている間に起こし直す。
+    """
+
+    def __init__(self, embed_fn: Callable[[List[str]], List[List[float]]],
+                 window_ms: float = 5.0, max_batch: int = 64, latency_samples: int = 2048,
+                 timeout: float = 60.0) -> None:
+        self.embed_fn = embed_fn
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self.timeout = timeout
+        # (priority, 到着順, texts, fut, t0)。同じ priority の中は到着順
+        self._queue: "queue.PriorityQueue[_Item]" = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies: Deque[float] = deque(maxlen=latency_samples)
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self.restarts = 0
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            with self._start_lock:
+                if self._thread is None or not self._thread.is_alive():
+                    if self._thread is not None:
+                        self.restarts += 1
+                    self._thread = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                    self._thread.start()
+
+    def submit(self, texts: List[str], priority: int = 0) -> Future:
+        self._ensure_thread()
+        texts = list(texts)
+        t0 = time.perf_counter()
+        fut: Future = Future()
+        if len(texts) <= self.max_batch:
+            self._queue.put((priority, next(self._seq), texts, fut, t0))
+            return fut
+        # max_batch ずつに分けて並べ、全部そろったら1つの結果にまとめる。
+        # 分けたぶんの間に、後から来た優先度の高い依頼が割り込める
+        parts: List[Future] = []
+        for i in range(0, len(texts), self.max_batch):
+            part: Future = Future()
+            parts.append(part)
+            self._queue.put((priority, next(self._seq), texts[i:i + self.max_batch], part, t0))
+
+        def _gather(_: Future) -> None:
+            if not all(p.done() for p in parts):
+                return
+            for p in parts:
+                if p.cancelled():
+                    _settle(fut, exc=RuntimeError("embedding cancelled"))
+                    return
+                if p.exception() is not None:
+                    _settle(fut, exc=p.exception())
+                    return
+            _settle(fut, [v for p in parts for v in p.result()])
+
+        def _cancel_parts(f: Future) -> None:
+            if f.cancelled():
+                for p in parts:
+                    p.cancel()
+
+        for part in parts:
+            part.add_done_callback(_gather)
+        fut.add_done_callback(_cancel_parts)
+        return fut
+
+    def embed(self, texts: List[str], priority: int = 0) -> List[List[float]]:
+        fut = self.submit(texts, priority)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                return fut.result(timeout=max(0.0, min(1.0, remaining)))
+            except FutureTimeout:
+                if remaining <= 1.0:
+                    fut.cancel()
+                    raise TimeoutError(f"embedding did not finish within {self.timeout}s")
+                # 送信スレッドが落ちていたら起こし直す（行列に残っているぶんは新しいスレッドが拾う）
+                self._ensure_thread()
+
+    def _collect(self) -> List[Tuple[List[str], Future, float]]:
+        first = self._queue.get()
+        batch = [first[2:]]
+        n_texts = len(first[2])
+        deadline = time.perf_counter() + self.window_ms / 1000.0
+        while n_texts < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if n_texts + len(item[2]) > self.max_batch:
+                # 入りきらないものは順番を保ったまま戻して次の送信に回す
+                self._queue.put(item)
+                break
+            batch.append(item[2:])
+            n_texts += len(item[2])
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            try:
+                self._send(batch)
+            except BaseException as e:
+                # 想定外の失敗でもこのバッチの呼び出し元は待たせない。スレッドが終わる場合は次の embed() で起こし直す
+                for _, fut, _ in batch:
+                    _settle(fut, exc=e if isinstance(e, Exception) else RuntimeError("embed batcher stopped"))
+                if not isinstance(e, Exception):
+                    raise
+
+    def _send(self, batch: List[Tuple[List[str], Future, float]]) -> None:
+        texts = [t for item_texts, _, _ in batch for t in item_texts]
+        vectors = self.embed_fn(texts)
+        if len(vectors) != len(texts):
+            raise ValueError(f"embedding count mismatch: {len(vectors)} != {len(texts)}")
+        # まとめて得たベクトルを、リクエストごとに切り分けて返す
+        done = time.perf_counter()
+        pos = 0
+        with self._stats_lock:
+            self.batches += 1
+            self.requests += len(batch)
+            self.texts += len(texts)
+            for item_texts, fut, t0 in batch:
+                self._latencies.append((done - t0) * 1000)
+        for item_texts, fut, _ in batch:
+            _settle(fut, vectors[pos:pos + len(item_texts)])
+            pos += len(item_texts)
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            lat = sorted(self._latencies)
+            return {
+                "window_ms": self.window_ms,
+                "max_batch": self.max_batch,
+                "requests": self.requests,
+                "batches": self.batches,
+                "restarts": self.restarts,
+                "avg_batch_size": round(self.texts / self.batches, 2) if self.batches else 0.0,
+                "latency_ms_avg": round(sum(lat) / len(lat), 3) if lat else 0.0,
+                "latency_ms_p50": round(_percentile(lat, 50), 3),
+                "latency_ms_p95": round(_percentile(lat, 95), 3),
+                "latency_ms_p99": round(_percentile(lat, 99), 3),
+            }
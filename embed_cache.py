@@ -0,0 +1,142 @@
+# embed_cache.py
+from __future__ import annotations
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from typing import Callable, Dict, List, Optional, Sequence
+
+EMBED_CACHE_PATH = "data/embed_cache.sqlite3"
+EMBED_CACHE_MAX_ENTRIES = 1_000_000   # これを超えたら最後に使われたのが古いものから捨てる
+_SQL_BATCH = 500                      # IN (...) に一度に渡すキー数（SQLiteの変数上限対策）
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    内容アドレス方式の埋め込みキャッシュ（SQLite・float32で保存）。
+      - キーは (埋め込みモデル名, sha256(テキスト))。同じテキストはファイルが違っても1回しか埋め込まない
+      - get_many でまとめて引き、ミスしたものだけを埋め込みサーバへ送る
+      - 件数が max_entries を超えたら last_used の古いものから捨てる
+    rag_ingest（インデックス作成）と rag_query（問い合わせ）の両方から使う。
+    """
+
+    def __init__(self, path: str = EMBED_CACHE_PATH, max_entries: int = EMBED_CACHE_MAX_ENTRIES) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, key TEXT NOT NULL, vec BLOB NOT NULL, last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, key)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self._count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, keys: Sequence[str]) -> Dict[str, List[float]]:
+        """keys のうちキャッシュにあるものを {key: vector} で返す"""
+        found: Dict[str, List[float]] = {}
+        uniq = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(uniq), _SQL_BATCH):
+                part = uniq[i:i+_SQL_BATCH]
+                marks = ",".join("?" * len(part))
+                rows = self._db.execute(
+                    f"SELECT key, vec FROM embeddings WHERE model=? AND key IN ({marks})", [model, *part]
+                ).fetchall()
+                for key, blob in rows:
+                    vec = array("f")
+                    vec.frombytes(blob)
+                    found[key] = vec.tolist()
+                if rows:
+                    hit_keys = [key for key, _ in rows]
+                    self._db.execute(
+                        f"UPDATE embeddings SET last_used=? WHERE model=? AND key IN ({','.join('?' * len(hit_keys))})",
+                        [now, model, *hit_keys],
+                    )
+        return found
+
+    def put_many(self, model: str, items: Dict[str, Sequence[float]]) -> None:
+        now = time.time()
+        rows = [(model, key, array("f", vec).tobytes(), now) for key, vec in items.items()]
+        with self._lock:
+            cur = self._db.executemany(
+                "INSERT OR IGNORE INTO embeddings(model, key, vec, last_used) VALUES (?, ?, ?, ?)", rows
+            )
+            self._count += max(0, cur.rowcount)
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self) -> None:
+        # 毎回1件ずつ消すと書き込みが増えるので、上限の9割まで一気に減らす
+        target = int(self.max_entries * 0.9)
+        self._db.execute(
+            "DELETE FROM embeddings WHERE (model, key) IN "
+            "(SELECT model, key FROM embeddings ORDER BY last_used LIMIT ?)",
+            (self._count - target,),
+        )
+        self._count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def embed(self, model: str, texts: Sequence[str],
+              embed_fn: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        """
+        texts の埋め込みを返す。キャッシュにあるものはそのまま使い、
+        ミスしたテキストだけ（重複を除いて）embed_fn にまとめて渡す。
+        """
+        keys = [text_key(t) for t in texts]
+        found = self.get_many(model, keys)
+        missing: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        n_miss = sum(1 for key in keys if key not in found)
+        with self._lock:
+            self.hits += len(keys) - n_miss
+            self.misses += n_miss
+        if missing:
+            vectors = embed_fn(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.put_many(model, fresh)
+            found.update(fresh)
+        return [found[key] for key in keys]
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "entries": self._count,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+_default: Optional[EmbeddingCache] = None
+_default_lock = threading.Lock()
+
+
+def default_cache() -> EmbeddingCache:
+    """プロセス内で共有するキャッシュ（初回呼び出し時に開く）"""
+    global _default
+    if _default is None:
+        with _default_lock:
+            if _default is None:
+                _default = EmbeddingCache()
+    return _default
@@ -0,0 +1,127 @@
+# embed_pipeline.py
+from __future__ import annotations
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Type
+
+# 1件 = (id, metadata, 本文)
+Item = Tuple[str, Dict[str, Any], str]
+
+
+class AdaptiveBatchSize:
+    """
+    埋め込みサーバの応答時間を見てバッチサイズを調整する（AIMD）。
+      - 応答が target_latency の半分未満なら minimum ずつ増やす
+      - target_latency を超えたら半分にする
+    """
+
+    def __init__(self, initial: int = 64, minimum: int = 8, maximum: int = 512,
+                 target_latency: float = 2.0) -> None:
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+
+    def update(self, latency: float) -> None:
+        if latency > self.target_latency:
+            self.size = max(self.minimum, self.size // 2)
+        elif latency < self.target_latency / 2:
+            self.size = min(self.maximum, self.size + self.minimum)
+
+
+@dataclass
+class PipelineStats:
+    items: int = 0
+    batches: int = 0
+    retries: int = 0
+    embed_seconds: float = 0.0
+    batch_sizes: List[int] = field(default_factory=list)
+
+
+class EmbedPipeline:
+    """
+    埋め込み → 書き込みのパイプライン。
+      - 埋め込みリクエストは最大 max_inflight 本まで同時に投げる（サーバを遊ばせない）
+      - バッチサイズは AdaptiveBatchSize で応答時間に合わせて変える
+      - 終わったバッチから順に write_fn で書き込む（全件をメモリに溜めない）
+      - 一時的な失敗は指数バックオフ＋ジッタで再試行する
+    メモリに載るのは「同時に投げているバッチ + 組み立て中の1バッチ」だけ。
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str]], List[List[float]]],
+        write_fn: Callable[[List[Item], List[List[float]]], None],
+        max_inflight: int = 4,
+        batch_size: Optional[AdaptiveBatchSize] = None,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        retry_on: Tuple[Type[BaseException], ...] = (Exception,),
+    ) -> None:
+        self.embed_fn = embed_fn
+        self.write_fn = write_fn
+        self.max_inflight = max_inflight
+        self.batch_size = batch_size or AdaptiveBatchSize()
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_on = retry_on
+        self.stats = PipelineStats()
+
+    def _embed_with_retry(self, texts: List[str]) -> Tuple[List[List[float]], float]:
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            try:
+                return self.embed_fn(texts), time.perf_counter() - t0
+            except self.retry_on as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                self.stats.retries += 1
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+                delay *= 0.5 + random.random() / 2
+                print(f"[WARN] embed失敗（{attempt}/{self.max_retries}回目, {delay:.1f}s後に再試行）: {e}")
+                time.sleep(delay)
+
+    def _write(self, batch: Sequence[Item], fut: Future, total_hint: Optional[int]) -> None:
+        embeddings, latency = fut.result()
+        self.batch_size.update(latency)
+        self.write_fn(list(batch), embeddings)
+        self.stats.items += len(batch)
+        self.stats.batches += 1
+        self.stats.embed_seconds += latency
+        self.stats.batch_sizes.append(len(batch))
+        total = f"/{total_hint}" if total_hint else ""
+        print(f"[INFO] embedded {self.stats.items}{total} (batch={len(batch)}, {latency:.2f}s)")
+
+    def run(self, items: Iterable[Item], total_hint: Optional[int] = None) -> PipelineStats:
+        inflight: Dict[Future, List[Item]] = {}
+        with ThreadPoolExecutor(max_workers=self.max_inflight, thread_name_prefix="embed") as ex:
+
+            def drain(block_until_free: bool) -> None:
+                # 上限に達していれば1本終わるまで待ち、終わったものから書き込む
+                if not inflight:
+                    return
+                timeout = None if block_until_free else 0
+                done, _ = wait(inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    self._write(inflight.pop(fut), fut, total_hint)
+
+            batch: List[Item] = []
+            for item in items:
+                batch.append(item)
+                if len(batch) < self.batch_size.size:
+                    continue
+                drain(block_until_free=len(inflight) >= self.max_inflight)
+                inflight[ex.submit(self._embed_with_retry, [t for _, _, t in batch])] = batch
+                batch = []
+            if batch:
+                drain(block_until_free=len(inflight) >= self.max_inflight)
+                inflight[ex.submit(self._embed_with_retry, [t for _, _, t in batch])] = batch
+            while inflight:
+                drain(block_until_free=True)
+        return self.stats
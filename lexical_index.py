@@ -0,0 +1,185 @@
+# lexical_index.py
+from __future__ import annotations
+import json
+import os
+import re
+import shutil
+import unicodedata
+from array import array
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+from vector_index import JsonlSidecar, JsonlSidecarWriter, replace_dir
+
+LEXICAL_INDEX_DIR = "data/lexical_index"
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# ディレクトリ構成（meta 以外はすべて np.load(mmap_mode="r") で開ける配列）:
+#   terms.npy       … n-gram の整数コード（昇順, uint64）
+#   term_ptr.npy    … terms[i] のポスティングは postings[term_ptr[i]:term_ptr[i+1]]
+#   post_docs.npy   … ポスティングの文書番号（uint32）
+#   post_tf.npy     … ポスティングの出現回数（uint16）
+#   doc_len.npy     … 文書ごとの n-gram 数（uint32）
+#   meta.jsonl / offsets.npy … 文書番号 → {"id", "meta", "doc"}
+#   index.json      … 件数・平均文書長・参照している全文の版（text_versions）
+
+# 文字コードは最大 0x10FFFF（21bit）なので、3文字までなら 63bit に詰めて衝突なしで表せる。
+# bigram は3文字目に「あり得ない文字コード」を入れて trigram と区別する。
+_BIGRAM_MARK = 0x1FFFFF
+
+
+def normalize_text(text: str) -> str:
+    # 全角英数→半角・大文字→小文字・連続空白→1つ
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text).lower()).strip()
+
+
+def ngram_codes(text: str) -> List[int]:
+    """正規化したテキストの文字 bigram / trigram を整数コードで返す"""
+    cps = [ord(c) for c in normalize_text(text)]
+    codes = []
+    for i in range(len(cps) - 1):
+        a, b = cps[i], cps[i + 1]
+        codes.append((a << 42) | (b << 21) | _BIGRAM_MARK)
+        if i + 2 < len(cps):
+            codes.append((a << 42) | (b << 21) | cps[i + 2])
+    return codes
+
+
+class LexicalIndexWriter:
+    """
+    文字 n-gram の転置インデックスを作る。
+    文書ごとの (term, doc, tf) を array に積んでおき、commit() でまとめて整列して配列に書き出す。
+    """
+
+    def __init__(self, out_dir: str, n: int) -> None:
+        self.out_dir = out_dir
+        self.tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self.n = n
+        self._terms = array("Q")
+        self._docs = array("I")
+        self._tfs = array("H")
+        self._doc_len = array("I")
+        self._meta = JsonlSidecarWriter(self.tmp_dir, n)
+        self._text_versions: Set[Tuple[str, str]] = set()   # 行が参照する全文の (source, text_sha)
+
+    def add(self, ids: Sequence[str], metadatas: Sequence[Dict], documents: Sequence[Optional[str]],
+            texts: Optional[Sequence[Optional[str]]] = None) -> None:
+        """
+        texts: 索引づけに使う本文（省略時は documents）。documents が空（位置情報だけ）のコレクション用
+        """
+        texts = documents if texts is None else texts
+        for id_, meta, doc, text in zip(ids, metadatas, documents, texts):
+            docno = len(self._doc_len)
+            counts = Counter(ngram_codes(text or ""))
+            for code, tf in counts.items():
+                self._terms.append(code)
+                self._docs.append(docno)
+                self._tfs.append(min(tf, 0xFFFF))
+            self._doc_len.append(sum(counts.values()))
+            self._meta.add({"id": id_, "meta": meta, "doc": doc})
+            if meta and meta.get("text_sha"):
+                self._text_versions.add((meta["source"], meta["text_sha"]))
+
+    def commit(self) -> None:
+        if len(self._doc_len) != self.n:
+            raise ValueError(f"件数が合いません: {len(self._doc_len)} != {self.n}")
+        terms = np.frombuffer(self._terms, dtype=np.uint64)
+        docs = np.frombuffer(self._docs, dtype=np.uint32)
+        tfs = np.frombuffer(self._tfs, dtype=np.uint16)
+        order = np.lexsort((docs, terms))
+        terms, docs, tfs = terms[order], docs[order], tfs[order]
+        uniq, starts = np.unique(terms, return_index=True)
+        term_ptr = np.append(starts, len(terms)).astype(np.int64)
+        doc_len = np.frombuffer(self._doc_len, dtype=np.uint32)
+
+        np.save(os.path.join(self.tmp_dir, "terms.npy"), uniq)
+        np.save(os.path.join(self.tmp_dir, "term_ptr.npy"), term_ptr)
+        np.save(os.path.join(self.tmp_dir, "post_docs.npy"), docs)
+        np.save(os.path.join(self.tmp_dir, "post_tf.npy"), tfs)
+        np.save(os.path.join(self.tmp_dir, "doc_len.npy"), doc_len)
+        self._meta.close()
+        with open(os.path.join(self.tmp_dir, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "count": self.n,
+                "terms": int(len(uniq)),
+                "avg_doc_len": float(doc_len.mean()) if self.n else 0.0,
+                "text_versions": sorted(self._text_versions),
+            }, f)
+        replace_dir(self.tmp_dir, self.out_dir)
+
+
+class LexicalIndex:
+    """
+    文字 bigram/trigram の転置インデックスに対する BM25 検索。
+    埋め込みを呼ばないので、ID・日付・モデル名のような完全一致寄りの検索が1ミリ秒未満で返る。
+    """
+
+    def __init__(self, index_dir: str = LEXICAL_INDEX_DIR) -> None:
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "index.json"), encoding="utf-8") as f:
+            self.info = json.load(f)
+
+        def load(name: str) -> np.ndarray:
+            # np.memmap のままだとスライスのたびにサブクラスの後処理が走るので、素の ndarray ビューにする
+            return np.asarray(np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode="r"))
+
+        self.terms = load("terms")
+        self.term_ptr = load("term_ptr")
+        self.post_docs = load("post_docs")
+        self.post_tf = load("post_tf")
+        self.doc_len = load("doc_len")
+        self.meta = JsonlSidecar(index_dir)
+        self.avg_doc_len = self.info["avg_doc_len"] or 1.0
+
+    def __len__(self) -> int:
+        return int(self.info["count"])
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return self.meta[i]
+
+    def search(self, query: str, top_k: int = 4) -> List[Tuple[int, float]]:
+        """[(文書番号, BM25スコア), ...] をスコアの高い順で返す"""
+        n = len(self)
+        codes = np.unique(np.array(ngram_codes(query), dtype=np.uint64))
+        if n == 0 or len(codes) == 0:
+            return []
+        pos = np.searchsorted(self.terms, codes)
+        valid = pos < len(self.terms)
+        pos = pos[valid][self.terms[pos[valid]] == codes[valid]]   # 索引にある n-gram だけ残す
+        if len(pos) == 0:
+            return []
+
+        # 該当 n-gram のポスティングをまとめて取り出し、BM25 の寄与を一度に計算して文書ごとに足し込む
+        starts, ends = self.term_ptr[pos], self.term_ptr[pos + 1]
+        df = (ends - starts).astype(np.float32)
+        idf = np.log1p((n - df + 0.5) / (df + 0.5))
+        docs = np.concatenate([self.post_docs[s:e] for s, e in zip(starts, ends)])
+        tf = np.concatenate([self.post_tf[s:e] for s, e in zip(starts, ends)]).astype(np.float32)
+        norm = BM25_K1 * (1.0 - BM25_B + BM25_B * self.doc_len[docs] / self.avg_doc_len)
+        contrib = np.repeat(idf, ends - starts) * tf * (BM25_K1 + 1.0) / (tf + norm)
+        scores = np.bincount(docs, weights=contrib, minlength=n)
+
+        hit = np.flatnonzero(scores)
+        if len(hit) == 0:
+            return []
+        k = min(top_k, len(hit))
+        top = hit[np.argpartition(-scores[hit], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(d), float(scores[d])) for d in top]
+
+    def close(self) -> None:
+        self.meta.close()
+
+
+def reciprocal_rank_fusion(rankings: Iterable[Sequence[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """複数の順位リスト（id の列）を RRF で1つにまとめる。score = Σ 1/(k + 順位)"""
+    fused: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, start=1):
+            fused[id_] = fused.get(id_, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda kv: kv[1], reverse=True)
@@ -0,0 +1,276 @@
+# metrics.py
+from __future__ import annotations
+import asyncio
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 秒単位のバケット（Prometheus の既定値を、LLM の応答時間向けに長い方へ伸ばしたもの）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TPS_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+LabelKey = Tuple[str, ...]
+
+
+def _labels(names: Sequence[str], key: LabelKey, extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labelnames)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return super().render() + [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels: str) -> Iterator[None]:
+        """with の間だけ +1（同時実行数の計測用）"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[LabelKey, List[int]] = {}
+        self._sums: Dict[LabelKey, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            items = sorted((k, list(c), self._sums[k]) for k, c in self._counts.items())
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                cumulative += c
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_num(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_num(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+
+def render_metrics() -> str:
+    """Prometheus のテキスト形式（text/plain; version=0.0.4）"""
+    return "\n".join(line for m in REGISTRY for line in m.render()) + "\n"
+
+
+# ---- 計測項目 ----
+TTFT_SECONDS = Histogram("gptoss_ttft_seconds", "Time from request start to the first streamed token", ["endpoint"])
+TOKENS_PER_SECOND = Histogram("gptoss_tokens_per_second", "Generation speed of streamed answers", ["endpoint"],
+                              buckets=TPS_BUCKETS)
+PHASE_SECONDS = Histogram("gptoss_phase_seconds", "Duration of each request phase", ["endpoint", "phase"])
+TOOL_SECONDS = Histogram("gptoss_tool_seconds", "Tool execution latency", ["tool"])
+EMBED_SECONDS = Histogram("gptoss_embed_seconds", "Query embedding latency (including the embedding cache)")
+SEARCH_SECONDS = Histogram("gptoss_vector_search_seconds", "Retriever search latency", ["backend"])
+INFLIGHT_STREAMS = Gauge("gptoss_inflight_streams", "SSE streams currently open", ["endpoint"])
+STREAMS_TOTAL = Counter("gptoss_streams_total", "SSE streams started", ["endpoint"])
+STREAMS_CANCELLED = Counter("gptoss_streams_cancelled_total",
+                            "SSE streams stopped early because the client went away", ["endpoint", "stage"])
+BACKEND_INFLIGHT = Gauge("gptoss_backend_inflight", "Requests in flight per upstream backend", ["pool", "backend"])
+BACKEND_SECONDS = Histogram("gptoss_backend_request_seconds", "Successful upstream request duration per backend",
+                            ["pool", "backend"])
+BACKEND_FAILURES = Counter("gptoss_backend_failures_total", "Upstream failures counted toward ejection",
+                           ["pool", "backend"])
+COMPONENT_READY = Gauge("gptoss_component_ready", "1 once the component finished its startup warmup", ["component"])
+WARMUP_SECONDS = Histogram("gptoss_warmup_seconds", "Startup warmup duration per component", ["component"])
+
+
+# ---- リクエスト単位の区間計測 ----
+class Timings:
+    """
+    1リクエスト内の区間（ms）を記録する。Server-Timing ヘッダや SSE の debug 出力に使う。
+    同じ名前の区間が複数回あれば足し合わせる。
+    """
+
+    def __init__(self, endpoint: str) -> None:
+        self.endpoint = endpoint
+        self.t0 = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.interrupted: Optional[str] = None   # キャンセル（クライアント切断）されたときに実行中だった区間
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.spans[name] = self.spans.get(name, 0.0) + seconds * 1000
+        PHASE_SECONDS.observe(seconds, endpoint=self.endpoint, phase=name)
+
+    def mark(self, name: str) -> float:
+        """リクエスト開始からの経過時間を name として記録する（TTFT など）"""
+        elapsed = time.perf_counter() - self.t0
+        with self._lock:
+            self.spans.setdefault(name, elapsed * 1000)
+        return elapsed
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.t0) * 1000
+
+    def server_timing(self) -> str:
+        with self._lock:
+            items = list(self.spans.items())
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in items)
+
+    def as_dict(self) -> Dict[str, float]:
+        with self._lock:
+            spans = {name: round(ms, 1) for name, ms in self.spans.items()}
+        return {**spans, "total": round(self.elapsed_ms(), 1)}
+
+
+_current: contextvars.ContextVar[Optional[Timings]] = contextvars.ContextVar("timings", default=None)
+
+
+def start_timings(endpoint: str) -> Timings:
+    """このリクエストの Timings を作り、以降の span() の記録先にする（スレッドプールにも引き継がれる）"""
+    timings = Timings(endpoint)
+    _current.set(timings)
+    return timings
+
+
+def current_timings() -> Optional[Timings]:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, histogram: Optional[Histogram] = None, timings: Optional[Timings] = None,
+         **labels: str) -> Iterator[None]:
+    """
+    区間を計って、現在のリクエストの Timings と（指定があれば）ヒストグラムに記録する。
+    途中でキャンセルされた場合は、いちばん内側の区間名を Timings.interrupted に残す。
+    """
+    t0 = time.perf_counter()
+    try:
+        yield
+    except (asyncio.CancelledError, GeneratorExit):
+        timings = timings or _current.get()
+        if timings is not None and timings.interrupted is None:
+            timings.interrupted = name
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        timings = timings or _current.get()
+        if timings is not None:
+            timings.add(name, elapsed)
+        if histogram is not None:
+            histogram.observe(elapsed, **labels)
+
+
+class GenerationMeter:
+    """
+    ストリーミング生成1回ぶんの計測。最初のトークンで TTFT を、終わりに tokens/sec を記録する。
+    トークン数は usage（stream_options.include_usage）があればそれを、なければデルタの数を使う。
+    """
+
+    def __init__(self, endpoint: str, timings: Optional[Timings] = None) -> None:
+        self.endpoint = endpoint
+        self.timings = timings
+        self.t_first: Optional[float] = None
+        self.deltas = 0
+        self.completion_tokens: Optional[int] = None
+
+    def token(self) -> None:
+        self.deltas += 1
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+            if self.timings is not None and "ttft" not in self.timings.spans:
+                TTFT_SECONDS.observe(self.timings.mark("ttft"), endpoint=self.endpoint)
+
+    def usage(self, usage) -> None:
+        # 最初のトークンより前のラウンド（ツール呼び出しだけのラウンド）の usage は速度に含めない
+        if self.t_first is not None and usage is not None and getattr(usage, "completion_tokens", None):
+            self.completion_tokens = (self.completion_tokens or 0) + usage.completion_tokens
+
+    def finish(self) -> None:
+        if self.t_first is None:
+            return
+        elapsed = time.perf_counter() - self.t_first
+        tokens = self.completion_tokens or self.deltas
+        if elapsed > 0 and tokens > 1:
+            TOKENS_PER_SECOND.observe(tokens / elapsed, endpoint=self.endpoint)
+
+
+class ServerTimingMiddleware:
+    """
+    リクエストごとに Timings を用意し、レスポンスヘッダに Server-Timing を付ける ASGI ミドルウェア。
+    ヘッダはボディより先に送るので、SSE ではその時点までの区間しか載らない
+    （全区間はリクエストの debug=true で最後の SSE イベントに出す）。
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timings = start_timings(scope.get("path", ""))
+
+        async def send_with_timing(message) -> None:
+            if message["type"] == "http.response.start":
+                value = ", ".join(filter(None, [timings.server_timing(), f"app;dur={timings.elapsed_ms():.1f}"]))
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", value.encode())]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
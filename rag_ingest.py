@@ -1,91 +1,370 @@
 # rag_ingest.py
 from __future__ import annotations
-import os, re, json
+import os, json, hashlib, argparse, time
 from pathlib import Path
-from typing import List, Dict
-from openai import OpenAI
+from typing import List, Dict, Iterator, Optional, Set, Tuple
+from openai import APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
 import chromadb
 from chromadb.utils import embedding_functions
 
+from backend_pool import PoolClient
+from chunker import CHUNK_MIN_CHARS, CHUNK_TARGET_CHARS, Chunk, split_chunks
+from doc_loader import (
+    PDF_TIMEOUT, PDF_WORKERS, TEXT_SUFFIXES,
+    extract_pdf_text, iter_doc_paths, iter_documents, read_text_file,
+)
+from embed_cache import default_cache
+from embed_pipeline import AdaptiveBatchSize, EmbedPipeline, Item
+from lexical_index import LEXICAL_INDEX_DIR, LexicalIndexWriter
+from source_texts import SOURCE_TEXT_DIR, SourceTextStore
+from vector_index import NUMPY_INDEX_DIR, NumpyIndexWriter
+
 # ---- 設定 ----
-OLLAMA_BASE_URL = "http://localhost:11434/v1"
 EMBED_MODEL = "nomic-embed-text"   # ローカル埋め込み
 CHROMA_DIR = "data/chroma"
 DOCS_DIR = "data/docs"
 COLLECTION = "local_corpus"
+MANIFEST_PATH = os.path.join(CHROMA_DIR, "ingest_manifest.json")  # 差分インデックス用の台帳
+CORPUS_VERSION_PATH = os.path.join(CHROMA_DIR, "corpus_version")   # 中身が変わるたびに更新（検索キャッシュの無効化用）
+MANIFEST_FORMAT = 2   # チャンクの形式（分割方法・メタデータ）を変えたら上げる。台帳と違えば全件作り直す
+
+# ---- 埋め込みパイプライン ----
+EMBED_MAX_INFLIGHT = 4        # 同時に投げる埋め込みリクエスト数
+EMBED_BATCH = 64              # 初期バッチサイズ（応答時間を見て増減する）
+EMBED_BATCH_MIN = 8
+EMBED_BATCH_MAX = 512
+EMBED_TARGET_LATENCY = 2.0    # 1バッチあたりの目標応答時間（秒）
+
+# 埋め込みの送り先は backend_pool の EMBEDDING_BACKENDS（複数あれば同時実行数の少ないものへ振り分ける）
+client = PoolClient()
 
-client = OpenAI(base_url=OLLAMA_BASE_URL, api_key="ollama")
+def read_document(p: Path) -> Optional[str]:
+    """1ファイル分のテキストを返す。読めなければ None"""
+    if p.suffix.lower() in TEXT_SUFFIXES:
+        return read_text_file(p)
+    if p.suffix.lower() == ".pdf":
+        try:
+            return extract_pdf_text(str(p))
+        except Exception as e:
+            print(f"[WARN] PDF読取失敗 {p}: {e}")
+    return None
 
 def load_texts(doc_dir: str) -> List[Dict]:
-    texts = []
-    for p in Path(doc_dir).rglob("*"):
-        if p.suffix.lower() in [".txt", ".md"]:
-            texts.append({"path": str(p), "text": p.read_text(encoding="utf-8", errors="ignore")})
-        elif p.suffix.lower() == ".pdf":
-            try:
-                from pypdf import PdfReader
-                reader = PdfReader(str(p))
-                content = "\n".join([page.extract_text() or "" for page in reader.pages])
-                texts.append({"path": str(p), "text": content})
-            except Exception as e:
-                print(f"[WARN] PDF読取失敗 {p}: {e}")
-    return texts
-
-def chunk_text(text: str, max_chars: int = 800, overlap: int = 100) -> List[str]:
-    text = re.sub(r"\s+", " ", text).strip()
-    chunks = []
-    i = 0
-    while i < len(text):
-        chunk = text[i:i+max_chars]
-        chunks.append(chunk)
-        i += max(1, max_chars - overlap)
-    return chunks
+    """全文書をリストで返す（小さいコーパス向け。インデックス作成は iter_documents で遅延読み込みする）"""
+    return [
+        {"path": str(p), "text": text}
+        for p, text in iter_documents(iter_doc_paths(doc_dir))
+        if text is not None
+    ]
 
-def embed_batch(strings: List[str]) -> List[List[float]]:
-    # OpenAI互換 Embeddings API をOllamaに向ける
+def iter_chunks(text: str, target_chars: int = CHUNK_TARGET_CHARS, min_chars: int = CHUNK_MIN_CHARS) -> Iterator[str]:
+    for c in split_chunks(text, target_chars, min_chars):
+        yield c.text(text)
+
+def chunk_text(text: str, target_chars: int = CHUNK_TARGET_CHARS, min_chars: int = CHUNK_MIN_CHARS) -> List[str]:
+    """見出し・段落・文の境目で区切ったチャンクの本文（位置情報が要るときは chunker.split_chunks）"""
+    return list(iter_chunks(text, target_chars, min_chars))
+
+def chunk_meta(path: str, idx: int, c: Chunk, text_sha: str) -> Dict:
+    # 本文は持たず、全文（SourceTextStore）のどの版のどの位置かと、見出しの階層だけを持つ
+    return {"source": path, "chunk": idx, "text_sha": text_sha, "start": c.start, "end": c.end, "heading": c.heading}
+
+def chunk_hash(meta: Dict, text: str) -> str:
+    # 位置も含めてハッシュする（前の方が変わって位置がずれたチャンクは書き直す。埋め込みはキャッシュが効く）
+    key = json.dumps(meta, ensure_ascii=False, sort_keys=True) + "\n" + text
+    return sha256_hex(key.encode("utf-8"))
+
+def _embed_remote(strings: List[str]) -> List[List[float]]:
+    # OpenAI互換 Embeddings API をOllamaに向ける（バックエンドはプールから選ぶ）
     res = client.embeddings.create(model=EMBED_MODEL, input=strings)
     # res.data は順序対応のベクトル群
     return [item.embedding for item in res.data]
 
-def main():
+def embed_batch(strings: List[str]) -> List[List[float]]:
+    # 埋め込みキャッシュにないテキストだけをサーバへ送る
+    return default_cache().embed(EMBED_MODEL, strings, _embed_remote)
+
+def sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+# ---- 差分インデックス用の台帳 ----
+# { "format": MANIFEST_FORMAT, "files": { path: { "sha256": ファイル内容のハッシュ, "text_sha": 全文の版, "chunks": [チャンクごとのハッシュ, ...] } } }
+def load_manifest(path: str = MANIFEST_PATH) -> Dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"files": {}}
+
+def save_manifest(manifest: Dict, path: str = MANIFEST_PATH) -> None:
+    # 途中で落ちても壊れた台帳が残らないよう、一時ファイルに書いてから置き換える
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+def bump_corpus_version(path: str = CORPUS_VERSION_PATH) -> str:
+    """コレクションを書き換えたら呼ぶ。rag_query はこの値が変わると検索キャッシュを捨てる"""
+    version = f"{time.time_ns()}-{os.getpid()}"
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp, path)
+    return version
+
+def export_numpy_index(coll, out_dir: str = NUMPY_INDEX_DIR, dtype: str = "float32", page: int = 1000) -> int:
+    """
+    Chroma のコレクションを NumpyIndex 形式（mmap行列＋メタデータ）に書き出す。
+    ページ単位で読んで memmap に直接書くので、全件をメモリに載せない。
+    本文は（Chroma と同じく）位置情報だけを持ち、検索時に SourceTextStore から切り出す。
+    """
+    n = coll.count()
+    writer = None
+    for offset in range(0, n, page):
+        res = coll.get(limit=page, offset=offset, include=["embeddings", "metadatas", "documents"])
+        if writer is None:
+            writer = NumpyIndexWriter(out_dir, n, len(res["embeddings"][0]), dtype)
+        writer.add(res["ids"], res["embeddings"], res["metadatas"], res["documents"])
+    if writer is not None:
+        writer.commit()
+    print(f"[INFO] NumPyインデックス書き出し: {n}件 → {out_dir} ({dtype})")
+    return n
+
+def export_lexical_index(coll, out_dir: str = LEXICAL_INDEX_DIR, page: int = 1000,
+                         store: Optional[SourceTextStore] = None) -> int:
+    """Chroma のコレクションから文字 n-gram の転置インデックス（BM25用）を作る"""
+    store = store or SourceTextStore()
+    n = coll.count()
+    writer = LexicalIndexWriter(out_dir, n)
+    for offset in range(0, n, page):
+        res = coll.get(limit=page, offset=offset, include=["metadatas", "documents"])
+        # 索引づけには本文が要るので全文から切り出す（保存するのは Chroma にあった documents のまま）
+        texts = store.resolve(res["metadatas"], res["documents"])
+        writer.add(res["ids"], res["metadatas"], res["documents"], texts=texts)
+    writer.commit()
+    print(f"[INFO] 文字n-gramインデックス書き出し: {n}件 → {out_dir}")
+    return n
+
+def indexed_text_versions(index_dir: str) -> Optional[List[Tuple[str, str]]]:
+    """
+    書き出し済みインデックスが参照している全文の版。インデックスが無ければ []。
+    版を記録していない以前の形式なら None（版なしの全文ファイルを参照している）
+    """
+    try:
+        with open(os.path.join(index_dir, "index.json"), encoding="utf-8") as f:
+            info = json.load(f)
+    except FileNotFoundError:
+        return []
+    if "text_versions" not in info:
+        return None
+    return [tuple(v) for v in info["text_versions"]]
+
+def manifest_text_versions(manifest: Dict) -> Set[Tuple[str, str]]:
+    return {(path, entry["text_sha"]) for path, entry in manifest["files"].items() if entry.get("text_sha")}
+
+def index_up_to_date(index_dir: str, manifest: Dict) -> bool:
+    """書き出し済みのインデックスが、台帳と同じ版の全文を指しているか"""
+    if not os.path.exists(os.path.join(index_dir, "index.json")):
+        return False
+    versions = indexed_text_versions(index_dir)
+    return versions is not None and set(versions) == manifest_text_versions(manifest)
+
+def prune_source_texts(store: SourceTextStore, manifest: Dict) -> int:
+    """台帳（= Chroma）と、書き出し済みの NumPy / 文字n-gram インデックスのどれからも参照されない版を消す"""
+    keep = manifest_text_versions(manifest)
+    keep_unversioned = len(keep) < len(manifest["files"])
+    for index_dir in (NUMPY_INDEX_DIR, LEXICAL_INDEX_DIR):
+        versions = indexed_text_versions(index_dir)
+        if versions is None:
+            keep_unversioned = True
+        else:
+            keep.update(versions)
+    return store.prune(keep, keep_unversioned=keep_unversioned)
+
+def chunk_id(path: str, idx: int) -> str:
+    return f"{path}#{idx}"
+
+class ManifestTracker:
+    """
+    台帳の更新をファイル単位で管理する。
+    あるファイルの埋め込み待ちチャンクが全部書き込まれた時点で、はじめてそのファイルを台帳に反映する。
+    途中で落ちても、書き込み済みのファイルは次回スキップされる（やり直しは未完了ぶんだけ）。
+    """
+
+    def __init__(self, manifest: Dict, path: str = MANIFEST_PATH, save_interval: float = 5.0) -> None:
+        self.manifest = manifest
+        self.files: Dict[str, Dict] = manifest.setdefault("files", {})
+        self.path = path
+        self.save_interval = save_interval
+        self._pending: Dict[str, List] = {}   # path -> [台帳エントリ, 残りチャンク数]
+        self._last_save = time.monotonic()
+
+    def expect(self, path: str, entry: Dict, n_chunks: int) -> None:
+        if n_chunks == 0:
+            self.files[path] = entry
+        else:
+            self._pending[path] = [entry, n_chunks]
+
+    def written(self, metadatas: List[Dict]) -> None:
+        for m in metadatas:
+            pending = self._pending[m["source"]]
+            pending[1] -= 1
+            if pending[1] == 0:
+                self.files[m["source"]] = pending[0]
+                del self._pending[m["source"]]
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def remove(self, path: str) -> None:
+        self.files.pop(path, None)
+
+    def save(self) -> None:
+        save_manifest(self.manifest, self.path)
+        self._last_save = time.monotonic()
+
+def main(full: bool = False, numpy_index: bool = False, numpy_dtype: str = "float32",
+         lexical_index: bool = False):
+    """
+    文書を読み込み→分割→埋め込み→保存する。
+    既定は差分モード：台帳（ファイル/チャンクのハッシュ）と比べて、
+      - 内容が変わっていないファイルは読みもしない
+      - 新規・変更チャンクだけを埋め込んで upsert
+      - 削除されたファイルや短くなったファイルの余りチャンクは delete
+    full=True なら台帳とコレクションを捨てて全件作り直す（台帳の形式が MANIFEST_FORMAT と違うときも）。
+    numpy_index=True なら、最後にコレクションを NumpyIndex 形式にも書き出す（rag_query の numpy バックエンド用）。
+    lexical_index=True なら、文字 n-gram の転置インデックスも作る（rag_query の lexical / hybrid 用）。
+    埋め込みは EmbedPipeline で並行に投げ、終わったバッチから順に Chroma へ書き込む。
+    """
     # DB準備
     client_chroma = chromadb.PersistentClient(path=CHROMA_DIR)
+    store = SourceTextStore(SOURCE_TEXT_DIR)
+    manifest = load_manifest()
+    if not full and manifest["files"] and manifest.get("format") != MANIFEST_FORMAT:
+        # 以前の形式のチャンクが混ざると本文と位置・埋め込みが食い違うので、差分ではなく作り直す
+        print(f"[INFO] 台帳の形式が古いため全件作り直します（{manifest.get('format', 1)} → {MANIFEST_FORMAT}）")
+        full = True
+    if full:
+        try:
+            client_chroma.delete_collection(COLLECTION)
+        except Exception:
+            pass
+        manifest = {"files": {}}
+    manifest["format"] = MANIFEST_FORMAT
+    coll = client_chroma.get_or_create_collection(COLLECTION)
+    tracker = ManifestTracker(manifest)
+    old_files: Dict[str, Dict] = dict(tracker.files)
+    counts = {"files": 0, "changed": 0, "deleted": 0}
+
+    seen = set()
+    file_hashes: Dict[str, str] = {}
+
+    def changed_paths() -> Iterator[Path]:
+        """前回から内容が変わったファイルだけを返す（変わっていないファイルは読みもしない）"""
+        for p in iter_doc_paths(DOCS_DIR):
+            counts["files"] += 1
+            path = str(p)
+            seen.add(path)
+            file_hash = sha256_hex(p.read_bytes())
+            old = old_files.get(path)
+            if old and old.get("sha256") == file_hash:
+                continue
+            file_hashes[path] = file_hash
+            yield p
+
+    def changed_chunks() -> Iterator[Item]:
+        """埋め込みが必要なチャンクを順に返す（ついでに不要チャンクの削除も行う）"""
+        for p, text in iter_documents(changed_paths(), PDF_WORKERS, PDF_TIMEOUT):
+            # 読めなかったファイルは前回の状態を保つ（次回また試す）
+            if text is None:
+                continue
+            path = str(p)
+            counts["changed"] += 1
+            # チャンクの本文は全文から切り出すので、先に全文を保存しておく。
+            # 版ごとに別ファイルなので、まだ書き直していないチャンクやインデックスは前の版を読み続ける
+            text_sha = store.put(path, text)
+            chunks = split_chunks(text)
+            metas = [chunk_meta(path, idx, c, text_sha) for idx, c in enumerate(chunks)]
+            hashes = [chunk_hash(m, c.text(text)) for m, c in zip(metas, chunks)]
+            old = old_files.get(path)
+            old_hashes = old.get("chunks", []) if old else []
+            todo = [
+                idx for idx, h in enumerate(hashes)
+                if not (idx < len(old_hashes) and old_hashes[idx] == h)
+            ]
+            stale = [chunk_id(path, idx) for idx in range(len(chunks), len(old_hashes))]
+            if stale:
+                coll.delete(ids=stale)
+                counts["deleted"] += len(stale)
+            tracker.expect(path, {"sha256": file_hashes.pop(path), "text_sha": text_sha, "chunks": hashes}, len(todo))
+            for idx in todo:
+                yield chunk_id(path, idx), metas[idx], chunks[idx].text(text)
+
+        # 消えたファイルのチャンクを削除
+        for path, old in old_files.items():
+            if path not in seen:
+                stale = [chunk_id(path, idx) for idx in range(len(old.get("chunks", [])))]
+                if stale:
+                    coll.delete(ids=stale)
+                    counts["deleted"] += len(stale)
+                tracker.remove(path)   # 全文は最後の prune_source_texts で消す
+
+    def write(batch: List[Item], embeddings: List[List[float]]) -> None:
+        # upsert なので既存IDがあっても失敗しない（再実行しても結果は同じ）
+        # documents は渡さない（本文は SourceTextStore の全文から start/end で切り出す）。
+        # 以前の形式で入れた documents は Chroma に残るが、読む側は位置があればそちらを使う
+        ids, metadatas, _ = (list(x) for x in zip(*batch))
+        coll.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas)
+        tracker.written(metadatas)
+
+    pipeline = EmbedPipeline(
+        embed_batch,
+        write,
+        max_inflight=EMBED_MAX_INFLIGHT,
+        batch_size=AdaptiveBatchSize(
+            initial=EMBED_BATCH, minimum=EMBED_BATCH_MIN, maximum=EMBED_BATCH_MAX,
+            target_latency=EMBED_TARGET_LATENCY,
+        ),
+        retry_on=(APIConnectionError, APITimeoutError, RateLimitError, InternalServerError),
+    )
+    changed = exported = False
     try:
-        coll = client_chroma.get_collection(COLLECTION)
-    except:
-        coll = client_chroma.create_collection(COLLECTION)
-
-    # 文書読み込み→分割→埋め込み→保存
-    docs = load_texts(DOCS_DIR)
-    print(f"[INFO] 読み込んだ文書数: {len(docs)}")
-
-    ids, metadatas, contents = [], [], []
-    for d in docs:
-        chunks = chunk_text(d["text"])
-        for idx, ch in enumerate(chunks):
-            ids.append(f"{d['path']}#{idx}")
-            metadatas.append({"source": d["path"], "chunk": idx})
-            contents.append(ch)
-
-    print(f"[INFO] チャンク数: {len(contents)}")
-    if not contents:
-        print("[INFO] 追加するデータなし")
-        return
-
-    # バッチで埋め込み（大きすぎる場合は分割して）
-    BATCH = 64
-    all_embeddings = []
-    for i in range(0, len(contents), BATCH):
-        batch = contents[i:i+BATCH]
-        embs = embed_batch(batch)
-        all_embeddings.extend(embs)
-        print(f"[INFO] embedded {i+len(batch)}/{len(contents)}")
-
-    # 既存IDと重複しないように add（Chromaは重複IDでエラー）
-    coll.add(ids=ids, embeddings=all_embeddings, metadatas=metadatas, documents=contents)
+        try:
+            stats = pipeline.run(changed_chunks())
+        finally:
+            tracker.save()
+            changed = bool(full or pipeline.stats.items or counts["deleted"])
+
+        # 前回オプションなしで取り込んだぶんも含め、台帳と版が食い違うインデックスは書き出し直す
+        if numpy_index and (changed or not index_up_to_date(NUMPY_INDEX_DIR, manifest)):
+            exported = True
+            export_numpy_index(coll, NUMPY_INDEX_DIR, numpy_dtype)
+        if lexical_index and (changed or not index_up_to_date(LEXICAL_INDEX_DIR, manifest)):
+            exported = True
+            export_lexical_index(coll, LEXICAL_INDEX_DIR, store=store)
+    finally:
+        # 版はインデックスを全部書き終えてから上げる。先に上げると、書き出し中の検索が
+        # 古いインデックスの結果を新しい版のキーでキャッシュしてしまう（失敗したときも最後に上げる）
+        if changed or exported:
+            bump_corpus_version()
+    # 取り込みが最後まで済んだときだけ古い版を消す（途中で落ちたら、書き直していないチャンクが前の版を指している）
+    pruned = prune_source_texts(store, manifest)
+
+    print(f"[INFO] 文書数: {counts['files']}（変更あり: {counts['changed']}）")
+    print(f"[INFO] 埋め込んだチャンク数: {stats.items}（{stats.batches}バッチ, 再試行 {stats.retries}回）"
+          f" / 削除したチャンク数: {counts['deleted']} / 消した全文の版: {pruned}")
+    print(f"[INFO] 埋め込みキャッシュ: {default_cache().stats()}")
     print("[OK] インデックス完了")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="data/docs をChromaにインデックスする")
+    parser.add_argument("--full", action="store_true", help="差分ではなく全件作り直す")
+    parser.add_argument("--numpy-index", action="store_true", help=f"NumPy形式のインデックスも書き出す（{NUMPY_INDEX_DIR}）")
+    parser.add_argument("--numpy-dtype", choices=["float32", "float16"], default="float32",
+                        help="NumPyインデックスの精度（float16 でサイズ半分）")
+    parser.add_argument("--lexical-index", action="store_true",
+                        help=f"文字n-gramの転置インデックスも作る（{LEXICAL_INDEX_DIR}）")
+    args = parser.parse_args()
     os.makedirs("data/docs", exist_ok=True)
     os.makedirs("data/chroma", exist_ok=True)
-    main()
+    main(full=args.full, numpy_index=args.numpy_index, numpy_dtype=args.numpy_dtype,
+         lexical_index=args.lexical_index)
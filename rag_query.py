@@ -1,71 +1,356 @@
 # rag_query.py
 from __future__ import annotations
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 import json
-from openai import OpenAI
-import chromadb
+import os
+import threading
+import re
+import unicodedata
+import numpy as np
+
+from backend_pool import PoolClient
+from cache import TTLCache
+from context_packer import PackedContext, pack_context
+from embed_batcher import EmbedMicroBatcher
+from embed_cache import default_cache
+from lexical_index import LEXICAL_INDEX_DIR, LexicalIndex, reciprocal_rank_fusion
+from metrics import EMBED_SECONDS, SEARCH_SECONDS, span
+from source_texts import SourceTextStore
+from vector_index import NUMPY_INDEX_DIR, NumpyIndex
 
-OLLAMA_BASE_URL = "http://localhost:11434/v1"
 EMBED_MODEL = "nomic-embed-text"
 GEN_MODEL = "gpt-oss:20b"
 CHROMA_DIR = "data/chroma"
 COLLECTION = "local_corpus"
+CORPUS_VERSION_PATH = os.path.join(CHROMA_DIR, "corpus_version")  # rag_ingest が更新する
+RETRIEVER_BACKEND = "chroma"   # "chroma" | "numpy"（numpy は rag_ingest --numpy-index で作成）
+RETRIEVAL_MODE = "vector"      # "vector" | "lexical" | "hybrid"（lexical/hybrid は rag_ingest --lexical-index が必要）
+HYBRID_CANDIDATES = 4          # hybrid で各方式から top_k の何倍を候補に取るか
+RRF_K = 60                     # reciprocal rank fusion の定数
+
+# ---- 埋め込みのマイクロバッチ ----
+EMBED_BATCH_WINDOW_MS = 5.0   # 最初の1件からこの時間だけ他のリクエストを待つ（0 なら待たない）
+EMBED_BATCH_MAX = 64          # 1回にまとめるテキスト数の上限
+EMBED_BATCH_TIMEOUT = 60.0    # 1回の埋め込みを待つ上限（秒）
+
+# ---- 検索結果キャッシュ ----
+RETRIEVAL_CACHE_SIZE = 2048
+RETRIEVAL_CACHE_TTL = 600.0   # 秒
+
+# ---- コンテキストの詰め込み ----
+CONTEXT_TOKEN_BUDGET = 3000    # プロンプトに入れるコンテキストの上限（概算トークン）
+# 今のチャンク分割は重ならず、隣接チャンクは start/end でつなぐ。この値を使うのは位置情報を持たない
+# 以前の形式のインデックス（固定長＋200文字の重なりで切っていたもの）だけで、重なりを文字列で探す最大文字数
+CONTEXT_MAX_OVERLAP = 200
+CONTEXT_MMR_LAMBDA = 0.7       # MMR の関連度の重み（1.0 なら検索順のまま）
+CONTEXT_DUP_THRESHOLD = 0.95   # 採用済みチャンクとのコサイン類似度がこれ以上なら重複として落とす
+
+# ---- クライアントと Chroma は初回使用時に開く ----
+# import だけでは Chroma を読み込まないので、ingest 前でも /chat だけのワーカーでも起動できる。
+# 埋め込み・生成の送り先は backend_pool の EMBEDDING_BACKENDS / GENERATION_BACKENDS（app と同じプールを共有する）。
+# 向き先を固定したい場合は client に OpenAI クライアントを代入すればそれが使われる。
+client = None
+_collection = None
+_init_lock = threading.Lock()
 
-client = OpenAI(base_url=OLLAMA_BASE_URL, api_key="ollama")
-chroma = chromadb.PersistentClient(path=CHROMA_DIR)
-coll = chroma.get_collection(COLLECTION)
+def get_client():
+    """埋め込み・生成用のクライアント（初回呼び出し時に作る）"""
+    global client
+    if client is None:
+        with _init_lock:
+            if client is None:
+                client = PoolClient()
+    return client
+
+def get_collection():
+    """
+    Chroma のコレクション（初回呼び出し時に開く）。
+    まだ無いときは RuntimeError。失敗は覚えないので、あとから rag_ingest すれば次の呼び出しで開ける。
+    """
+    global _collection
+    if _collection is None:
+        with _init_lock:
+            if _collection is None:
+                import chromadb
+                try:
+                    _collection = chromadb.PersistentClient(path=CHROMA_DIR).get_collection(COLLECTION)
+                except Exception as e:
+                    raise RuntimeError(
+                        f"Chroma collection '{COLLECTION}' is not available in {CHROMA_DIR} "
+                        f"(run rag_ingest.py first): {e}"
+                    ) from e
+    return _collection
 
 SYSTEM_PROMPT = """あなたは社内向けアシスタントです。与えられたコンテキストに基づいて、簡潔で正確に回答してください。わからない場合は「わかりません」と答えてください。必ず根拠の出典（sourceとchunk番号）も最後に列挙してください。"""
 
-def embed(texts: List[str]) -> List[List[float]]:
-    res = client.embeddings.create(model=EMBED_MODEL, input=texts)
+def _embed_remote(texts: List[str]) -> List[List[float]]:
+    res = get_client().embeddings.create(model=EMBED_MODEL, input=texts)
     return [d.embedding for d in res.data]
 
-def retrieve(query: str, top_k: int = 4):
-    q_emb = embed([query])[0]
+# 同時に来た質問の埋め込み（キャッシュミスぶん）を1回のリクエストにまとめる
+embed_batcher = EmbedMicroBatcher(_embed_remote, window_ms=EMBED_BATCH_WINDOW_MS, max_batch=EMBED_BATCH_MAX,
+                                  timeout=EMBED_BATCH_TIMEOUT)
 
-    res = coll.query(
-        query_embeddings=[q_emb],
-        n_results=top_k,
-        include=["documents", "metadatas", "distances"],
-    )
+def embed(texts: List[str], priority: int = 0) -> List[List[float]]:
+    # 同じ質問の2回目以降は埋め込みサーバへ問い合わせない。priority が大きいものは対話の埋め込みの後に回る
+    return default_cache().embed(EMBED_MODEL, texts, lambda missing: embed_batcher.embed(missing, priority))
+
+# ---- 検索結果キャッシュ（コーパスのバージョンが変わったら自動で無効化） ----
+retrieval_cache = TTLCache(maxsize=RETRIEVAL_CACHE_SIZE, ttl=RETRIEVAL_CACHE_TTL)
+_version_state: Tuple[Optional[int], str] = (None, "")
+
+def corpus_version() -> str:
+    """rag_ingest が書いたバージョン印。ファイルの mtime が変わったときだけ読み直す"""
+    global _version_state
+    try:
+        mtime = os.stat(CORPUS_VERSION_PATH).st_mtime_ns
+    except FileNotFoundError:
+        return ""
+    if mtime != _version_state[0]:
+        with open(CORPUS_VERSION_PATH, encoding="utf-8") as f:
+            version = f.read().strip()
+        if version != _version_state[1]:
+            retrieval_cache.clear()   # 古いバージョンのエントリはもう当たらないので捨てる
+        _version_state = (mtime, version)
+    return _version_state[1]
+
+def normalize_query(query: str) -> str:
+    # 全角/半角・連続空白の違いだけの質問は同じキーにする
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", query)).strip()
+
+# ---- 検索バックエンド ----
+class ChromaRetriever:
+    """Chroma の query でベクトル検索する。score は Chroma の距離（小さいほど近い）"""
+    name = "chroma"
+
+    def search(self, q_embs: List[List[float]], top_k: int) -> List[List[Dict]]:
+        res = get_collection().query(
+            query_embeddings=q_embs,
+            n_results=top_k,
+            include=["documents", "metadatas", "distances", "embeddings"],
+        )
+        out = []
+        for qi in range(len(q_embs)):
+            hits = []
+            ids = res.get("ids", [[]])[qi]
+            docs = res.get("documents", [[]])[qi]
+            metas = res.get("metadatas", [[]])[qi]
+            dists = res.get("distances", [[]])[qi]
+            all_embs = res.get("embeddings")
+            embs = all_embs[qi] if all_embs is not None and all_embs[qi] is not None else []
+
+            for i in range(len(docs)):
+                hits.append({
+                    "id": ids[i] if i < len(ids) else None,
+                    "doc": docs[i],
+                    "meta": metas[i] if i < len(metas) else {},
+                    "score": dists[i] if i < len(dists) else None,
+                    # context_packer の重複除去に使う（キャッシュに載るので float32 で持つ）
+                    "embedding": np.asarray(embs[i], dtype=np.float32) if i < len(embs) else None,
+                })
+            out.append(hits)
+        return out
+
+class _ReloadingIndex:
+    """mmap 形式のインデックスを開いて持つ。書き直されたら（index.json の mtime が変わったら）開き直す"""
+
+    def __init__(self, factory, index_dir: str) -> None:
+        self.factory = factory
+        self.index_dir = index_dir
+        self._index = None
+        self._mtime: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        mtime = os.stat(os.path.join(self.index_dir, "index.json")).st_mtime_ns
+        if self._index is None or mtime != self._mtime:
+            with self._lock:
+                if self._index is None or mtime != self._mtime:
+                    self._index, self._mtime = self.factory(self.index_dir), mtime
+        return self._index
+
+class NumpyRetriever:
+    """
+    rag_ingest --numpy-index が書いた mmap 行列を総当たりで検索する。
+    score はコサイン距離（1 - 類似度。Chromaと同じく小さいほど近い）。
+    """
+    name = "numpy"
+
+    def __init__(self, index_dir: str = NUMPY_INDEX_DIR) -> None:
+        self._index = _ReloadingIndex(NumpyIndex, index_dir)
+
+    def index(self) -> NumpyIndex:
+        return self._index.get()
 
-    hits = []
-    ids = res.get("ids", [[]])[0]
-    docs = res.get("documents", [[]])[0]
-    metas = res.get("metadatas", [[]])[0]
-    dists = res.get("distances", [[]])[0]
-
-    for i in range(len(docs)):
-        hits.append({
-            "id": ids[i] if i < len(ids) else None,
-            "doc": docs[i],
-            "meta": metas[i] if i < len(metas) else {},
-            "score": dists[i] if i < len(dists) else None,
-        })
+    def search(self, q_embs: List[List[float]], top_k: int) -> List[List[Dict]]:
+        index = self.index()
+        out = []
+        for rows in index.search(q_embs, top_k):
+            hits = []
+            for r, sim in rows:
+                row = index.row(r)
+                hits.append({
+                    "id": row["id"], "doc": row["doc"], "meta": row["meta"], "score": 1.0 - sim,
+                    "embedding": np.asarray(index.vectors[r], dtype=np.float32),
+                })
+            out.append(hits)
+        return out
+
+class LexicalRetriever:
+    """
+    rag_ingest --lexical-index が書いた文字 n-gram 転置インデックスを BM25 で検索する。
+    埋め込みを呼ばない。score は BM25（大きいほど近い）。
+    """
+    name = "lexical"
+
+    def __init__(self, index_dir: str = LEXICAL_INDEX_DIR) -> None:
+        self._index = _ReloadingIndex(LexicalIndex, index_dir)
+
+    def index(self) -> LexicalIndex:
+        return self._index.get()
+
+    def search_text(self, query: str, top_k: int) -> List[Dict]:
+        index = self.index()
+        hits = []
+        for d, score in index.search(query, top_k):
+            row = index.row(d)
+            hits.append({"id": row["id"], "doc": row["doc"], "meta": row["meta"], "score": score})
+        return hits
+
+# チャンクの本文は持たず、rag_ingest が保存した全文から start/end で切り出す
+source_texts = SourceTextStore()
+
+def fill_documents(hits: List[Dict]) -> List[Dict]:
+    docs = source_texts.resolve([h["meta"] or {} for h in hits], [h["doc"] for h in hits])
+    for h, doc in zip(hits, docs):
+        h["doc"] = doc
     return hits
 
+RETRIEVERS = {
+    "chroma": ChromaRetriever(),
+    "numpy": NumpyRetriever(),
+}
+lexical_retriever = LexicalRetriever()
+
+def get_retriever(backend: Optional[str] = None):
+    backend = backend or RETRIEVER_BACKEND
+    if backend not in RETRIEVERS:
+        raise ValueError(f"Unknown retriever backend: {backend}")
+    return RETRIEVERS[backend]
+
+def fuse_hits(vector_hits: List[Dict], lexical_hits: List[Dict], top_k: int) -> List[Dict]:
+    """ベクトル検索と BM25 の順位を RRF で融合する。score は RRF スコア（大きいほど近い）"""
+    by_id = {h["id"]: h for h in lexical_hits}
+    by_id.update({h["id"]: h for h in vector_hits})
+    fused = reciprocal_rank_fusion([[h["id"] for h in vector_hits], [h["id"] for h in lexical_hits]], k=RRF_K)
+    return [{**by_id[id_], "score": score} for id_, score in fused[:top_k]]
+
+def retrieve(query: str, top_k: int = 4, backend: Optional[str] = None, mode: Optional[str] = None):
+    """
+    mode:
+      "vector"  … 埋め込み＋ベクトル検索（backend で chroma / numpy を選ぶ）
+      "lexical" … 文字 n-gram の BM25 だけ。埋め込みを呼ばない
+      "hybrid"  … 両方の上位候補を RRF で融合
+    """
+    return retrieve_many([query], top_k, backend, mode)[0]
+
+def retrieve_many(queries: List[str], top_k: int = 4, backend: Optional[str] = None,
+                  mode: Optional[str] = None, priority: int = 0) -> List[List[Dict]]:
+    """
+    複数の質問をまとめて検索する（結果は入力順）。
+    キャッシュに無い質問は、埋め込み1回（input に全部渡す）とベクトル検索1回（複数クエリ）で処理する。
+    priority は埋め込みの順番（embed_batcher）。大口のバッチは 1 以上を渡す。
+    """
+    mode = mode or RETRIEVAL_MODE
+    if mode not in ("vector", "lexical", "hybrid"):
+        raise ValueError(f"Unknown retrieval mode: {mode}")
+    retriever = get_retriever(backend)
+    version = corpus_version()
+    keys = [(version, retriever.name, mode, normalize_query(q), top_k) for q in queries]
+    results: List[Optional[List[Dict]]] = [retrieval_cache.get(k) for k in keys]
+
+    # 同じ質問が複数あっても検索は1回
+    todo: Dict[Tuple, List[int]] = {}
+    for i, hits in enumerate(results):
+        if hits is None:
+            todo.setdefault(keys[i], []).append(i)
+    if todo:
+        idxs = [positions[0] for positions in todo.values()]
+        todo_queries = [queries[i] for i in idxs]
+        if mode == "lexical":
+            with span("lexical_search", SEARCH_SECONDS, backend="lexical"):
+                fresh = [lexical_retriever.search_text(q, top_k) for q in todo_queries]
+        else:
+            n_cand = top_k if mode == "vector" else max(top_k, top_k * HYBRID_CANDIDATES)
+            with span("embed", EMBED_SECONDS):
+                q_embs = embed(todo_queries, priority)
+            with span("vector_search", SEARCH_SECONDS, backend=retriever.name):
+                fresh = retriever.search(q_embs, n_cand)
+            if mode == "hybrid":
+                with span("lexical_search", SEARCH_SECONDS, backend="lexical"):
+                    lexical = [lexical_retriever.search_text(q, n_cand) for q in todo_queries]
+                fresh = [fuse_hits(hits, lex, top_k) for hits, lex in zip(fresh, lexical)]
+        for (key, positions), hits in zip(todo.items(), fresh):
+            fill_documents(hits)
+            retrieval_cache.set(key, hits)
+            for i in positions:
+                results[i] = hits
+    return [list(hits) for hits in results]
+
+def warmup_index(backend: Optional[str] = None, mode: Optional[str] = None) -> Dict[str, object]:
+    """
+    起動時のウォームアップ用。検索で使うインデックスと埋め込みキャッシュを開いておき、件数などを返す。
+    最初の質問で Chroma の読み込みやファイルの mmap を待たなくて済むようにする。
+    """
+    mode = mode or RETRIEVAL_MODE
+    retriever = get_retriever(backend)
+    info: Dict[str, object] = {"backend": retriever.name, "mode": mode, "corpus_version": corpus_version()}
+    if mode != "lexical":
+        if retriever.name == "chroma":
+            info["chunks"] = get_collection().count()
+        else:
+            info["chunks"] = len(retriever.index())
+        default_cache()
+    if mode != "vector":
+        info["lexical_docs"] = len(lexical_retriever.index())
+    return info
+
+
+def pack_hits(hits) -> PackedContext:
+    """
+    検索結果をトークン予算内のコンテキストに詰める。
+    隣接チャンクの重なりをつなぎ直し、ほぼ重複のチャンクを落とす。stats に削減できたトークン数が入る
+    """
+    return pack_context(
+        hits,
+        token_budget=CONTEXT_TOKEN_BUDGET,
+        max_overlap=CONTEXT_MAX_OVERLAP,
+        mmr_lambda=CONTEXT_MMR_LAMBDA,
+        dup_threshold=CONTEXT_DUP_THRESHOLD,
+    )
 
 def build_context(hits) -> str:
-    blocks = []
-    for h in hits:
-        src = h["meta"].get("source")
-        ch = h["meta"].get("chunk")
-        blocks.append(f"[source={src} chunk={ch}]\n{h['doc']}")
-    return "\n\n---\n\n".join(blocks)
-
-def answer(query: str, temperature: float = 0.2) -> str:
-    hits = retrieve(query)
-    context = build_context(hits)
-    messages = [
+    return pack_hits(hits).text
+
+def prompt_messages(query: str, context: str) -> List[Dict[str, str]]:
+    return [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": f"質問: {query}\n\n# コンテキスト\n{context}"},
     ]
-    res = client.chat.completions.create(
-        model=GEN_MODEL,
-        messages=messages,
-        temperature=temperature,
-    )
+
+def build_messages(query: str, hits) -> List[Dict[str, str]]:
+    return prompt_messages(query, build_context(hits))
+
+def answer(query: str, temperature: float = 0.2, mode: Optional[str] = None) -> str:
+    with span("retrieve"):
+        hits = retrieve(query, mode=mode)
+    messages = build_messages(query, hits)
+    with span("generate"):
+        res = get_client().chat.completions.create(
+            model=GEN_MODEL,
+            messages=messages,
+            temperature=temperature,
+        )
     return res.choices[0].message.content
 
 if __name__ == "__main__":
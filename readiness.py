@@ -0,0 +1,72 @@
+# readiness.py
+from __future__ import annotations
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from metrics import COMPONENT_READY, WARMUP_SECONDS
+
+PENDING, WARMING, READY, FAILED, SKIPPED = "pending", "warming", "ready", "error", "skipped"
+
+
+class Readiness:
+    """
+    起動時ウォームアップの進み具合をコンポーネントごとに持つ（/ready 用）。
+    状態は pending → warming → ready / error。ウォームアップしない設定なら skipped。
+    required に挙げたものが全部 ready（か skipped）になったら準備完了とみなす。
+    """
+
+    def __init__(self, components: Iterable[str], required: Iterable[str]) -> None:
+        self._components: Dict[str, Dict[str, Any]] = {
+            name: {"state": PENDING, "attempts": 0, "ms": None, "error": None, "detail": None}
+            for name in components
+        }
+        self.required = tuple(required)
+        self.started_at = time.time()
+
+    def skip(self, name: str) -> None:
+        self._components[name]["state"] = SKIPPED
+
+    async def warm(self, name: str, fn: Callable[[], Awaitable[Any]],
+                   retries: int = 0, retry_delay: float = 1.0) -> bool:
+        """
+        fn を実行して成功したら ready。失敗したら retry_delay（倍々）を空けて retries 回までやり直す。
+        fn の戻り値は detail として /ready に出す。
+        """
+        c = self._components[name]
+        delay = retry_delay
+        for attempt in range(retries + 1):
+            c["state"], c["attempts"] = WARMING, attempt + 1
+            t0 = time.perf_counter()
+            try:
+                detail = await fn()
+            except asyncio.CancelledError:
+                c["state"] = PENDING
+                raise
+            except Exception as e:
+                c["state"], c["error"] = FAILED, f"{type(e).__name__}: {e}"
+                if attempt < retries:
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                continue
+            elapsed = time.perf_counter() - t0
+            c.update(state=READY, ms=round(elapsed * 1000, 1), error=None, detail=detail)
+            WARMUP_SECONDS.observe(elapsed, component=name)
+            COMPONENT_READY.inc(component=name)
+            return True
+        return False
+
+    def state(self, name: str) -> Optional[str]:
+        c = self._components.get(name)
+        return c["state"] if c else None
+
+    def is_ready(self) -> bool:
+        return all(self.state(name) in (READY, SKIPPED) for name in self.required)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "ready": self.is_ready(),
+            "required": list(self.required),
+            "uptime_sec": round(time.time() - self.started_at, 1),
+            "components": {name: dict(c) for name, c in self._components.items()},
+        }
@@ -0,0 +1,160 @@
+# scheduler.py
+from __future__ import annotations
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+PRIORITY_INTERACTIVE = 0   # /chat など、人が画面の前で待っているもの
+PRIORITY_BULK = 1          # /rag・/rag/batch など、まとめて流すもの
+
+
+class QueueFull(Exception):
+    """待ち行列が上限に達している。retry_after 秒後に再試行してほしい"""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__(f"queue is full (retry after {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """Scheduler.enqueue が返す整理券。wait() で順番を待ち、終わったら必ず release() する"""
+
+    def __init__(self, scheduler: "Scheduler", client_id: str, priority: int, vtime: float, seq: int) -> None:
+        self.scheduler = scheduler
+        self.client_id = client_id
+        self.priority = priority
+        self.vtime = vtime
+        self.seq = seq
+        self.granted = False
+        self.released = False
+        self.enqueued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    def sort_key(self):
+        return (self.priority, self.vtime, self.seq)
+
+    def __lt__(self, other: "Ticket") -> bool:
+        return self.sort_key() < other.sort_key()
+
+    async def wait(self) -> AsyncIterator[int]:
+        """
+        順番が来るまで待つ。待っている間は、前に何件いるか（0始まり）が変わるたびに yield する。
+        ストリーミングのエンドポイントはこれをそのまま SSE の queue イベントにする。
+        """
+        last = None
+        try:
+            while True:
+                # 状態を読む前に clear する。yield で止まっている間（呼び出し側が送信を待っている間）に
+                # 順番が来ても、その notify() は消えずに残り、下の wait() がすぐ返る
+                self._changed.clear()
+                if self.granted:
+                    break
+                position = self.scheduler.position(self)
+                if position != last:
+                    last = position
+                    yield position
+                await self._changed.wait()
+        except BaseException:
+            # 待っている間に切断された場合は行列から抜ける
+            self.release()
+            raise
+
+    async def wait_granted(self) -> None:
+        async for _ in self.wait():
+            pass
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.scheduler._release(self)
+
+    def notify(self) -> None:
+        self._changed.set()
+
+
+class Scheduler:
+    """
+    生成リクエストの受付制御。
+      - 同時に走らせる生成は max_inflight 本まで。あふれた分は待ち行列へ
+      - 待ち行列は (優先度, クライアントごとの仮想時刻, 到着順) の順で取り出す。
+        同じクライアントが大量に積んでも、他のクライアントの要求と交互に処理される（公平キューイング）
+      - 待ち行列が max_queue を超えたら QueueFull（呼び出し側で 429 + Retry-After にする）
+    """
+
+    def __init__(self, max_inflight: int = 4, max_queue: int = 64, initial_service_time: float = 10.0) -> None:
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.inflight = 0
+        self._queue: List[Ticket] = []
+        self._seq = itertools.count()
+        self._vclock = 0.0
+        self._client_vtime: Dict[str, float] = {}
+        self._service_time = initial_service_time   # 1件あたりの所要時間の移動平均（Retry-After の見積もり用）
+        self.rejected = 0
+        self.completed = 0
+
+    def enqueue(self, client_id: str, priority: int = PRIORITY_INTERACTIVE) -> Ticket:
+        """整理券を発行する。空きがあればその場で開始扱い、行列が満杯なら QueueFull"""
+        if self.inflight >= self.max_inflight and len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(self.retry_after())
+        vtime = max(self._vclock, self._client_vtime.get(client_id, 0.0)) + 1.0
+        self._client_vtime[client_id] = vtime
+        ticket = Ticket(self, client_id, priority, vtime, next(self._seq))
+        heapq.heappush(self._queue, ticket)
+        self._dispatch()
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        return sum(1 for t in self._queue if t < ticket)
+
+    def retry_after(self) -> int:
+        waves = (len(self._queue) + 1) / max(1, self.max_inflight)
+        return max(1, math.ceil(waves * self._service_time))
+
+    def _dispatch(self) -> None:
+        granted = False
+        while self._queue and self.inflight < self.max_inflight:
+            ticket = heapq.heappop(self._queue)
+            self._vclock = max(self._vclock, ticket.vtime)
+            ticket.granted = True
+            ticket.started_at = time.monotonic()
+            self.inflight += 1
+            ticket.notify()
+            granted = True
+        if granted:
+            # 前が空いたので、待っている全員の順位が変わる
+            for t in self._queue:
+                t.notify()
+
+    def _release(self, ticket: Ticket) -> None:
+        if ticket.granted:
+            self.inflight -= 1
+            self.completed += 1
+            elapsed = time.monotonic() - (ticket.started_at or ticket.enqueued_at)
+            self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+        elif ticket in self._queue:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+            for t in self._queue:
+                t.notify()
+        if not any(t.client_id == ticket.client_id for t in self._queue):
+            # 待ちの無いクライアントの仮想時刻は覚えておく必要がない
+            if self._client_vtime.get(ticket.client_id, 0.0) <= self._vclock:
+                self._client_vtime.pop(ticket.client_id, None)
+        self._dispatch()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "inflight": self.inflight,
+            "max_inflight": self.max_inflight,
+            "queued": len(self._queue),
+            "max_queue": self.max_queue,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "avg_service_seconds": round(self._service_time, 3),
+        }
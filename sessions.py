@@ -0,0 +1,119 @@
+# sessions.py
+from __future__ import annotations
+import asyncio
+import json
+import uuid
+from typing import Any, Dict, List, Optional
+
+from cache import TTLCache
+from context_packer import estimate_tokens
+
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    """1メッセージの概算トークン数（本文＋ツール呼び出しの引数）"""
+    n = 4 + estimate_tokens(message.get("content") or "")   # 4 はロールなどの区切りぶん
+    if message.get("tool_calls"):
+        n += estimate_tokens(json.dumps(message["tool_calls"], ensure_ascii=False))
+    return n
+
+
+class Session:
+    """
+    1つの会話の履歴。Ollama に送ったメッセージをそのままの形で持つ（tool_calls / role=tool も含む）。
+    次のターンはこの履歴の後ろに足すだけなので、先頭部分が毎回同じになり、バックエンドのプロンプトキャッシュが効く。
+    """
+
+    def __init__(self, session_id: str) -> None:
+        self.id = session_id
+        self.messages: List[Dict[str, Any]] = []
+        self.tokens = 0
+        self.turns = 0
+        self.trimmed_turns = 0
+        # 同じセッションに同時に2ターン来たら順番に処理する（履歴が混ざらないように）
+        self.lock = asyncio.Lock()
+
+    def prompt(self, new_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """今回送るメッセージ列（履歴＋新しいメッセージ）。履歴自体は commit まで変えない"""
+        return [*self.messages, *new_messages]
+
+    def commit(self, messages: List[Dict[str, Any]], max_tokens: int, trim_to_tokens: int) -> None:
+        """ターンが最後まで終わったときだけ呼ぶ。途中で切れたターンは履歴に残さない"""
+        self.messages = messages
+        self.tokens = sum(message_tokens(m) for m in messages)
+        self.turns += 1
+        if self.tokens > max_tokens:
+            self.trim(trim_to_tokens)
+
+    def trim(self, target_tokens: int) -> None:
+        """
+        先頭の system メッセージは残し、古いターン（user から次の user の手前まで）をまとめて落とす。
+        上限を超えたら下限まで一気に減らす（ヒステリシス）ので、先頭が変わるのはたまにだけで済む。
+        """
+        pinned = 0
+        while pinned < len(self.messages) and self.messages[pinned].get("role") == "system":
+            pinned += 1
+        head, body = self.messages[:pinned], self.messages[pinned:]
+        tokens = self.tokens
+        while tokens > target_tokens:
+            # 次の user メッセージまでが1ターン。最後のターンは落とさない
+            nxt = next((i for i in range(1, len(body)) if body[i].get("role") == "user"), None)
+            if nxt is None:
+                break
+            tokens -= sum(message_tokens(m) for m in body[:nxt])
+            body = body[nxt:]
+            self.trimmed_turns += 1
+        self.messages = head + body
+        self.tokens = tokens
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.id,
+            "messages": len(self.messages),
+            "tokens": self.tokens,
+            "turns": self.turns,
+            "trimmed_turns": self.trimmed_turns,
+        }
+
+
+class SessionStore:
+    """
+    サーバ側の会話履歴（プロセス内メモリ）。
+      - 件数は max_sessions まで。あふれたら最も長く使われていないセッションから捨てる
+      - ttl 秒使われなかったセッションは捨てる
+      - 履歴が max_tokens を超えたら trim_to_tokens まで古いターンを落とす
+    複数ワーカーで動かす場合は、同じセッションが同じワーカーに届くようにする（sticky）必要がある。
+    """
+
+    def __init__(self, max_sessions: int = 10000, ttl: Optional[float] = 3600.0,
+                 max_tokens: int = 6000, trim_to_tokens: int = 4000) -> None:
+        self.max_tokens = max_tokens
+        self.trim_to_tokens = trim_to_tokens
+        self._sessions = TTLCache(maxsize=max_sessions, ttl=ttl)
+        self.created = 0
+
+    def create(self) -> Session:
+        """新しいセッションを作る。ID は必ずサーバ側で発行する（クライアントの指定した ID は使わない）"""
+        session = Session(uuid.uuid4().hex)
+        self._sessions.set(session.id, session)
+        self.created += 1
+        return session
+
+    def resume(self, session_id: str) -> Optional[Session]:
+        """発行済みで期限内のセッションを返し、TTL を延長する。知らない ID・期限切れは None"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.set(session_id, session)
+        return session
+
+    def get(self, session_id: str) -> Optional[Session]:
+        return self._sessions.get(session_id)
+
+    def delete(self, session_id: str) -> bool:
+        return self._sessions.pop(session_id) is not None
+
+    def commit(self, session: Session, messages: List[Dict[str, Any]]) -> None:
+        session.commit(messages, self.max_tokens, self.trim_to_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._sessions.stats(), "created": self.created,
+                "max_tokens": self.max_tokens, "trim_to_tokens": self.trim_to_tokens}
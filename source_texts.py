@@ -0,0 +1,109 @@
+# source_texts.py
+from __future__ import annotations
+import hashlib
+import os
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from cache import TTLCache
+
+SOURCE_TEXT_DIR = "data/chroma/texts"   # rag_ingest が書く（ファイルごとに1つ、抽出済みの全文）
+SOURCE_TEXT_CACHE_SIZE = 256            # メモリに置いておく全文の数
+
+
+def text_version(text: str) -> str:
+    """全文の版（内容のハッシュ）。チャンクのメタデータの text_sha に入れて、どの版を切り出すかを固定する"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class SourceTextStore:
+    """
+    抽出済みの全文をファイルごとに保存し、チャンクは (start, end) でそこから切り出す。
+    チャンクごとに本文を持たないので、重なりの分だけ膨らむこともなく、Chroma の documents も空でよい。
+    PDF の再抽出も不要（インデックス作成時に抜き出したテキストをそのまま使う）。
+    全文は (source, 版) ごとに別ファイルにして上書きしない。書き出し直していない NumPy / 文字n-gram
+    インデックスや、取り込み途中で古いままのチャンクも、自分が作られたときの版から切り出せる。
+    どこからも参照されなくなった版は prune() で消す。
+    """
+
+    def __init__(self, root: str = SOURCE_TEXT_DIR, cache_size: int = SOURCE_TEXT_CACHE_SIZE) -> None:
+        self.root = root
+        self._cache = TTLCache(maxsize=cache_size, ttl=None)
+
+    def _name(self, source: str, version: Optional[str]) -> str:
+        digest = hashlib.sha256(source.encode("utf-8")).hexdigest()
+        # 版なし（text_sha を持たない以前のチャンク）は上書き式だったころのファイル名
+        return f"{digest}-{version}.txt" if version else f"{digest}.txt"
+
+    def _file(self, source: str, version: Optional[str] = None) -> str:
+        return os.path.join(self.root, self._name(source, version))
+
+    def put(self, source: str, text: str) -> str:
+        """全文を保存して版を返す。同じ版がすでにあれば書かない"""
+        version = text_version(text)
+        path = self._file(source, version)
+        if not os.path.exists(path):
+            os.makedirs(self.root, exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8", newline="") as f:
+                f.write(text)
+            os.replace(tmp, path)
+        return version
+
+    def prune(self, keep: Iterable[Tuple[str, str]], keep_unversioned: bool = False) -> int:
+        """
+        keep（(source, 版) の組）に無い版を消し、消した数を返す。
+        keep_unversioned=False なら版なしの古いファイルも消す（参照するインデックスが残っていないとき）。
+        """
+        names = {self._name(source, version) for source, version in keep}
+        removed = 0
+        try:
+            entries = os.listdir(self.root)
+        except FileNotFoundError:
+            return 0
+        for name in entries:
+            if name in names or not name.endswith(".txt"):
+                continue
+            if "-" not in name and keep_unversioned:
+                continue
+            try:
+                os.remove(os.path.join(self.root, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        self._cache.clear()
+        return removed
+
+    def get(self, source: str, version: Optional[str] = None) -> Optional[str]:
+        path = self._file(source, version)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        key = (source, version, mtime)
+        text = self._cache.get(key)
+        if text is None:
+            with open(path, encoding="utf-8", newline="") as f:
+                text = f.read()
+            self._cache.set(key, text)
+        return text
+
+    def slice(self, meta: Dict) -> Optional[str]:
+        """メタデータ（source, text_sha, start, end）が指す範囲のテキスト。見つからなければ None"""
+        if "start" not in meta or "end" not in meta:
+            return None
+        text = self.get(meta.get("source", ""), meta.get("text_sha"))
+        return None if text is None else text[int(meta["start"]):int(meta["end"])]
+
+    def resolve(self, metadatas: Sequence[Dict], documents: Optional[Sequence[Optional[str]]]) -> List[Optional[str]]:
+        """
+        チャンクの本文を返す。メタデータに位置（start/end）があれば全文から切り出し、
+        位置を持たない以前の形式のチャンクと、全文が見つからないときだけ documents を使う。
+        （Chroma の upsert は documents を省くと前の本文を残すので、documents は古いことがある）
+        """
+        documents = documents or [None] * len(metadatas)
+        out: List[Optional[str]] = []
+        for meta, doc in zip(metadatas, documents):
+            text = self.slice(meta or {})
+            out.append(doc if text is None else text)
+        return out
+
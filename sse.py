@@ -0,0 +1,186 @@
+# sse.py
+from __future__ import annotations
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Set, Union
+
+
+@dataclass
+class FlushPolicy:
+    """
+    テキスト差分をまとめて送るときの flush 条件。どちらかを満たしたら1フレームとして送る。
+      max_bytes    : バッファがこのバイト数(UTF-8)に達したら即 flush。0 ならデルタごとに flush
+      max_delay_ms : 最初の未送信デルタからこの時間が経ったら flush。0 ならデルタごとに flush
+      emit_ids     : data フレームに連番の id: を付ける（クライアントが Last-Event-ID で再開位置を持てる）
+    """
+    max_bytes: int = 1024
+    max_delay_ms: float = 40.0
+    emit_ids: bool = False
+
+
+@dataclass
+class SSEEvent:
+    """
+    まとめずにそのまま送る制御フレーム（[DONE] や event: 付きの通知など）。
+    送る前に未送信のテキストは必ず flush される。
+    """
+    data: str
+    event: Optional[str] = None
+    id: Optional[str] = None
+
+
+def sse_data(data: str, event: Optional[str] = None, id: Optional[str] = None) -> bytes:
+    """
+    SSEフレームを生成する。改行を含む data は複数の data: 行に分割する
+    （クライアント側で "\\n" 連結されて元に戻る）。例:
+      event: sources
+      id: 3
+      data: 1行目
+      data: 2行目
+      \\n
+    """
+    lines: List[str] = []
+    if event:
+        lines.append(f"event: {event}")
+    if id is not None:
+        lines.append(f"id: {id}")
+    # \r\n / \r / \n のいずれも行区切りとして扱う（SSE仕様と同じ）
+    for line in data.replace("\r\n", "\n").replace("\r", "\n").split("\n"):
+        lines.append(f"data: {line}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+def sse_comment(text: str = "") -> bytes:
+    """コメント行（": ..."）だけのフレーム。クライアントの EventSource は読み捨てる"""
+    return f": {text}\n\n".encode("utf-8")
+
+
+# 後始末用に投げたタスクが GC で消えないよう参照を保持
+_background: Set[asyncio.Task] = set()
+
+
+def _spawn(coro) -> None:
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+class SSEWriter:
+    """
+    テキスト差分（str）と制御フレーム（SSEEvent）の列を、FlushPolicy に従って
+    まとめた SSE バイト列に変換する。1文字ごとの小さな write / TCPパケットを避けるためのレイヤ。
+      heartbeat_sec   : この秒数なにも送っていなければ ": ping" を送る（プロキシのアイドル切断を防ぎ、
+                        書き込みの失敗で相手が居なくなったことに気づける）。None/0 なら送らない
+      is_disconnected : ハートビートのたびに呼ぶ切断チェック（Request.is_disconnected など）。
+                        True なら上流を待たずにそこで打ち切る（上流は pending のキャンセルで止まる）
+    """
+
+    def __init__(self, policy: Optional[FlushPolicy] = None, heartbeat_sec: Optional[float] = None,
+                 is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None) -> None:
+        self.policy = policy or FlushPolicy()
+        self.heartbeat_sec = heartbeat_sec
+        self.is_disconnected = is_disconnected
+        self.disconnected = False
+        self._buf: List[str] = []
+        self._buf_bytes = 0
+        self._first_ts: Optional[float] = None
+        self._seq = 0
+
+    # ---- 同期API（テストや非同期でない呼び出し元向け） ----
+    def feed(self, text: str) -> bytes:
+        """テキスト差分を積む。サイズ条件を満たしたら flush したフレームを返す（なければ b""）"""
+        if not text:
+            return b""
+        if self._first_ts is None:
+            self._first_ts = time.monotonic()
+        self._buf.append(text)
+        self._buf_bytes += len(text.encode("utf-8"))
+        if self._buf_bytes >= self.policy.max_bytes or self.policy.max_delay_ms <= 0:
+            return self.flush()
+        return b""
+
+    def event(self, ev: SSEEvent) -> bytes:
+        """未送信テキストを flush してから制御フレームを返す"""
+        return self.flush() + sse_data(ev.data, event=ev.event, id=ev.id)
+
+    def flush(self) -> bytes:
+        if not self._buf:
+            return b""
+        data = "".join(self._buf)
+        self._buf.clear()
+        self._buf_bytes = 0
+        self._first_ts = None
+        frame_id = None
+        if self.policy.emit_ids:
+            self._seq += 1
+            frame_id = str(self._seq)
+        return sse_data(data, id=frame_id)
+
+    def _time_left(self) -> Optional[float]:
+        """時間条件での flush までの残り秒数。バッファが空なら None（無期限に待ってよい）"""
+        if self._first_ts is None:
+            return None
+        deadline = self._first_ts + self.policy.max_delay_ms / 1000.0
+        return max(0.0, deadline - time.monotonic())
+
+    def _wait_timeout(self, last_write: float) -> Optional[float]:
+        """時間条件での flush かハートビートの、早いほうまでの残り秒数"""
+        left = self._time_left()
+        if self.heartbeat_sec:
+            beat = max(0.0, last_write + self.heartbeat_sec - time.monotonic())
+            left = beat if left is None else min(left, beat)
+        return left
+
+    # ---- 非同期API ----
+    async def stream(self, source: AsyncIterator[Union[str, SSEEvent]]) -> AsyncIterator[bytes]:
+        """
+        source を読みながら SSE バイト列を返す非同期ジェネレータ。
+        上流が詰まっていても、max_delay_ms を過ぎたバッファは待たずに送る。
+        上流が黙っている間（プリフィル・ツール実行・順番待ち）は heartbeat_sec ごとに ": ping" を送る。
+        """
+        it = source.__aiter__()
+        pending: Optional[asyncio.Future] = None
+        finished = False
+        last_write = time.monotonic()
+        try:
+            while True:
+                if pending is None:
+                    pending = asyncio.ensure_future(it.__anext__())
+                done, _ = await asyncio.wait({pending}, timeout=self._wait_timeout(last_write))
+                if not done:
+                    if self._buf:
+                        # 時間切れ：次のデルタを待たずに今あるぶんを送る（これがハートビートも兼ねる）
+                        yield self.flush()
+                    else:
+                        if self.is_disconnected is not None and await self.is_disconnected():
+                            self.disconnected = True
+                            break
+                        yield sse_comment("ping")
+                    last_write = time.monotonic()
+                    continue
+
+                fut, pending = pending, None
+                try:
+                    item = fut.result()
+                except StopAsyncIteration:
+                    finished = True
+                    break
+
+                if isinstance(item, SSEEvent):
+                    yield self.event(item)
+                elif frame := self.feed(item):
+                    yield frame
+                else:
+                    continue
+                last_write = time.monotonic()
+
+            if not self.disconnected and (tail := self.flush()):
+                yield tail
+        finally:
+            # クライアント切断などで途中終了した場合も、上流のジェネレータを確実に閉じる。
+            # ここで await すると外側のキャンセルに巻き込まれるので、別タスクに任せる。
+            if pending is not None and not pending.done():
+                pending.cancel()
+            elif not finished and hasattr(it, "aclose"):
+                _spawn(it.aclose())
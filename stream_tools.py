@@ -1,12 +1,18 @@
 # stream_tools.py
 from __future__ import annotations
 import json
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Any, Dict, List
 from openai import OpenAI
 
+from tool_calls import ToolCallAssembler
+
 client = OpenAI(base_url="http://localhost:11434/v1", api_key="ollama")
 MODEL = "gpt-oss:20b"
 
+# 引数がそろったツールから、1回目のストリームを読み終わる前に裏で実行しておく
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tool")
+
 tools = [
     {
         "type": "function",
@@ -34,19 +40,33 @@ def call_tool(name: str, arguments_json: str) -> Dict[str, Any]:
         return add_numbers(**args)
     raise ValueError(f"Unknown tool {name}")
 
+def run_tool(name: str, arguments_json: str) -> Dict[str, Any]:
+    """ワーカーで動かす用。失敗しても例外にせず {"error": ...} を返す（2回目にそのまま渡す）"""
+    try:
+        return call_tool(name, arguments_json)
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+
 def first_turn_with_stream(user_message: str) -> Dict[str, Any]:
     """
     1回目をストリーミングで受け取りつつ、
     - ツール呼び出しが無ければそのままコンテンツを表示して終了
-    - ツール呼び出しがあれば name / arguments を復元して返す
+    - ツール呼び出しがあれば index ごとに name / arguments を復元し、
+      引数がそろった呼び出しから（残りの呼び出しを受信中でも）ワーカーで実行を始める
     """
     messages: List[Dict[str, Any]] = [
         {"role": "system", "content": "必要なら必ず tools を使って正確に答えてください。"},
         {"role": "user", "content": user_message},
     ]
 
-    tool_name = None
-    tool_args_buf = ""
+    assembler = ToolCallAssembler()
+    content_parts: List[str] = []
+    futures: Dict[str, Future] = {}  # tool_call id -> 実行中の結果
+
+    def dispatch(ready: List[Dict[str, Any]]) -> None:
+        for call in ready:
+            fn = call["function"]
+            futures[call["id"]] = executor.submit(run_tool, fn["name"], fn["arguments"])
 
     with client.chat.completions.create(
         model=MODEL,
@@ -57,56 +77,52 @@ def first_turn_with_stream(user_message: str) -> Dict[str, Any]:
         messages=messages,
     ) as stream:
         for ev in stream:
+            if not ev.choices:
+                continue
             ch = ev.choices[0]
 
             # ① ふつうのテキストを受け取ったら、画面に逐次出力
             if ch.delta and (txt := (ch.delta.content or "")):
+                content_parts.append(txt)
                 print(txt, end="", flush=True)
 
-            # ② ツール呼び出しが来た場合、増分で name/args が小分けに届くので結合
+            # ② ツール呼び出しは index ごとに小分けで届くので、呼び出しごとに結合し、
+            #    JSON が閉じたものから先に実行しておく
             if ch.delta and ch.delta.tool_calls:
-                for tc in ch.delta.tool_calls:
-                    if tc.function and tc.function.name:
-                        tool_name = tc.function.name  # nameはだいたい一発で届く
-                    if tc.function and tc.function.arguments:
-                        tool_args_buf += tc.function.arguments  # JSON断片を結合
+                assembler.add(ch.delta.tool_calls)
+                dispatch(assembler.ready())
 
-            # ③ ストリーム終了時のフラグ
-            if ev.choices[0].finish_reason in ("stop", "tool_calls"):
-                pass
+    # ③ ストリーム終了：まだ走らせていない呼び出し（引数が壊れているものも含む）を流す
+    dispatch(assembler.ready(final=True))
 
     print()  # 改行
     return {
         "messages": messages,            # 2ターン目に引き継ぐ
-        "tool_name": tool_name,
-        "tool_args_json": tool_args_buf.strip() if tool_args_buf else None,
+        "content": "".join(content_parts) or None,
+        "tool_calls": assembler.calls(),
+        "futures": futures,
     }
 
 def second_turn_with_tool(context: Dict[str, Any]) -> None:
     messages = context["messages"]
-    tool_name = context["tool_name"]
-    tool_args_json = context["tool_args_json"]
+    tool_calls = context["tool_calls"]
 
     # ツールが要求されていなければ終了
-    if not tool_name:
+    if not tool_calls:
         return
 
-    # 1回目のassistantメッセージ（ツール呼び出しを含む）を追加
-    # 実装簡略化のため、空メッセージで代用（Ollamaは大抵OK）
-    messages.append({"role": "assistant", "content": None, "tool_calls": [{
-        "id": "tool-call-1",
-        "type": "function",
-        "function": {"name": tool_name, "arguments": tool_args_json or "{}"}
-    }]})
-
-    # ツール実行 → 結果を role=tool で渡す
-    result = call_tool(tool_name, tool_args_json or "{}")
-    messages.append({
-        "role": "tool",
-        "tool_call_id": "tool-call-1",
-        "name": tool_name,
-        "content": json.dumps(result, ensure_ascii=False),
-    })
+    # 1回目のassistantメッセージ（全部のツール呼び出しを含む）を追加
+    messages.append({"role": "assistant", "content": context["content"], "tool_calls": tool_calls})
+
+    # 先に走らせておいたツールの結果を、呼び出しと同じ順に role=tool で渡す
+    for tc in tool_calls:
+        result = context["futures"][tc["id"]].result()
+        messages.append({
+            "role": "tool",
+            "tool_call_id": tc["id"],
+            "name": tc["function"]["name"],
+            "content": json.dumps(result, ensure_ascii=False),
+        })
 
     # 2回目：ツール結果を踏まえて最終回答（ここもストリーミング可能）
     with client.chat.completions.create(
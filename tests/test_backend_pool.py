@@ -0,0 +1,142 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from backend_pool import AsyncPoolClient, BackendPool, NoBackendAvailable
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, timeout=5))
+
+
+class FakeHttp:
+    """GET の結果を URL ごとに決められる httpx.AsyncClient の代役"""
+
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+
+    async def get(self, url, timeout=None):
+        outcome = self.outcomes[url]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return httpx.Response(outcome, request=httpx.Request("GET", url))
+
+
+def test_health_check_marks_backend_unhealthy_on_unexpected_errors():
+    pool = BackendPool("t", [{"url": "http://a/v1"}, {"url": "http://b/v1"}, {"url": "http://c/v1"}],
+                       eject_after=1)
+    http = FakeHttp({
+        "http://a/v1/models": 200,
+        "http://b/v1/models": ValueError("broken"),
+        "http://c/v1/models": httpx.ConnectError("down"),
+    })
+
+    run(pool.check(http))
+
+    a, b, c = pool.backends
+    now = time.time()
+    assert not a.ejected(now)
+    assert b.ejected(now) and "ValueError" in b.last_error
+    assert c.ejected(now)
+
+
+def test_warm_backends_without_candidates_raises_no_backend_available():
+    import app
+
+    pool = BackendPool("t", [{"url": "http://a/v1", "models": ["other"]}])
+
+    async def warm_one(b):
+        return "ok"
+
+    with pytest.raises(NoBackendAvailable):
+        run(app.warm_backends(pool, "gpt-oss:20b", warm_one))
+
+
+# ---- AsyncPoolClient のフェイルオーバー ----
+def conn_error():
+    import openai
+    return openai.APIConnectionError(request=httpx.Request("POST", "http://x/v1/chat/completions"))
+
+
+class FakeStream:
+    """AsyncStream の代役。chunks を順に返し、Exception が来たらそこで投げる"""
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        item = self.chunks.pop(0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeBackendClient:
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.calls = 0
+        self.streams = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        self.calls += 1
+        if isinstance(self.behaviour, Exception):
+            raise self.behaviour
+        stream = FakeStream(self.behaviour)
+        self.streams.append(stream)
+        return stream
+
+
+def pool_client(behaviours):
+    # weight の大きい順に選ばれる（同時実行数 / weight が小さいものから）
+    pool = BackendPool("gen", [{"url": f"http://b{i}/v1", "weight": 10.0 - i} for i in range(len(behaviours))])
+    fakes = {f"http://b{i}/v1": FakeBackendClient(b) for i, b in enumerate(behaviours)}
+    client = AsyncPoolClient(pool, pool)
+    client._new_client = lambda url: fakes[url]
+    return client, pool, [fakes[b.url] for b in pool.backends]
+
+
+async def collect(client):
+    stream = await client.chat.completions.create(model="m", messages=[], stream=True)
+    async with stream:
+        return [chunk async for chunk in stream]
+
+
+def test_stream_fails_over_when_connect_fails():
+    client, pool, (first, second) = pool_client([conn_error(), ["a", "b"]])
+
+    assert run(collect(client)) == ["a", "b"]
+    assert (first.calls, second.calls) == (1, 1)
+    assert pool.backends[0].consecutive_failures == 1
+    assert all(b.inflight == 0 for b in pool.backends)
+
+
+def test_stream_fails_over_when_first_chunk_fails():
+    client, pool, (first, second) = pool_client([[conn_error()], ["a", "b"]])
+
+    assert run(collect(client)) == ["a", "b"]
+    assert first.streams[0].closed
+    assert pool.backends[0].failures == 1
+    assert all(b.inflight == 0 for b in pool.backends)
+
+
+def test_stream_does_not_fail_over_after_first_chunk():
+    client, pool, (first, second) = pool_client([["a", conn_error()], ["x"]])
+
+    with pytest.raises(Exception) as exc:
+        run(collect(client))
+    assert type(exc.value).__name__ == "APIConnectionError"
+    assert second.calls == 0
+    assert all(b.inflight == 0 for b in pool.backends)
@@ -0,0 +1,29 @@
+import json
+
+import completion_cache as cc
+from completion_cache import CompletionCache
+
+
+def test_put_with_ttl_expires_before_the_default(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cc.time, "time", lambda: now[0])
+    cache = CompletionCache(ttl=3600.0)
+    cache.put("short", {"text": "a"}, ttl=30.0)
+    cache.put("default", {"text": "b"})
+
+    now[0] += 31
+    assert cache.get("short") is None
+    assert cache.get("default") == {"text": "b"}
+
+
+def test_completion_ttl_follows_the_shortest_tool_ttl():
+    import app
+
+    def tool(name):
+        return {"role": "tool", "name": name, "content": json.dumps({"ok": 1})}
+
+    assert app.completion_ttl([{"role": "assistant", "content": "hi"}]) == app.completion_cache.ttl
+    assert app.completion_ttl([tool("add_numbers")]) == 300.0
+    assert app.completion_ttl([tool("add_numbers"), tool("get_current_weather")]) == 30.0
+    # キャッシュしないツール・未登録のツールを使った回答は覚えない
+    assert app.completion_ttl([tool("unknown_tool")]) == 0.0
@@ -0,0 +1,45 @@
+# tests/test_doc_loader.py
+import os
+import time
+from pathlib import Path
+
+import doc_loader
+
+
+def fake_extract(path: str) -> str:
+    """ファイル名で振る舞いを変える代役（ワーカープロセス側で動く）"""
+    name = os.path.basename(path)
+    if name.startswith("crash"):
+        os._exit(1)          # segfault / OOM でワーカーが落ちた状況
+    if name.startswith("hang"):
+        time.sleep(30)
+    time.sleep(0.05)
+    return "text:" + name
+
+
+def extract_all(monkeypatch, names, workers=2, timeout=5.0):
+    monkeypatch.setattr(doc_loader, "extract_pdf_text", fake_extract)
+    paths = [Path(n + ".pdf") for n in names]
+    return {p.stem: text for p, text in doc_loader.iter_documents(paths, workers, timeout)}
+
+
+def test_all_files_are_extracted(monkeypatch):
+    names = [f"doc{i}" for i in range(6)]
+    assert extract_all(monkeypatch, names) == {n: f"text:{n}.pdf" for n in names}
+
+
+def test_crashing_worker_only_skips_that_file(monkeypatch):
+    names = ["a", "b", "crash1", "c", "d", "e"]
+    result = extract_all(monkeypatch, names)
+    assert set(result) == set(names)
+    assert result["crash1"] is None
+    assert all(result[n] == f"text:{n}.pdf" for n in names if n != "crash1")
+
+
+def test_timeout_requeues_other_files(monkeypatch):
+    names = ["a", "hang1", "b", "c"]
+    t0 = time.monotonic()
+    result = extract_all(monkeypatch, names, workers=2, timeout=1.0)
+    assert time.monotonic() - t0 < 10
+    assert result["hang1"] is None
+    assert all(result[n] == f"text:{n}.pdf" for n in ("a", "b", "c"))
@@ -0,0 +1,62 @@
+import threading
+
+from embed_batcher import EmbedMicroBatcher
+
+
+class RecordingEmbed:
+    """送られたバッチを記録する。gate が閉じている間は送信スレッドを止めておける"""
+
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.started = threading.Event()
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        self.started.set()
+        self.gate.wait(5)
+        return [[float(len(t))] for t in texts]
+
+
+def test_large_request_is_split_into_max_batch_sized_sends():
+    fn = RecordingEmbed()
+    batcher = EmbedMicroBatcher(fn, window_ms=0, max_batch=4, timeout=5)
+    texts = [f"t{i}" * (i + 1) for i in range(10)]
+
+    vectors = batcher.embed(texts)
+
+    assert vectors == [[float(len(t))] for t in texts]
+    assert [len(b) for b in fn.batches] == [4, 4, 2]
+
+
+def test_interactive_request_goes_before_the_rest_of_a_bulk_request():
+    fn = RecordingEmbed()
+    batcher = EmbedMicroBatcher(fn, window_ms=0, max_batch=2, timeout=5)
+    # 最初の送信を止めておき、その間に大口と対話の依頼を並べる
+    fn.gate.clear()
+    blocker = batcher.submit(["x"])
+    assert fn.started.wait(5)
+    bulk = batcher.submit([f"b{i}" for i in range(6)], priority=1)
+    interactive = batcher.submit(["q"], priority=0)
+    fn.gate.set()
+
+    assert interactive.result(5) == [[1.0]]
+    assert len(bulk.result(5)) == 6
+    blocker.result(5)
+    assert fn.batches[1] == ["q"]
+    assert all(len(b) <= 2 for b in fn.batches)
+
+
+def test_small_requests_are_not_merged_past_max_batch():
+    fn = RecordingEmbed()
+    batcher = EmbedMicroBatcher(fn, window_ms=0, max_batch=3, timeout=5)
+    fn.gate.clear()
+    blocker = batcher.submit(["x"])
+    assert fn.started.wait(5)
+    futs = [batcher.submit(["a", "b"]) for _ in range(3)]
+    fn.gate.set()
+
+    assert [f.result(5) for f in futs] == [[[1.0], [1.0]]] * 3
+    blocker.result(5)
+    assert [len(b) for b in fn.batches] == [1, 2, 2, 2]
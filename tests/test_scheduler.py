@@ -0,0 +1,123 @@
+# tests/test_scheduler.py
+import asyncio
+
+from scheduler import PRIORITY_BULK, PRIORITY_INTERACTIVE, QueueFull, Scheduler
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, timeout=5))
+
+
+def test_grants_up_to_max_inflight_and_queues_the_rest():
+    async def main():
+        s = Scheduler(max_inflight=2, max_queue=8)
+        tickets = [s.enqueue("c") for _ in range(3)]
+        assert [t.granted for t in tickets] == [True, True, False]
+        assert s.stats()["inflight"] == 2 and s.stats()["queued"] == 1
+        tickets[0].release()
+        assert tickets[2].granted
+        assert s.stats()["inflight"] == 2 and s.stats()["queued"] == 0
+    run(main())
+
+
+def test_release_is_idempotent():
+    async def main():
+        s = Scheduler(max_inflight=1)
+        t = s.enqueue("c")
+        t.release()
+        t.release()
+        assert s.stats()["inflight"] == 0 and s.stats()["completed"] == 1
+    run(main())
+
+
+def test_priority_then_fair_order_between_clients():
+    async def main():
+        s = Scheduler(max_inflight=1, max_queue=8)
+        running = s.enqueue("x")
+        a1, a2, a3 = (s.enqueue("a", PRIORITY_BULK) for _ in range(3))
+        b1 = s.enqueue("b", PRIORITY_BULK)
+        i1 = s.enqueue("c", PRIORITY_INTERACTIVE)
+        order = []
+        current = running
+        for _ in range(5):
+            current.release()
+            current = next(t for t in (a1, a2, a3, b1, i1) if t.granted and not t.released)
+            order.append(current)
+        # 対話的なものが先、同じ優先度ではクライアントごとに交互
+        assert order == [i1, a1, b1, a2, a3]
+    run(main())
+
+
+def test_queue_full_raises_with_retry_after():
+    async def main():
+        s = Scheduler(max_inflight=1, max_queue=1)
+        s.enqueue("c")
+        s.enqueue("c")
+        try:
+            s.enqueue("c")
+        except QueueFull as e:
+            assert e.retry_after >= 1
+        else:
+            raise AssertionError("QueueFull was not raised")
+        assert s.stats()["rejected"] == 1
+    run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        s = Scheduler(max_inflight=1)
+        first = s.enqueue("a")
+        waiting = s.enqueue("b")
+        task = asyncio.ensure_future(waiting.wait_granted())
+        await asyncio.sleep(0)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert waiting.released and s.stats()["queued"] == 0
+        first.release()
+        assert s.stats()["inflight"] == 0
+    run(main())
+
+
+def test_grant_while_consumer_is_suspended_at_yield_is_not_lost():
+    """
+    wait() が position を yield して止まっている間（SSE の送信待ち）に順番が来ても、
+    次に再開したときにそれを見落として永久に待ち続けないこと。
+    """
+    async def main():
+        s = Scheduler(max_inflight=1)
+        first = s.enqueue("a")
+        second = s.enqueue("b")
+        positions = []
+        gen = second.wait()
+        positions.append(await gen.__anext__())   # position 0 を受け取ったところで止まっている
+        first.release()                            # この間に順番が来る
+        assert second.granted
+        async for position in gen:                 # 再開したらすぐ抜けること
+            positions.append(position)
+        assert positions == [0]
+        second.release()
+        assert s.stats()["inflight"] == 0
+    run(main())
+
+
+def test_position_updates_are_yielded_while_waiting():
+    async def main():
+        s = Scheduler(max_inflight=1)
+        running = s.enqueue("a")
+        t1 = s.enqueue("b")
+        t2 = s.enqueue("c")
+        seen = []
+
+        async def consume():
+            async for position in t2.wait():
+                seen.append(position)
+                await asyncio.sleep(0.01)   # 送信に時間がかかる消費者
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.005)
+        running.release()
+        await asyncio.sleep(0.005)
+        t1.release()
+        await task
+        assert seen[0] == 1 and t2.granted
+    run(main())
@@ -0,0 +1,39 @@
+from fastapi.testclient import TestClient
+
+from sessions import SessionStore
+
+
+def test_create_issues_server_side_ids():
+    store = SessionStore()
+    a, b = store.create(), store.create()
+
+    assert a.id != b.id and len(a.id) == 32
+    assert store.resume(a.id) is a
+
+
+def test_resume_rejects_unknown_and_expired_ids(monkeypatch):
+    import cache
+
+    now = [100.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    store = SessionStore(ttl=10.0)
+    session = store.create()
+
+    assert store.resume("attacker-chosen-id") is None
+    assert store.get("attacker-chosen-id") is None
+    now[0] += 11
+    assert store.resume(session.id) is None
+
+
+def test_chat_returns_404_for_an_unknown_session_id():
+    import app
+
+    # lifespan（モデルやインデックスの読み込み）は走らせない
+    client = TestClient(app.app)
+    res = client.post("/chat", json={"messages": [{"role": "user", "content": "hi"}],
+                                     "session_id": "attacker-chosen-id"})
+    assert res.status_code == 404
+    res = client.post("/chat", json={"messages": [{"role": "user", "content": "hi"}]},
+                      headers={"X-Session-Id": "attacker-chosen-id"})
+    assert res.status_code == 404
+    assert app.sessions.get("attacker-chosen-id") is None
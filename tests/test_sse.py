@@ -0,0 +1,87 @@
+import asyncio
+
+from sse import FlushPolicy, SSEEvent, SSEWriter, sse_data
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, timeout=5))
+
+
+async def drain(writer, source):
+    return [frame async for frame in writer.stream(source)]
+
+
+def test_feed_coalesces_until_max_bytes():
+    writer = SSEWriter(FlushPolicy(max_bytes=6, max_delay_ms=1000))
+
+    assert writer.feed("ab") == b""
+    assert writer.feed("cd") == b""
+    assert writer.feed("ef") == sse_data("abcdef")
+    assert writer.flush() == b""
+
+
+def test_event_flushes_pending_text_first():
+    writer = SSEWriter(FlushPolicy(max_bytes=1024, max_delay_ms=1000))
+    writer.feed("hello")
+
+    assert writer.event(SSEEvent("[DONE]")) == sse_data("hello") + sse_data("[DONE]")
+
+
+def test_stream_flushes_after_max_delay_while_upstream_is_slow():
+    async def source():
+        yield "a"
+        yield "b"
+        await asyncio.sleep(0.3)
+        yield "c"
+        yield SSEEvent("[DONE]")
+
+    writer = SSEWriter(FlushPolicy(max_bytes=1024, max_delay_ms=20))
+    frames = run(drain(writer, source()))
+
+    # "ab" は "c" を待たずに時間切れで送られ、"c" は [DONE] の直前に同じ書き込みで flush される
+    assert frames == [sse_data("ab"), sse_data("c") + sse_data("[DONE]")]
+
+
+def test_stream_sends_heartbeat_while_upstream_is_silent():
+    async def source():
+        await asyncio.sleep(0.25)
+        yield "x"
+
+    writer = SSEWriter(FlushPolicy(max_bytes=1, max_delay_ms=1000), heartbeat_sec=0.05)
+    frames = run(drain(writer, source()))
+
+    assert frames[-1] == sse_data("x")
+    assert b": ping\n\n" in frames[:-1]
+
+
+def test_stream_stops_and_cancels_upstream_on_disconnect():
+    state = {"closed": False, "produced": 0}
+
+    async def source():
+        try:
+            yield "first"
+            while True:
+                await asyncio.sleep(10)
+                state["produced"] += 1
+                yield "never"
+        finally:
+            state["closed"] = True
+
+    checks = []
+
+    async def is_disconnected():
+        checks.append(1)
+        return len(checks) >= 2
+
+    async def main():
+        writer = SSEWriter(FlushPolicy(max_bytes=1, max_delay_ms=1000), heartbeat_sec=0.02,
+                           is_disconnected=is_disconnected)
+        frames = await drain(writer, source())
+        await asyncio.sleep(0.05)   # 上流のキャンセルが届くのを待つ
+        return writer, frames
+
+    writer, frames = run(main())
+
+    assert writer.disconnected
+    assert frames == [sse_data("first"), b": ping\n\n"]
+    assert state["closed"] and state["produced"] == 0
@@ -0,0 +1,77 @@
+# tests/test_tool_engine.py
+import asyncio
+import threading
+import time
+
+from tool_engine import ToolEngine
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, timeout=5))
+
+
+def make_engine(delay=0.2, cache_ttl=60.0, max_workers=8):
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        time.sleep(delay)
+        return {"x": x}
+
+    engine = ToolEngine(max_workers=max_workers)
+    engine.register("slow", slow, timeout=2.0, cache_ttl=cache_ttl)
+    return engine, calls
+
+
+def test_results_keep_the_tool_calls_order():
+    async def main():
+        engine, _ = make_engine(delay=0.01)
+        calls = [{"function": {"name": "slow", "arguments": f'{{"x": {i}}}'}} for i in range(3)]
+        calls.append({"function": {"name": "missing", "arguments": "{}"}})
+        results = await engine.run_all(calls)
+        assert results[:3] == [{"x": 0}, {"x": 1}, {"x": 2}]
+        assert "error" in results[3]
+    run(main())
+
+
+def test_duplicate_calls_share_one_run_and_survive_one_disconnect():
+    async def main():
+        engine, calls = make_engine()
+        a = asyncio.ensure_future(engine.run("slow", '{"x": 1}'))
+        await asyncio.sleep(0.02)
+        b = asyncio.ensure_future(engine.run("slow", '{"x": 1}'))
+        await asyncio.sleep(0.02)
+        a.cancel()
+        assert await b == {"x": 1}
+        assert calls == [1]
+        assert await engine.run("slow", '{"x": 1}') == {"x": 1}   # キャッシュから
+        assert calls == [1]
+    run(main())
+
+
+def test_run_is_cancelled_when_the_last_waiter_goes_away():
+    async def main():
+        # ワーカー1本を塞いでおき、2本目の呼び出しがスレッドプールの順番待ちのまま取り消されること
+        engine, calls = make_engine(delay=0.3, cache_ttl=None, max_workers=1)
+        busy = asyncio.ensure_future(engine.run("slow", '{"x": 0}'))
+        await asyncio.sleep(0.02)
+        queued = asyncio.ensure_future(engine.run("slow", '{"x": 1}'))
+        await asyncio.sleep(0.02)
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert await busy == {"x": 0}
+        await asyncio.sleep(0.4)
+        assert calls == [0]
+        assert not engine._waiters
+    run(main())
+
+
+def test_new_caller_does_not_join_a_cancelled_run():
+    async def main():
+        engine, calls = make_engine(delay=0.1)
+        a = asyncio.ensure_future(engine.run("slow", '{"x": 5}'))
+        await asyncio.sleep(0.02)
+        a.cancel()
+        await asyncio.gather(a, return_exceptions=True)
+        assert await engine.run("slow", '{"x": 5}') == {"x": 5}
+    run(main())
@@ -0,0 +1,95 @@
+# tool_calls.py
+from __future__ import annotations
+import json
+from typing import Any, Dict, List, Optional, Set
+
+
+class ToolCallAssembler:
+    """
+    ストリーミング中に小分けで届く tool_calls の断片を、index ごとに組み立てる。
+      - name / id はだいたい最初の断片で届く
+      - arguments は JSON文字列の断片として複数回に分けて届く
+    並列ツール呼び出し（index=0,1,...）が混ざっても壊れないよう、呼び出しごとに別バッファを持つ。
+    ready() で「引数がそろった呼び出し」をストリームの途中でも取り出せる（先にツールを走らせる用）。
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[int, Dict[str, Any]] = {}
+        self._last_index: Optional[int] = None
+        self._reported: Set[int] = set()
+
+    def _resolve_index(self, tc: Any) -> int:
+        idx = getattr(tc, "index", None)
+        if idx is not None:
+            return idx
+        # index を付けない実装向け：新しい id が来たら次の呼び出しとみなす
+        if self._last_index is None or (tc.id and tc.id != self._calls[self._last_index]["id"]):
+            return len(self._calls)
+        return self._last_index
+
+    def add(self, deltas: Any) -> None:
+        """delta.tool_calls（ChoiceDeltaToolCall のリスト）を取り込む"""
+        for tc in deltas or []:
+            idx = self._resolve_index(tc)
+            call = self._calls.setdefault(idx, {
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""},
+            })
+            if tc.id:
+                call["id"] = tc.id
+            fn = tc.function
+            if fn and fn.name:
+                call["function"]["name"] = fn.name
+            if fn and fn.arguments:
+                call["function"]["arguments"] += fn.arguments  # JSON断片を結合
+            self._last_index = idx
+
+    def _entry(self, n: int, idx: int) -> Dict[str, Any]:
+        call = self._calls[idx]
+        return {
+            "id": call["id"] or f"tool-call-{n+1}",
+            "type": "function",
+            "function": {
+                "name": call["function"]["name"],
+                "arguments": call["function"]["arguments"] or "{}",
+            },
+        }
+
+    @staticmethod
+    def _complete(arguments: str) -> bool:
+        """引数の JSON がオブジェクトとして閉じているか（閉じた後に続きが来ることはない）"""
+        text = arguments.strip()
+        if not text.endswith("}"):
+            return False
+        try:
+            return isinstance(json.loads(text), dict)
+        except json.JSONDecodeError:
+            return False
+
+    def ready(self, final: bool = False) -> List[Dict[str, Any]]:
+        """
+        まだ返していない呼び出しのうち、引数がそろったものを tool_calls 形式で返す。
+        後ろの index の断片が来ていれば前の呼び出しは終わっているとみなす。
+        final=True（ストリーム終了後）なら残りを全部返す（壊れた引数は実行側でエラーにする）。
+        """
+        out = []
+        order = sorted(self._calls)
+        for n, idx in enumerate(order):
+            if idx in self._reported:
+                continue
+            call = self._calls[idx]
+            later = n + 1 < len(order)
+            done = call["function"]["name"] and (later or self._complete(call["function"]["arguments"]))
+            if not (final or done):
+                continue
+            self._reported.add(idx)
+            out.append(self._entry(n, idx))
+        return out
+
+    def calls(self) -> List[Dict[str, Any]]:
+        """index 順に並べた、assistantメッセージの tool_calls 形式のリストを返す"""
+        return [self._entry(n, idx) for n, idx in enumerate(sorted(self._calls))]
+
+    def __len__(self) -> int:
+        return len(self._calls)
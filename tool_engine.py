@@ -0,0 +1,148 @@
+# tool_engine.py
+from __future__ import annotations
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from cache import TTLCache
+from metrics import TOOL_SECONDS
+
+
+@dataclass
+class ToolSpec:
+    fn: Callable[..., Dict[str, Any]]
+    timeout: float = 10.0             # 1回の実行の締め切り（秒）
+    cache_ttl: Optional[float] = None  # 結果を覚えておく秒数（None/0 ならキャッシュしない）
+
+
+class ToolEngine:
+    """
+    ツール実行エンジン（dispatch_tool の if 連鎖の置き換え）。
+      - 登録したツールを名前で引いて実行する
+      - 独立した tool_calls は上限付きのスレッドプールで並行に実行する
+      - ツールごとに締め切りを設け、超えたら {"error": ...} を返して先へ進む
+      - (ツール名, 正規化した引数) をキーにした TTL付きLRU で結果を使い回す
+    結果は常に元の tool_calls の順で返す。
+    """
+
+    def __init__(self, max_workers: int = 8, cache_size: int = 1024) -> None:
+        self._tools: Dict[str, ToolSpec] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self._cache = TTLCache(maxsize=cache_size, ttl=None)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}   # 実行ごとの待っている呼び出し元の数
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._stats_lock = threading.Lock()
+
+    def register(self, name: str, fn: Callable[..., Dict[str, Any]], timeout: float = 10.0,
+                 cache_ttl: Optional[float] = None) -> None:
+        self._tools[name] = ToolSpec(fn=fn, timeout=timeout, cache_ttl=cache_ttl)
+        self._stats[name] = {"calls": 0, "errors": 0, "timeouts": 0, "total_ms": 0.0, "max_ms": 0.0}
+
+    def cache_ttl(self, name: str) -> Optional[float]:
+        """ツール結果を覚えておく秒数（未登録・キャッシュしないツールは None）"""
+        spec = self._tools.get(name)
+        return spec.cache_ttl if spec is not None and spec.cache_ttl else None
+
+    @staticmethod
+    def cache_key(name: str, args: Dict[str, Any]) -> str:
+        # キー順・空白の違いを吸収して同じ呼び出しを同じキーにする
+        return name + ":" + json.dumps(args, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+    def _record(self, name: str, elapsed_ms: float, error: bool = False, timeout: bool = False) -> None:
+        TOOL_SECONDS.observe(elapsed_ms / 1000, tool=name)
+        with self._stats_lock:
+            st = self._stats[name]
+            st["calls"] += 1
+            st["errors"] += int(error)
+            st["timeouts"] += int(timeout)
+            st["total_ms"] += elapsed_ms
+            st["max_ms"] = max(st["max_ms"], elapsed_ms)
+
+    async def run(self, name: str, args_json: str) -> Dict[str, Any]:
+        """ツールを1つ実行する。失敗・タイムアウトも例外にせず {"error": ...} で返す"""
+        spec = self._tools.get(name)
+        if spec is None:
+            return {"error": f"Unknown tool: {name}"}
+        try:
+            args = json.loads(args_json or "{}")
+        except json.JSONDecodeError as e:
+            return {"error": f"Invalid arguments: {e}"}
+
+        key = self.cache_key(name, args)
+        if spec.cache_ttl:
+            cached = self._cache.get(key)
+            if cached is not None:
+                return cached
+            # 同じ呼び出しが実行中ならその結果を待つ（同時に来た重複を1回にまとめる）
+            # （待ち手が0人の実行は取り消し中なので相乗りしない）
+            task = self._inflight.get(key)
+            if task is None or not self._waiters.get(task):
+                task = self._start(name, spec, args, key)
+                self._inflight[key] = task
+                task.add_done_callback(lambda t: self._inflight.pop(key) if self._inflight.get(key) is t else None)
+        else:
+            task = self._start(name, spec, args, key)
+        # 実行は呼び出し元とは別タスクで、待っている呼び出し元を数えておく。
+        # 切断された呼び出し元は自分の待ちだけをやめる（同じ実行を待つほかのリクエストには影響しない）。
+        # 最後の1人が居なくなったら実行そのものを取り消す（まだスレッドプールの順番待ちなら走らない）
+        self._waiters[task] += 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            left = self._waiters[task] - 1
+            if left:
+                self._waiters[task] = left
+            else:
+                del self._waiters[task]
+                if not task.done():
+                    task.cancel()
+
+    def _start(self, name: str, spec: ToolSpec, args: Dict[str, Any], key: str) -> asyncio.Task:
+        task = asyncio.ensure_future(self._execute(name, spec, args, key))
+        self._waiters[task] = 0
+        return task
+
+    async def _execute(self, name: str, spec: ToolSpec, args: Dict[str, Any], key: str) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        t0 = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(self._executor, lambda: spec.fn(**args)),
+                timeout=spec.timeout,
+            )
+            self._record(name, (time.perf_counter() - t0) * 1000)
+            if spec.cache_ttl:
+                self._cache.set(key, result, ttl=spec.cache_ttl)
+        except asyncio.TimeoutError:
+            # スレッド自体は止められないが、ストリームはこれ以上待たない
+            self._record(name, (time.perf_counter() - t0) * 1000, error=True, timeout=True)
+            result = {"error": f"Tool {name} timed out after {spec.timeout}s"}
+        except Exception as e:
+            self._record(name, (time.perf_counter() - t0) * 1000, error=True)
+            result = {"error": str(e)}
+        return result
+
+    async def run_all(self, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """tool_calls（assistantメッセージの形式）を並行に実行し、元の順で結果を返す"""
+        return await asyncio.gather(*[
+            self.run(tc["function"]["name"], tc["function"]["arguments"]) for tc in tool_calls
+        ])
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            tools = {
+                name: {
+                    **st,
+                    "avg_ms": round(st["total_ms"] / st["calls"], 3) if st["calls"] else 0.0,
+                }
+                for name, st in self._stats.items()
+            }
+        return {"cache": self._cache.stats(), "tools": tools}
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
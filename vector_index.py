@@ -0,0 +1,175 @@
+# vector_index.py
+from __future__ import annotations
+import json
+import mmap
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+NUMPY_INDEX_DIR = "data/vector_index"
+_SEARCH_BLOCK = 65536   # 行列積を何行ずつ行うか（float16 → float32 変換の一時メモリを抑える）
+_SEARCH_MAX_SCORES = 2**22   # 1ブロックで持つスコアの最大個数（クエリ数×行数。float32 で 16MB）
+
+# ディレクトリ構成:
+#   vectors.npy   … (n, dim) の L2正規化済み行列（float32 か float16）。np.load(mmap_mode="r") で開く
+#   meta.jsonl    … 1行1チャンク {"id", "meta", "doc"}
+#   offsets.npy   … meta.jsonl の各行の開始バイト位置（n+1 個）。必要な行だけ読む
+#   index.json    … 件数・次元・dtype・参照している全文の版（text_versions）
+
+
+class JsonlSidecarWriter:
+    """1行1レコードのJSONLと、各行の開始バイト位置（offsets.npy）を書く"""
+
+    def __init__(self, out_dir: str, n: int, name: str = "meta") -> None:
+        self.out_dir, self.name = out_dir, name
+        self._offsets = np.zeros(n + 1, dtype=np.int64)
+        self._file = open(os.path.join(out_dir, f"{name}.jsonl"), "wb")
+        self._row = 0
+
+    def add(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        self._file.write(line)
+        self._offsets[self._row + 1] = self._offsets[self._row] + len(line)
+        self._row += 1
+
+    def close(self) -> None:
+        self._file.close()
+        np.save(os.path.join(self.out_dir, "offsets.npy" if self.name == "meta" else f"{self.name}_offsets.npy"),
+                self._offsets)
+
+
+class JsonlSidecar:
+    """JsonlSidecarWriter が書いたファイルを mmap し、必要な行だけ読む"""
+
+    def __init__(self, index_dir: str, name: str = "meta") -> None:
+        self.offsets = np.load(
+            os.path.join(index_dir, "offsets.npy" if name == "meta" else f"{name}_offsets.npy"), mmap_mode="r"
+        )
+        self._file = open(os.path.join(index_dir, f"{name}.jsonl"), "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return json.loads(self._data[start:end])
+
+    def close(self) -> None:
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+
+def replace_dir(tmp_dir: str, out_dir: str) -> None:
+    """書き終えた一時ディレクトリで out_dir を差し替える（古い方は退避してから消す）"""
+    old = f"{out_dir}.old-{os.getpid()}"
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+class NumpyIndexWriter:
+    """
+    NumpyIndex 形式を書き出す。行数を先に決めて memmap に直接書くので、全ベクトルをメモリに持たない。
+    書き終わるまでは一時ディレクトリに書き、commit() で差し替える。
+    """
+
+    def __init__(self, out_dir: str, n: int, dim: int, dtype: str = "float32") -> None:
+        self.out_dir = out_dir
+        self.tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self.n, self.dim, self.dtype = n, dim, dtype
+        self._vectors = np.lib.format.open_memmap(
+            os.path.join(self.tmp_dir, "vectors.npy"), mode="w+", dtype=dtype, shape=(n, dim)
+        )
+        self._meta = JsonlSidecarWriter(self.tmp_dir, n)
+        self._text_versions: Set[Tuple[str, str]] = set()   # 行が参照する全文の (source, text_sha)
+        self._row = 0
+
+    def add(self, ids: Sequence[str], embeddings: Any, metadatas: Sequence[Dict],
+            documents: Sequence[Optional[str]]) -> None:
+        vecs = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        vecs /= np.maximum(norms, 1e-12)
+        end = self._row + len(vecs)
+        self._vectors[self._row:end] = vecs.astype(self.dtype)
+        for id_, meta, doc in zip(ids, metadatas, documents):
+            self._meta.add({"id": id_, "meta": meta, "doc": doc})
+            if meta and meta.get("text_sha"):
+                self._text_versions.add((meta["source"], meta["text_sha"]))
+        self._row = end
+
+    def commit(self) -> None:
+        if self._row != self.n:
+            raise ValueError(f"行数が合いません: {self._row} != {self.n}")
+        self._vectors.flush()
+        del self._vectors
+        self._meta.close()
+        with open(os.path.join(self.tmp_dir, "index.json"), "w", encoding="utf-8") as f:
+            json.dump({"count": self.n, "dim": self.dim, "dtype": self.dtype,
+                       "text_versions": sorted(self._text_versions)}, f)
+        replace_dir(self.tmp_dir, self.out_dir)
+
+
+class NumpyIndex:
+    """
+    mmap した行列に対する総当たりのコサイン類似度検索。
+      - 起動時はファイルを mmap するだけなので数ミリ秒で開ける
+      - 検索はブロックごとの行列積（クエリをまとめて渡せる）と argpartition による top-k の併合
+    数百万チャンク程度までなら Chroma を通すより速く、起動コストもない。
+    """
+
+    def __init__(self, index_dir: str = NUMPY_INDEX_DIR) -> None:
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "index.json"), encoding="utf-8") as f:
+            self.info = json.load(f)
+        self.vectors = np.load(os.path.join(index_dir, "vectors.npy"), mmap_mode="r")
+        self.meta = JsonlSidecar(index_dir)
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def row(self, i: int) -> Dict[str, Any]:
+        return self.meta[i]
+
+    def search(self, queries: Any, top_k: int = 4) -> List[List[Tuple[int, float]]]:
+        """
+        queries: (m, dim) のクエリベクトル。クエリごとに [(行番号, コサイン類似度), ...] を類似度の高い順で返す
+        """
+        q = np.asarray(queries, dtype=np.float32)
+        if q.ndim == 1:
+            q = q[None, :]
+        q = q / np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+        n = len(self)
+        if n == 0:
+            return [[] for _ in range(len(q))]
+
+        # 全行ぶんのスコア行列は作らない。ブロックごとに上位 k 件を取り、それまでの上位とだけ比べる。
+        # 一時メモリはクエリ数×ブロック行数と、クエリ数×k で済む（クエリが多ければブロックを小さくする）
+        k = min(top_k, n)
+        block_rows = max(1, min(_SEARCH_BLOCK, _SEARCH_MAX_SCORES // len(q)))
+        best_scores = np.empty((len(q), 0), dtype=np.float32)
+        best_rows = np.empty((len(q), 0), dtype=np.int64)
+        for start in range(0, n, block_rows):
+            block = np.asarray(self.vectors[start:start+block_rows], dtype=np.float32)
+            scores = q @ block.T
+            kb = min(k, scores.shape[1])
+            part = np.argpartition(-scores, kb - 1, axis=1)[:, :kb]
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, part, axis=1)], axis=1)
+            best_rows = np.concatenate([best_rows, part + start], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        results = []
+        for qi in range(len(q)):
+            results.append([(int(best_rows[qi, j]), float(best_scores[qi, j])) for j in order[qi]])
+        return results
+
+    def close(self) -> None:
+        self.meta.close()